@@ -2,39 +2,33 @@
 # import boto3
 # import logging
 import datetime
+import inspect
 import os
 import posixpath
-import psycopg2 as psql
-import subprocess
 import tempfile
 import time
 import uuid
 
-from fastapi import Cookie, Depends, FastAPI, HTTPException, File, Form, UploadFile
+from fastapi import Cookie, Depends, FastAPI, HTTPException, Form, Query
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND
 from typing import List, Optional, Union
 
-from ultitrackerapi import CORS_ORIGINS, S3_BUCKET_NAME, ULTITRACKER_COOKIE_KEY, annotator_queue, auth, get_backend, get_logger, get_s3Client, models, sql_models, video
+from ultitrackerapi import ANNOTATION_EXPIRATION_DURATION, ANNOTATION_STREAM_BATCH_SIZE, ANNOTATION_STREAM_MAX_BATCH_SIZE, CORS_ORIGINS, GAME_LIST_DEFAULT_LIMIT, GAME_LIST_MAX_LIMIT, MAX_ANNOTATION_BATCH_SIZE, MAX_ANNOTATION_EXPIRATION_DURATION, MAX_IMAGES_FOR_ANNOTATION, MAX_UPLOAD_SIZE, NUM_IMAGES_FOR_ANNOTATION, QUERY_IMAGES_DEFAULT_LIMIT, QUERY_IMAGES_MAX_LIMIT, S3_BUCKET_NAME, ULTITRACKER_COOKIE_KEY, annotator_queue, auth, get_backend, get_lease_manager, get_logger, get_presigner, get_s3Client, get_sync_backend, models, sql_backend, sql_models, upload, video, video_jobs
+from ultitrackerapi.backend import call_backend
 
 # sleep just to make sure the above happened
 time.sleep(1)
 
 backend_instance = get_backend()
+lease_manager = get_lease_manager()
 s3Client = get_s3Client()
 logger = get_logger(__name__, "DEBUG")
 
-
-try:
-    backend_instance.client._establish_connection()
-
-except psql.DatabaseError as e:
-    logger.error("main: Couldn't connect to database. Aborting")
-    raise e
-
 logger.info("CORS_ORIGINS: {}".format(CORS_ORIGINS))
 
 app = FastAPI()
@@ -50,6 +44,24 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def connect_to_database():
+    try:
+        await call_backend(backend_instance.client._establish_connection)
+
+    except Exception as e:
+        logger.error("main: Couldn't connect to database. Aborting")
+        raise e
+
+
+@app.on_event("shutdown")
+async def disconnect_from_database():
+    if lease_manager is not None:
+        await call_backend(lease_manager.close)
+
+    await call_backend(backend_instance.client.close_connection)
+
+
 @app.get("/")
 async def return_welcome():
     return {"message": "Welcome"}
@@ -59,7 +71,7 @@ async def return_welcome():
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
 ):
-    user = auth.authenticate_user(
+    user = await auth.authenticate_user(
         auth.sanitize_for_html(form_data.username), form_data.password
     )
 
@@ -104,8 +116,8 @@ async def add_user(userform: models.UserForm = Depends()):
         full_name=auth.sanitize_for_html(userform.full_name),
     )
 
-    is_success = backend_instance.add_user(
-        user, salted_password=salted_password)
+    is_success = await call_backend(
+        backend_instance.add_user, user, salted_password=salted_password)
 
     if is_success:
         return is_success
@@ -134,11 +146,73 @@ async def get_user_info(
     return current_user
 
 
+@app.get("/pool_stats")
+async def get_pool_stats(
+    current_user: models.User = Depends(auth.get_admin_user_from_cookie),
+):
+    return backend_instance.client.pool_stats()
+
+
+@app.get("/cache_stats")
+async def get_cache_stats(
+    current_user: models.User = Depends(auth.get_admin_user_from_cookie),
+):
+    return {
+        "user_cache": backend_instance.user_cache.stats(),
+        "jwt_claims_cache": auth.claims_cache.stats(),
+        "presigned_url_cache": get_presigner().stats(),
+    }
+
+
+@app.get("/lease_stats")
+async def get_lease_stats(
+    current_user: models.User = Depends(auth.get_admin_user_from_cookie),
+):
+    if lease_manager is None:
+        return {}
+
+    return lease_manager.stats()
+
+
 @app.get("/get_game_list", response_model=models.GameListResponse)
 async def get_game_list(
+    limit: int = Query(GAME_LIST_DEFAULT_LIMIT, ge=1, le=GAME_LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    order_by: str = "game_id",
+    home: Optional[str] = None,
+    away: Optional[str] = None,
+    date: Optional[str] = None,
     current_user: models.User = Depends(auth.get_user_from_cookie),
 ):
-    return backend_instance.get_game_list(current_user)
+    """Returns one page of the user's games. Follow `next_cursor` for the
+    next page, `home`, `away` and `date` only return games matching them.
+    """
+    order = getattr(models.GameListOrder, order_by, None)
+    if order is None:
+        raise HTTPException(
+            status_code=400,
+            detail="order_by must be one of: {}".format(
+                ", ".join(o.name for o in models.GameListOrder)
+            )
+        )
+
+    filters = {
+        k: v
+        for k, v in [("home", home), ("away", away), ("date", date)]
+        if v is not None
+    }
+
+    try:
+        return await call_backend(
+            backend_instance.get_game_list,
+            current_user,
+            limit=limit,
+            cursor=cursor,
+            order_by=order,
+            filters=filters,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/get_game", response_model=Optional[models.GameResponse])
@@ -146,7 +220,9 @@ async def get_game(
     game_id: str,
     current_user: models.User = Depends(auth.get_user_from_cookie),
 ):
-    result = backend_instance.get_game(game_id=game_id, user=current_user)
+    result = await call_backend(
+        backend_instance.get_game, game_id=game_id, user=current_user
+    )
     if not result:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND, 
@@ -156,61 +232,132 @@ async def get_game(
         return result
 
 
+@app.get("/game/{game_id}/processing_status", response_model=models.ProcessingStatusResponse)
+async def get_processing_status(
+    game_id: str,
+    current_user: models.User = Depends(auth.get_user_from_cookie),
+):
+    """Where the ingestion of a game is: every stage that started with its
+    timing, counts and error, and the state of the processing job."""
+    game = await call_backend(
+        backend_instance.get_game, game_id=game_id, user=current_user
+    )
+    if not game:
+        raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND, 
+            detail="GameId not found"
+        )
+
+    return await call_backend(backend_instance.get_processing_status, game_id)
+
+
+@app.get("/processing_status/summary", response_model=models.ProcessingSummaryResponse)
+async def get_processing_summary(
+    days: int = Query(7, ge=1, le=365),
+    current_user: models.User = Depends(auth.get_admin_user_from_cookie),
+):
+    """Latency percentiles of every ingestion stage over the last `days`."""
+    return await call_backend(backend_instance.get_processing_summary, days)
+
+
 @app.post("/upload_file")
 async def upload_file(
+    request: Request,
     current_user: models.User = Depends(auth.get_user_from_cookie),
-    upload_file: UploadFile = File(...),
-    name: str = Form(...),
-    home: str = Form(...),
-    away: str = Form(...),
-    date: str = Form(...),
 ):
-    _, local_video_filename = tempfile.mkstemp()
+    """Adds a game for the video in the `upload_file` field of the multipart
+    body, with the `name`, `home`, `away` and `date` fields as its data.
+
+    The body is read here rather than through `File` and `Form` parameters,
+    so that it is hashed and written to disk as it arrives and a body larger
+    than MAX_UPLOAD_SIZE is rejected without being received in full.
+    """
+    fd, local_video_filename = tempfile.mkstemp()
+    os.close(fd)
     game_id = str(uuid.uuid4())
 
-    logger.debug("Local video filename: {}".format(local_video_filename))
-    logger.debug("home, away, date: {}, {}, {}".format(home, away, date))
-    logger.debug("game_id: {}".format(game_id))
-    
-    time.sleep(0.1)
+    try:
+        fields, content_sha256, _ = await upload.receive_upload(
+            request,
+            file_field="upload_file",
+            field_names=["name", "home", "away", "date"],
+            filename=local_video_filename,
+            max_size=MAX_UPLOAD_SIZE,
+        )
 
-    chunk_size = 10000
-    with open(local_video_filename, "wb") as f:
-        for chunk in iter(lambda: upload_file.file.read(chunk_size), b""):
-            f.write(chunk)
+        logger.debug("Local video filename: {}".format(local_video_filename))
+        logger.debug("home, away, date: {}, {}, {}".format(fields["home"], fields["away"], fields["date"]))
+        logger.debug("game_id: {}".format(game_id))
 
-    thumbnail_filename = local_video_filename + "_thumbnail.jpg"
+        data = dict(
+            fields,
+            bucket=S3_BUCKET_NAME,
+            content_sha256=content_sha256,
+        )
 
-    video_key = posixpath.join(game_id, "video.mp4")
-    thumbnail_key = posixpath.join(game_id, "thumbnail.jpg")
-    
-    logger.info("Submitting extract video job")
-    subprocess.Popen([
-        "python", "-m", 
-        "ultitrackerapi.extract_and_upload_video",
-        S3_BUCKET_NAME,
-        local_video_filename,
-        thumbnail_filename,
-        video_key,
-        thumbnail_key,
-        game_id
-    ])
-
-    logger.info("Adding game to DB")
-    backend_instance.add_game(
-        current_user,
-        game_id=game_id,
-        thumbnail_key=thumbnail_key,
-        video_key=video_key,
-        data={
-            "name": name,
-            "home": home,
-            "away": away,
-            "date": date,
-            "bucket": S3_BUCKET_NAME,
-            # "length": video_length,
-        },
-    )
+        source_game = await call_backend(
+            backend_instance.find_ingested_game, content_sha256
+        )
+        if source_game is not None:
+            logger.info(
+                "Video of game {} already ingested as game {}".format(
+                    game_id, source_game["game_id"]
+                )
+            )
+
+            await call_backend(
+                backend_instance.add_deduplicated_game,
+                current_user,
+                game_id=game_id,
+                data=data,
+                source_game=source_game,
+            )
+
+            return {"finished": True}
+
+        video_key = posixpath.join(game_id, "video.mp4")
+        thumbnail_key = posixpath.join(game_id, "thumbnail.jpg")
+
+        # the video workers can run on any node, so they get the video
+        # through S3. It is staged at its final key, the workers do not
+        # upload it again
+        logger.info("Uploading video")
+        await run_in_threadpool(
+            s3Client.upload_file,
+            local_video_filename,
+            S3_BUCKET_NAME,
+            video_key,
+        )
+    finally:
+        os.remove(local_video_filename)
+
+    # the game is only added together with the job that processes it, so a
+    # failure never leaves a game without a video or a job
+    logger.info("Adding game to DB and enqueueing extract video job")
+    user_in_db = await call_backend(backend_instance.get_user, current_user.username)
+    try:
+        await run_in_threadpool(
+            video_jobs.enqueue,
+            get_sync_backend().client,
+            game_id=game_id,
+            payload={
+                "bucket": S3_BUCKET_NAME,
+                "video_key": video_key,
+                "thumbnail_key": thumbnail_key,
+            },
+            commands=sql_backend.add_game_commands(
+                game_id,
+                user_in_db.user_id,
+                data,
+                thumbnail_key,
+                video_key,
+            ),
+        )
+    except Exception:
+        await run_in_threadpool(
+            s3Client.delete_object, Bucket=S3_BUCKET_NAME, Key=video_key
+        )
+        raise
 
     return {"finished": True}
 
@@ -220,18 +367,45 @@ async def get_images_to_annotate(
     current_user: models.User = Depends(auth.get_user_from_cookie),
     game_ids: str = Form(...),
     annotation_type: str = Form(...),
-    order_type: str = Form(...)
+    order_type: str = Form(...),
+    num_images: int = Form(
+        NUM_IMAGES_FOR_ANNOTATION, ge=1, le=MAX_IMAGES_FOR_ANNOTATION
+    ),
+    lease_duration: int = Form(
+        ANNOTATION_EXPIRATION_DURATION,
+        ge=1,
+        le=MAX_ANNOTATION_EXPIRATION_DURATION,
+    ),
 ):
+    """Leases up to `num_images` images for `lease_duration` seconds.
+
+    Concurrent callers never receive the same image.
+    """
     queue_params = annotator_queue.AnnotatorQueueParams(
         game_ids=game_ids.split(),
         annotation_type=models.AnnotationTable[annotation_type],
-        order_type=annotator_queue.AnnotationOrderType[order_type]
+        order_type=annotator_queue.AnnotationOrderType[order_type],
+        num_images=num_images,
+        lease_duration=lease_duration,
     )
 
-    images = annotator_queue.get_next_n_images(
-        backend=backend_instance, 
-        queue_params=queue_params
-    )
+    if lease_manager is not None:
+        images = await call_backend(
+            lease_manager.get_next_n_images,
+            backend=backend_instance,
+            queue_params=queue_params
+        )
+    elif inspect.iscoroutinefunction(backend_instance.get_user):
+        images = await annotator_queue.async_get_next_n_images(
+            backend=backend_instance,
+            queue_params=queue_params
+        )
+    else:
+        images = await call_backend(
+            annotator_queue.get_next_n_images,
+            backend=backend_instance, 
+            queue_params=queue_params
+        )
 
     return images
 
@@ -244,7 +418,8 @@ async def insert_annotation(
     current_user: models.User = Depends(auth.get_user_from_cookie),
 ):
     try:
-        backend_instance.insert_annotation(
+        await call_backend(
+            backend_instance.insert_annotation,
             user=current_user,
             img_id=img_id,
             annotation_table=models.AnnotationTable[annotation_table],
@@ -265,14 +440,60 @@ async def insert_annotation(
         )
         raise e
 
+    if lease_manager is not None:
+        lease_manager.release(img_id, models.AnnotationTable[annotation_table])
+
     return True
 
 
+@app.post("/annotator/insert_annotation_batch", response_model=models.AnnotationBatchResponse)
+async def insert_annotation_batch(
+    batch: models.AnnotationBatchRequest,
+    current_user: models.User = Depends(auth.get_user_from_cookie),
+):
+    """Writes every annotation of the batch in one transaction.
+
+    Items that are invalid, repeat an earlier item, contain the same field
+    line twice or reference an unknown image are reported in their result
+    and do not keep the others from being inserted. A resubmitted camera
+    angle or field line replaces the stored one, like a new set of boxes is
+    added to the stored ones.
+    """
+    if len(batch.items) > MAX_ANNOTATION_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail="At most {} items per batch".format(MAX_ANNOTATION_BATCH_SIZE),
+        )
+
+    response = await call_backend(
+        backend_instance.insert_annotation_batch,
+        user=current_user,
+        items=batch.items,
+    )
+
+    if lease_manager is not None:
+        for result in response.results:
+            if result.inserted:
+                lease_manager.release(
+                    result.img_id,
+                    models.AnnotationTable[result.annotation_table],
+                )
+
+    return response
+
+
 @app.get("/get_annotations")
-def get_annotations(
+async def get_annotations(
     annotation_table: str,
+    stream: bool = False,
+    batch_size: int = Query(
+        ANNOTATION_STREAM_BATCH_SIZE, ge=1, le=ANNOTATION_STREAM_MAX_BATCH_SIZE
+    ),
     current_user: models.User = Depends(auth.get_user_from_cookie)
 ):
+    """Returns every row of the annotation table. With `stream` the rows are
+    sent as NDJSON, read from the database `batch_size` rows at a time.
+    """
     table = getattr(models.AnnotationTable, annotation_table, None)
     if table is None:
         raise HTTPException(
@@ -280,17 +501,23 @@ def get_annotations(
             detail="annotation_table not found: {}".format(annotation_table)
         )
 
-    annotations = backend_instance.get_annotations(table)
+    if stream:
+        return StreamingResponse(
+            backend_instance.stream_annotations(table, batch_size=batch_size),
+            media_type="application/x-ndjson",
+        )
+
+    annotations = await call_backend(backend_instance.get_annotations, table)
 
     return annotations
 
 
 @app.get("/get_image")
-def get_image(
+async def get_image(
     img_id: str,
     current_user: models.User = Depends(auth.get_user_from_cookie)
 ):
-    s3_path = backend_instance.get_image_path(img_id)
+    s3_path = await call_backend(backend_instance.get_image_path, img_id)
     if not s3_path:
         error = FileExistsError("Image path does not exist for img_id: {}".format(img_id))
         logger.error(repr(error))
@@ -298,7 +525,7 @@ def get_image(
 
     bucket, key = models.parse_bucket_key_from_url(s3_path)
     
-    expiration_time = datetime.datetime.now() + datetime.timedelta(seconds=3600)
+    expiration_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=3600)
 
     return models.ImgLocationResponse(
         img_id=img_id,
@@ -307,22 +534,49 @@ def get_image(
     )
 
 
-@app.get("/query_images")
-def query_images(
-    query: str,
+@app.get("/query_images", response_model=models.ImageQueryResponse)
+async def query_images(
+    query: Optional[str] = None,
+    img_query: Optional[str] = None,
+    game_query: Optional[str] = None,
+    limit: int = Query(QUERY_IMAGES_DEFAULT_LIMIT, ge=1, le=QUERY_IMAGES_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    count_only: bool = False,
     current_user: models.User = Depends(auth.get_user_from_cookie)
 ):
-    """Queries all image metadata and returns all entries in `img_location` 
-    where each key, value pair in the query matches the corresponding key, value 
-    pair in the image metadata.
+    """Queries all image metadata and returns the entries in `img_location`
+    that match every query, one page at a time ordered by img_id.
+
+    `img_query` and `game_query` are json objects that the image metadata and
+    the game data have to contain. Each key, value pair of the legacy `query`
+    has to match the image metadata or the game data as text. With
+    `count_only` only the number of matching images is returned.
     """
     import json
 
-    try:
-        parsed_query = json.loads(query)
-    except json.decoder.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Expect query as a json")
+    parsed_queries = []
+    for name, value in [("query", query), ("img_query", img_query), ("game_query", game_query)]:
+        try:
+            parsed_query = json.loads(value) if value else {}
+        except json.decoder.JSONDecodeError:
+            parsed_query = None
+
+        if not isinstance(parsed_query, dict):
+            raise HTTPException(
+                status_code=400, detail="Expect {} as a json object".format(name)
+            )
 
-    results = backend_instance.query_images(parsed_query)
+        parsed_queries.append(parsed_query)
+
+    try:
+        results = await call_backend(
+            backend_instance.query_images,
+            *parsed_queries,
+            limit=limit,
+            cursor=cursor,
+            count_only=count_only,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     return results
@@ -1,10 +1,12 @@
 # import argparse
 import boto3
 import ffmpeg
+import io
 import json
 import logging
 import os
 import posixpath
+import queue
 import sys
 import tarfile
 import tempfile
@@ -25,6 +27,150 @@ def extract_frames(in_filename, out_directory, fps=1, height=720):
     )
 
 
+class NearDuplicateFilter(object):
+    """Perceptual hashes frames in order and compares them to the last kept
+    frame, like ultitrackerapi.frame_dedup."""
+
+    def __init__(self, threshold):
+        # numpy and Pillow are only packaged with the function when
+        # near-duplicate suppression or in memory extraction is used
+        import numpy as np
+        from PIL import Image
+
+        self._np = np
+        self._image = Image
+        self._threshold = threshold
+        self._kept_hash = None
+        self._kept_key = None
+
+        k = np.arange(32)[:, np.newaxis]
+        i = np.arange(32)[np.newaxis, :]
+        self._dct_matrix = np.sqrt(2.0 / 32) * np.cos(np.pi * (2 * i + 1) * k / (2 * 32))
+        self._dct_matrix[0] /= np.sqrt(2.0)
+
+    def phash(self, frame):
+        np = self._np
+        image = frame if isinstance(frame, self._image.Image) else self._image.fromarray(frame)
+        pixels = np.asarray(
+            image.convert("L").resize((32, 32), self._image.BILINEAR),
+            dtype=np.float64,
+        )
+        low_frequencies = (self._dct_matrix @ pixels @ self._dct_matrix.T)[:8, :8].ravel()
+        bits = low_frequencies > np.median(low_frequencies[1:])
+        return int(np.packbits(bits).view(">u8")[0])
+
+    def is_duplicate(self, frame, frame_info):
+        """Adds the hash and the kept frame it duplicates to `frame_info`."""
+        frame_hash = self.phash(frame)
+        frame_info["phash"] = "{:016x}".format(frame_hash)
+
+        if (
+            self._kept_hash is not None
+            and bin(frame_hash ^ self._kept_hash).count("1") <= self._threshold
+        ):
+            frame_info["duplicate_of"] = self._kept_key
+            return True
+
+        self._kept_hash = frame_hash
+        self._kept_key = frame_info["key"]
+        return False
+
+    def is_duplicate_file(self, frame_path, frame_info):
+        with self._image.open(frame_path) as frame:
+            return self.is_duplicate(frame, frame_info)
+
+
+def extract_and_upload_frames_in_memory(
+    client, in_filename, s3_bucket_path, s3_output_frames_path, video_metadata,
+    fps=1, num_parallel_upload_threads=4, num_buffers=16, dedup_filter=None, drop_duplicates=False
+):
+    """Reads raw frames from ffmpeg's stdout into reusable buffers, encodes
+    and uploads them from memory without writing any frame to disk."""
+    # numpy and Pillow are only packaged with the function when this mode
+    # is used
+    import numpy as np
+    from PIL import Image
+
+    width = video_metadata["height"]
+    height = max(1, int(round(width * video_metadata["height"] / video_metadata["width"])))
+
+    free_buffers = queue.Queue()
+    for _ in range(num_buffers):
+        free_buffers.put(np.empty((height, width, 3), dtype=np.uint8))
+
+    def encode_and_upload(frame_info, frame):
+        try:
+            out = io.BytesIO()
+            Image.fromarray(frame).save(out, format="PNG")
+        finally:
+            free_buffers.put(frame)
+
+        client.put_object(Bucket=frame_info["bucket"], Key=frame_info["key"], Body=out.getvalue())
+
+        return frame_info
+
+    process = (
+        ffmpeg.input(in_filename)
+        .filter("scale", width, height)
+        .filter("fps", fps)
+        .output("pipe:", format="rawvideo", pix_fmt="rgb24")
+        .run_async(cmd="./ffmpeg_bin", pipe_stdout=True)
+    )
+
+    frame_futures = []
+    num_dropped = 0
+    with ThreadPoolExecutor(num_parallel_upload_threads) as ex:
+        finished = False
+        try:
+            frame_index = 0
+            while True:
+                frame = free_buffers.get()
+                view = memoryview(frame).cast("B")
+                num_read = 0
+                while num_read < len(view):
+                    n = process.stdout.readinto(view[num_read:])
+                    if not n:
+                        break
+                    num_read += n
+
+                if num_read == 0:
+                    free_buffers.put(frame)
+                    break
+
+                if num_read < len(view):
+                    raise ValueError("ffmpeg wrote a truncated frame")
+
+                frame_index += 1
+                frame_path = "frame_{:06d}.png".format(frame_index)
+                frame_info = {
+                    "frame": frame_path,
+                    "bucket": s3_bucket_path,
+                    "key": posixpath.join(s3_output_frames_path, frame_path)
+                }
+                if (
+                    dedup_filter is not None
+                    and dedup_filter.is_duplicate(frame, frame_info)
+                    and drop_duplicates
+                ):
+                    free_buffers.put(frame)
+                    num_dropped += 1
+                    continue
+
+                frame_futures.append(ex.submit(encode_and_upload, frame_info, frame))
+
+            finished = True
+        finally:
+            process.stdout.close()
+            if not finished and process.poll() is None:
+                process.kill()
+            process.wait()
+
+        if process.returncode:
+            raise ValueError("ffmpeg", process.returncode)
+
+        return [frame_future.result() for frame_future in frame_futures], num_dropped
+
+
 def handler(event, context):
     # parser = argparse.ArgumentParser()
 
@@ -39,6 +185,11 @@ def handler(event, context):
     s3_video_path = event["s3_video_path"]
     s3_output_frames_path = event["s3_output_frames_path"]
     video_metadata = event["video_metadata"]
+    fps = event.get("fps", 1)
+    in_memory = event.get("in_memory", False)
+    # "off", "mark" or "drop" near-duplicate frames
+    dedup_mode = event.get("dedup_mode", "off")
+    dedup_threshold = event.get("dedup_threshold", 6)
     num_parallel_upload_threads = event.get("num_parallel_upload_threads", 4)
     logging_level = event.get("logging_level", "INFO")
 
@@ -63,14 +214,52 @@ def handler(event, context):
     client.download_file(s3_bucket_path, s3_video_path, download_filename)
     logger.info("Finished downloading file")
 
+    dedup_filter = NearDuplicateFilter(dedup_threshold) if dedup_mode != "off" else None
+
+    if in_memory:
+        logger.info("Extracting and uploading frames from memory")
+        frames_info, num_dropped = extract_and_upload_frames_in_memory(
+            client,
+            download_filename,
+            s3_bucket_path,
+            s3_output_frames_path,
+            video_metadata,
+            fps=fps,
+            num_parallel_upload_threads=num_parallel_upload_threads,
+            dedup_filter=dedup_filter,
+            drop_duplicates=dedup_mode == "drop",
+        )
+        logger.info("Finished uploading files")
+
+        return {
+            "frames": frames_info,
+            "num_dropped": num_dropped
+        }
+
     logger.info("Extracting frames")
-    extract_frames(download_filename, frames_out_directory, height=video_metadata["height"])
+    extract_frames(download_filename, frames_out_directory, fps=fps, height=video_metadata["height"])
     logger.info("Finished extracting frames")
 
     frames_info = []
+    num_dropped = 0
     with ThreadPoolExecutor(num_parallel_upload_threads) as ex:
-        for frame_path in os.listdir(frames_out_directory):
+        # in frame order, near duplicates are found by comparing each frame
+        # to the last kept one
+        for frame_path in sorted(os.listdir(frames_out_directory)):
             key = posixpath.join(s3_output_frames_path, frame_path)
+            frame_info = {
+                "frame": frame_path,
+                "bucket": s3_bucket_path,
+                "key": key
+            }
+
+            if dedup_filter is not None:
+                is_duplicate = dedup_filter.is_duplicate_file(
+                    os.path.join(frames_out_directory, frame_path), frame_info
+                )
+                if is_duplicate and dedup_mode == "drop":
+                    num_dropped += 1
+                    continue
 
             ex.submit(
                 client.upload_file, 
@@ -79,18 +268,13 @@ def handler(event, context):
                 posixpath.join(s3_output_frames_path, frame_path)
             )
 
-            frames_info.append(
-                {
-                    "frame": frame_path,
-                    "bucket": s3_bucket_path,
-                    "key": key
-                }
-            )
+            frames_info.append(frame_info)
 
     logger.info("Finished uploading files")
 
     return {
-        "frames": frames_info
+        "frames": frames_info,
+        "num_dropped": num_dropped
     }
     # return {
     #     "frames": [frame for frame in os.listdir(frames_out_directory)],
@@ -0,0 +1,90 @@
+"""Benchmarks local frame extraction of a video for several process pool
+sizes and ffmpeg thread caps.
+
+The video is chunked once like extract_and_upload_video chunks it and the
+chunks are extracted with `LocalFrameExtractor` without uploading the
+frames, so no AWS access is needed. The ultitrackerapi environment
+variables still have to be set for the package to import.
+
+    python benchmark_frame_extraction.py video.mp4 --workers 1 4 8 --ffmpeg_threads 1 2
+
+Pass --in_memory to time the extraction that encodes frames straight from
+ffmpeg's stdout instead of writing them to disk.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from ultitrackerapi import FRAME_EXTRACTION_FPS, video
+from ultitrackerapi.frame_extraction import LocalFrameExtractor
+
+
+def make_jobs(chunked_video_dir, video_height_width, fps):
+    return [
+        {
+            "s3_bucket_path": "benchmark-bucket",
+            "s3_video_path": "chunks/" + basename,
+            "s3_output_frames_path": "frames/" + os.path.splitext(basename)[0],
+            "video_metadata": video_height_width,
+            "fps": fps,
+            "local_video_path": os.path.join(chunked_video_dir, basename),
+        }
+        for basename in sorted(os.listdir(chunked_video_dir))
+    ]
+
+
+def run(jobs, max_workers, ffmpeg_threads, in_memory):
+    start = time.perf_counter()
+    with LocalFrameExtractor(
+        max_workers=max_workers,
+        ffmpeg_threads=ffmpeg_threads,
+        upload=False,
+        in_memory=in_memory,
+    ) as frame_extractor:
+        num_frames = sum(
+            len(response["frames"]) for response in frame_extractor.extract(jobs)
+        )
+
+    return num_frames, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("video_filename")
+    parser.add_argument("--chunk_size", type=int, default=60)
+    parser.add_argument("--fps", type=float, default=FRAME_EXTRACTION_FPS)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--ffmpeg_threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--in_memory", action="store_true", help="Encode frames from ffmpeg's stdout instead of png files")
+
+    args = parser.parse_args()
+
+    chunked_video_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        video.chunk_video(args.video_filename, chunked_video_dir, chunk_size=args.chunk_size)
+        print("Chunked into {} chunks in {:.2f}s".format(
+            len(os.listdir(chunked_video_dir)), time.perf_counter() - start
+        ))
+
+        jobs = make_jobs(
+            chunked_video_dir,
+            video.get_video_height_width(args.video_filename),
+            args.fps,
+        )
+
+        for max_workers in args.workers:
+            for ffmpeg_threads in args.ffmpeg_threads:
+                num_frames, elapsed = run(jobs, max_workers, ffmpeg_threads, args.in_memory)
+                print("workers={:3d} ffmpeg_threads={:2d}: {} frames in {:.2f}s, {:.1f} frames/s".format(
+                    max_workers, ffmpeg_threads, num_frames, elapsed, num_frames / elapsed
+                ))
+    finally:
+        shutil.rmtree(chunked_video_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Benchmarks building the /get_game_list response with and without the
+presigned url cache.
+
+Signing happens locally with dummy credentials, so no AWS access is needed.
+The ultitrackerapi environment variables still have to be set for the
+package to import.
+"""
+import argparse
+import boto3
+import statistics
+import time
+import uuid
+
+from ultitrackerapi import S3_BUCKET_NAME, models, sql_backend, sql_models
+from ultitrackerapi.presign import PresignedUrlCache
+
+
+def make_game_rows(num_games):
+    rows = []
+    for _ in range(num_games):
+        game_id = str(uuid.uuid4())
+        rows.append((
+            game_id,
+            {
+                "name": "Benchmark",
+                "home": "Team 1",
+                "away": "Team 2",
+                "date": "2019-10-31",
+                "bucket": S3_BUCKET_NAME or "benchmark-bucket",
+            },
+            game_id + "/thumbnail.jpg",
+            game_id + "/video.mp4",
+        ))
+
+    return rows
+
+
+class UncachedPresigner(object):
+    """Signs every url on every call, like the models did before the cache."""
+
+    def __init__(self, s3_client):
+        self._s3_client = s3_client
+
+    def get_url(self, bucket, key, expires_in):
+        return self._s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=expires_in,
+        )
+
+    def get_urls(self, requests):
+        return [self.get_url(*request) for request in requests]
+
+
+def use_presigner(presigner):
+    import ultitrackerapi
+    ultitrackerapi.get_presigner = lambda: presigner
+    sql_backend.get_presigner = lambda: presigner
+
+
+def uncached_game_list(rows):
+    """The game list as it was built before the presigned url cache."""
+    return models.GameListResponse(
+        game_list=[
+            models.GameResponse(
+                **dict(zip(sql_models.TableGameMetadata.columns, row))
+            )
+            for row in rows
+        ]
+    )
+
+
+def time_requests(fn, num_requests):
+    timings = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print(
+        "{:>10}: mean {:8.2f} ms, p50 {:8.2f} ms, p95 {:8.2f} ms".format(
+            name,
+            1000 * statistics.mean(timings),
+            1000 * timings[len(timings) // 2],
+            1000 * timings[int(len(timings) * 0.95)],
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_games", default=500, type=int)
+    parser.add_argument("--num_requests", default=50, type=int)
+    args = parser.parse_args()
+
+    s3_client = boto3.client(
+        "s3",
+        region_name="us-east-1",
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+    )
+    rows = make_game_rows(args.num_games)
+
+    print("{} games, {} requests".format(args.num_games, args.num_requests))
+
+    use_presigner(UncachedPresigner(s3_client))
+    report(
+        "before",
+        time_requests(lambda: uncached_game_list(rows), args.num_requests),
+    )
+
+    presigner = PresignedUrlCache(s3_client)
+    use_presigner(presigner)
+    report(
+        "after",
+        time_requests(lambda: sql_backend.parse_game_list(rows), args.num_requests),
+    )
+    print("cache: {}".format(presigner.stats()))
+
+
+if __name__ == "__main__":
+    main()
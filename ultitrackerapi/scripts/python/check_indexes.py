@@ -0,0 +1,49 @@
+import sys
+
+from ultitrackerapi import sql_backend, sql_models
+
+
+LIST_INDEXES_COMMAND = """
+SELECT schemaname, tablename, indexname
+FROM pg_indexes
+WHERE schemaname = ANY(%(schema_names)s::text[])
+"""
+
+
+def missing_indexes(client: sql_backend.SQLClient, db=sql_models.DatabaseUltitracker):
+    """Returns the (table, index) pairs declared in `db` that do not exist
+    on the database."""
+    tables = sorted(db.tables, key=lambda table: table.full_name)
+    existing = set(
+        (schema_name, table_name, index_name)
+        for schema_name, table_name, index_name in client.execute(
+            LIST_INDEXES_COMMAND,
+            {"schema_names": list(set(table.schema_name for table in tables))},
+        )
+    )
+
+    return [
+        (table, index)
+        for table in tables
+        for index in table.indexes
+        if (table.schema_name, table.table_name, index.name) not in existing
+    ]
+
+
+def main():
+    client = sql_backend.SQLClient()
+
+    missing = missing_indexes(client)
+    for table, index in missing:
+        print("Missing index {} on {}: {}".format(
+            index.name, table.full_name, index.create_command(table.full_name)
+        ))
+
+    if missing:
+        sys.exit(1)
+
+    print("All declared indexes exist")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ import argparse
 import psycopg2 as psql
 
 from passlib.hash import pbkdf2_sha256
-from ultitrackerapi import S3_BUCKET_NAME, get_backend, models, sql_backend, sql_models
+from ultitrackerapi import S3_BUCKET_NAME, get_sync_backend, models, sql_backend, sql_models
 
 
 def initialize_schema(client: sql_backend.SQLClient):
@@ -24,6 +24,9 @@ def initialize_tables(client: sql_backend.SQLClient):
         sql_models.TableFieldLines,
         sql_models.TableCameraAngle,
         sql_models.TableAnnotationTransaction,
+        sql_models.TableAnnotationStatus,
+        sql_models.TableVideoJob,
+        sql_models.TableIngestStage,
     ]
     for table in initialization_order:
         # try to initialize tables if not made yet
@@ -37,6 +40,12 @@ def initialize_tables(client: sql_backend.SQLClient):
             print("Couldn't initialize tables")
             raise e
 
+        if table.migration_commands:
+            client.execute(table.migration_commands)
+
+        if table.indexes:
+            client.execute(table.create_index_commands)
+
 
 def main():
     # parser = argparse.ArgumentParser()
@@ -50,7 +59,7 @@ def main():
 
     initialize_tables(client)
 
-    backend = get_backend()
+    backend = get_sync_backend()
 
     try:
         backend.add_user(
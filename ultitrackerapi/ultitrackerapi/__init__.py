@@ -13,11 +13,98 @@ ULTITRACKER_AUTH_JWT_ALGORITHM = os.getenv("ULTITRACKER_AUTH_JWT_ALGORITHM")
 ULTITRACKER_AUTH_SECRET_KEY = os.getenv("ULTITRACKER_AUTH_SECRET_KEY")
 ULTITRACKER_AUTH_TOKEN_EXP_LENGTH = int(os.getenv("ULTITRACKER_AUTH_TOKEN_EXP_LENGTH"))
 ULTITRACKER_COOKIE_KEY = os.getenv("ULTITRACKER_COOKIE_KEY")
+# log the decoded claims whenever a token is validated
+ULTITRACKER_AUTH_LOG_CLAIMS = os.getenv("ULTITRACKER_AUTH_LOG_CLAIMS", "true").lower() == "true"
 ULTITRACKER_URL = os.getenv("ULTIRACKER_URL")
+# comma separated usernames allowed to read the internal /*_stats routes
+ULTITRACKER_ADMIN_USERNAMES = set(
+    username for username in os.getenv("ULTITRACKER_ADMIN_USERNAMES", "").split(",") if username
+)
+
+# "sql" for the psycopg2 backend, "async_sql" for the asyncpg backend
+ULTITRACKER_BACKEND = os.getenv("ULTITRACKER_BACKEND", "sql")
+# serve annotation leases from in-process reservations, sql backend only
+ULTITRACKER_LEASE_MANAGER = os.getenv("ULTITRACKER_LEASE_MANAGER", "false").lower() == "true"
 
 NUM_CONNECTION_RETRIES = 5
 ANNOTATION_EXPIRATION_DURATION = 10
 NUM_IMAGES_FOR_ANNOTATION = 1
+MAX_IMAGES_FOR_ANNOTATION = int(os.getenv("MAX_IMAGES_FOR_ANNOTATION", "50"))
+MAX_ANNOTATION_EXPIRATION_DURATION = int(os.getenv("MAX_ANNOTATION_EXPIRATION_DURATION", "3600"))
+GAME_LIST_DEFAULT_LIMIT = int(os.getenv("GAME_LIST_DEFAULT_LIMIT", "100"))
+GAME_LIST_MAX_LIMIT = int(os.getenv("GAME_LIST_MAX_LIMIT", "500"))
+QUERY_IMAGES_DEFAULT_LIMIT = int(os.getenv("QUERY_IMAGES_DEFAULT_LIMIT", "100"))
+QUERY_IMAGES_MAX_LIMIT = int(os.getenv("QUERY_IMAGES_MAX_LIMIT", "1000"))
+ANNOTATION_STREAM_BATCH_SIZE = int(os.getenv("ANNOTATION_STREAM_BATCH_SIZE", "1000"))
+ANNOTATION_STREAM_MAX_BATCH_SIZE = int(os.getenv("ANNOTATION_STREAM_MAX_BATCH_SIZE", "50000"))
+MAX_ANNOTATION_BATCH_SIZE = int(os.getenv("MAX_ANNOTATION_BATCH_SIZE", "10000"))
+# img_location rows buffered across frame extraction responses per COPY
+IMG_LOCATION_COPY_BATCH_SIZE = int(os.getenv("IMG_LOCATION_COPY_BATCH_SIZE", "10000"))
+# largest request body accepted by /upload_file in bytes
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(10 * 1024 ** 3)))
+# video processing jobs, see ultitrackerapi.video_worker
+VIDEO_JOB_MAX_ATTEMPTS = int(os.getenv("VIDEO_JOB_MAX_ATTEMPTS", "3"))
+# seconds before the first retry, doubled for every further attempt
+VIDEO_JOB_RETRY_DELAY = float(os.getenv("VIDEO_JOB_RETRY_DELAY", "60"))
+# running jobs whose worker has not sent a heartbeat for this many seconds
+# are claimed again
+VIDEO_JOB_STALE_TIMEOUT = float(os.getenv("VIDEO_JOB_STALE_TIMEOUT", "600"))
+VIDEO_JOB_HEARTBEAT_INTERVAL = float(os.getenv("VIDEO_JOB_HEARTBEAT_INTERVAL", "60"))
+VIDEO_WORKER_NUM_SLOTS = int(os.getenv("VIDEO_WORKER_NUM_SLOTS", "2"))
+VIDEO_WORKER_POLL_INTERVAL = float(os.getenv("VIDEO_WORKER_POLL_INTERVAL", "5"))
+# frames per second of video extracted for annotation
+FRAME_EXTRACTION_FPS = float(os.getenv("FRAME_EXTRACTION_FPS", "1"))
+# chunks uploaded or waiting for frame extraction at the same time, and how
+# often the segment list of the running chunker is checked for new chunks
+CHUNK_UPLOAD_CONCURRENCY = int(os.getenv("CHUNK_UPLOAD_CONCURRENCY", "8"))
+SEGMENT_LIST_POLL_INTERVAL = float(os.getenv("SEGMENT_LIST_POLL_INTERVAL", "0.5"))
+# "lambda" extracts the frames of every chunk in AWS Lambda, "local" in a
+# process pool on the video worker, see ultitrackerapi.frame_extraction
+FRAME_EXTRACTION_EXECUTOR = os.getenv("FRAME_EXTRACTION_EXECUTOR", "lambda")
+FRAME_EXTRACTION_LAMBDA_FUNCTION = os.getenv("FRAME_EXTRACTION_LAMBDA_FUNCTION", "extractFrames")
+FRAME_EXTRACTION_LAMBDA_CONCURRENCY = int(os.getenv("FRAME_EXTRACTION_LAMBDA_CONCURRENCY", "16"))
+# local processes default to one per core, each ffmpeg limited to
+# FRAME_EXTRACTION_FFMPEG_THREADS so the processes do not oversubscribe them
+FRAME_EXTRACTION_LOCAL_WORKERS = int(os.getenv("FRAME_EXTRACTION_LOCAL_WORKERS", str(os.cpu_count() or 1)))
+FRAME_EXTRACTION_FFMPEG_THREADS = int(os.getenv("FRAME_EXTRACTION_FFMPEG_THREADS", "1"))
+FRAME_EXTRACTION_UPLOAD_THREADS = int(os.getenv("FRAME_EXTRACTION_UPLOAD_THREADS", "4"))
+# stream raw frames from ffmpeg's stdout and encode and upload them from
+# memory instead of writing every frame to disk first, at most
+# FRAME_EXTRACTION_NUM_BUFFERS decoded frames are held per chunk
+FRAME_EXTRACTION_IN_MEMORY = os.getenv("FRAME_EXTRACTION_IN_MEMORY", "false").lower() == "true"
+FRAME_EXTRACTION_NUM_BUFFERS = int(os.getenv("FRAME_EXTRACTION_NUM_BUFFERS", "16"))
+# "off", "mark" or "drop" near-duplicate frames, frames within this many of
+# 64 perceptual hash bits of the last kept frame, see
+# ultitrackerapi.frame_dedup
+FRAME_DEDUP_MODE = os.getenv("FRAME_DEDUP_MODE", "off")
+FRAME_DEDUP_HAMMING_THRESHOLD = int(os.getenv("FRAME_DEDUP_HAMMING_THRESHOLD", "6"))
+# probes of video files, keyed by path, modification time and size
+VIDEO_PROBE_CACHE_MAX_SIZE = int(os.getenv("VIDEO_PROBE_CACHE_MAX_SIZE", "64"))
+VIDEO_PROBE_CACHE_TTL = float(os.getenv("VIDEO_PROBE_CACHE_TTL", "3600"))
+# images reserved per database round trip and how long a reservation is
+# held, leases longer than the reservation bypass the lease manager
+LEASE_MANAGER_RESERVATION_SIZE = int(os.getenv("LEASE_MANAGER_RESERVATION_SIZE", "200"))
+LEASE_MANAGER_RESERVATION_DURATION = float(os.getenv("LEASE_MANAGER_RESERVATION_DURATION", "300"))
+LEASE_MANAGER_FLUSH_INTERVAL = float(os.getenv("LEASE_MANAGER_FLUSH_INTERVAL", "1"))
+# sequential annotation cursors kept per process, a game set whose cursor
+# was evicted starts again from its first frames
+SEQUENTIAL_CURSOR_CACHE_MAX_SIZE = int(os.getenv("SEQUENTIAL_CURSOR_CACHE_MAX_SIZE", "1024"))
+SEQUENTIAL_CURSOR_CACHE_TTL = float(os.getenv("SEQUENTIAL_CURSOR_CACHE_TTL", "3600"))
+
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+POSTGRES_POOL_CHECKOUT_TIMEOUT = float(os.getenv("POSTGRES_POOL_CHECKOUT_TIMEOUT", "30"))
+# seconds a connection may sit idle before it is health checked on checkout,
+# 0 checks on every checkout
+POSTGRES_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("POSTGRES_POOL_HEALTH_CHECK_INTERVAL", "30"))
+
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "1024"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+JWT_CLAIMS_CACHE_MAX_SIZE = int(os.getenv("JWT_CLAIMS_CACHE_MAX_SIZE", "4096"))
+PRESIGNED_URL_CACHE_MAX_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_MAX_SIZE", "10000"))
+# a cached presigned url is reused while at least this fraction of its
+# lifetime is left
+PRESIGNED_URL_MIN_REMAINING_FRACTION = float(os.getenv("PRESIGNED_URL_MIN_REMAINING_FRACTION", "0.5"))
 
 
 def get_logger(name, level=logging.INFO):
@@ -49,6 +136,17 @@ _s3Client = boto3.client("s3")
 def get_s3Client():
     return _s3Client
 
+from ultitrackerapi.presign import PresignedUrlCache
+
+_presigner = PresignedUrlCache(
+    _s3Client,
+    max_size=PRESIGNED_URL_CACHE_MAX_SIZE,
+    min_remaining_fraction=PRESIGNED_URL_MIN_REMAINING_FRACTION,
+)
+
+def get_presigner():
+    return _presigner
+
 from ultitrackerapi.sql_backend import SQLClient
 
 _sqlClient = SQLClient(
@@ -57,15 +155,66 @@ _sqlClient = SQLClient(
     hostname=POSTGRES_HOSTNAME,
     port=POSTGRES_PORT,
     database=POSTGRES_DATABASE,
-    num_connection_retries=NUM_CONNECTION_RETRIES
+    num_connection_retries=NUM_CONNECTION_RETRIES,
+    pool_min_size=POSTGRES_POOL_MIN_SIZE,
+    pool_max_size=POSTGRES_POOL_MAX_SIZE,
+    pool_checkout_timeout=POSTGRES_POOL_CHECKOUT_TIMEOUT,
+    pool_health_check_interval=POSTGRES_POOL_HEALTH_CHECK_INTERVAL,
 )
 
 from ultitrackerapi.backend import InMemoryBackend
+from ultitrackerapi.cache import TTLCache
 from ultitrackerapi.sql_backend import SQLBackend
 from ultitrackerapi import models
 
+# shared by both backends so that invalidation through either one is seen
+# by the other
+_user_cache = TTLCache(max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL)
+
 # _backend = InMemoryBackend(game_db={}, user_db={})
-_backend = SQLBackend(_sqlClient)
+_sync_backend = SQLBackend(_sqlClient, user_cache=_user_cache)
+
+if ULTITRACKER_BACKEND == "async_sql":
+    from ultitrackerapi.async_sql_backend import AsyncSQLBackend, AsyncSQLClient
+
+    _backend = AsyncSQLBackend(
+        AsyncSQLClient(
+            username=POSTGRES_USERNAME,
+            password=POSTGRES_PASSWORD,
+            hostname=POSTGRES_HOSTNAME,
+            port=POSTGRES_PORT,
+            database=POSTGRES_DATABASE,
+            num_connection_retries=NUM_CONNECTION_RETRIES,
+            pool_min_size=POSTGRES_POOL_MIN_SIZE,
+            pool_max_size=POSTGRES_POOL_MAX_SIZE,
+            pool_checkout_timeout=POSTGRES_POOL_CHECKOUT_TIMEOUT,
+        ),
+        user_cache=_user_cache,
+    )
+elif ULTITRACKER_BACKEND == "sql":
+    _backend = _sync_backend
+else:
+    raise ValueError("Invalid ULTITRACKER_BACKEND: {}".format(ULTITRACKER_BACKEND))
 
 def get_backend():
     return _backend
+
+
+def get_sync_backend():
+    """Backend for scripts and worker processes that run outside of an
+    event loop, regardless of ULTITRACKER_BACKEND."""
+    return _sync_backend
+
+
+_lease_manager = None
+if ULTITRACKER_LEASE_MANAGER:
+    if ULTITRACKER_BACKEND != "sql":
+        raise ValueError("ULTITRACKER_LEASE_MANAGER requires ULTITRACKER_BACKEND=sql")
+
+    from ultitrackerapi.lease_manager import LeaseManager
+
+    _lease_manager = LeaseManager(_sqlClient)
+
+def get_lease_manager():
+    """The `lease_manager.LeaseManager` or None if it is disabled."""
+    return _lease_manager
@@ -1,9 +1,12 @@
+import random
+import threading
 import ultitrackerapi
 
 from enum import Enum
 from pydantic import BaseModel
 from typing import List
 from ultitrackerapi import get_logger, models, sql_backend
+from ultitrackerapi.cache import TTLCache
 
 
 logger = get_logger(__name__, "DEBUG")
@@ -25,6 +28,9 @@ class AnnotatorQueueParams(BaseModel):
     game_ids: List[str]
     annotation_type: models.AnnotationTable
     order_type: AnnotationOrderType
+    num_images: int = ultitrackerapi.NUM_IMAGES_FOR_ANNOTATION
+    # seconds until a lease expires
+    lease_duration: float = ultitrackerapi.ANNOTATION_EXPIRATION_DURATION
     # annotation_status: AnnotationStatusType
     # prediction_status: PredictionStatusType
 
@@ -45,86 +51,225 @@ class AnnotatorQueueParams(BaseModel):
 #     def __init__(self, client: sql_backend.SQLClient):
 #         self._client = client
 
-def get_next_n_images(
-    backend: sql_backend.SQLBackend, 
-    queue_params: AnnotatorQueueParams
-) -> models.ImgLocationListResponse:
+# Available images are the ones without a status for the table yet or
+# whose lease expired, leaving out frames marked as near duplicates at
+# ingest. Candidate rows are locked with SKIP LOCKED, so concurrent leases
+# pass over each other's images instead of waiting on them.
+CANDIDATES_COMMAND = """
+SELECT A.img_id, A.img_raw_path, A.frame_number
+FROM ultitracker.img_location A
+{join_camera_angle}
+LEFT JOIN ultitracker.annotation_status S
+    ON S.img_id = A.img_id
+    AND S.table_ref = %(table_ref)s::annotation_table
+WHERE 1=1
+    AND A.game_id = ANY(%(game_ids)s::text[])
+    AND NOT (A.img_metadata ? 'duplicate_of')
+    AND (
+        S.img_id IS NULL
+        OR (
+            S.status = 'sent'
+            AND S.lease_expiration <= NOW() AT TIME ZONE 'utc'
+        )
+    )
+    {range_condition}
+{order_by}
+LIMIT %(num_images)s
+FOR UPDATE OF A SKIP LOCKED
+"""
+
+
+# Sequential order continues after the last leased frame of this process,
+# a keyset scan of the (game_id, frame_number) index that wraps around to
+# the first frames when it runs off the end.
+SEQUENTIAL_CANDIDATES_COMMAND = """
+SELECT * FROM ({after_cursor}) after_cursor
+UNION ALL
+SELECT * FROM ({before_cursor}) before_cursor
+LIMIT %(num_images)s
+"""
+
+
+# Random order without sorting: every image has a random_key drawn when it
+# was inserted, a lease scans the (game_id, random_key) index from a random
+# start and wraps around to the lowest keys when it runs off the end.
+RANDOM_CANDIDATES_COMMAND = """
+SELECT * FROM ({after_start}) after_start
+UNION ALL
+SELECT * FROM ({before_start}) before_start
+LIMIT %(num_images)s
+"""
+
+
+# Marks the candidates as sent until `expiration_duration` from now. The
+# upsert only overwrites an expired lease, so an image leased concurrently
+# since the candidates were read is not returned and not handed out twice.
+LEASE_STATUS_COMMAND = """
+INSERT INTO ultitracker.annotation_status (img_id, table_ref, status, lease_expiration, updated_at)
+SELECT
+    img_id,
+    %(table_ref)s::annotation_table,
+    'sent'::annotation_action,
+    NOW() AT TIME ZONE 'utc' + make_interval(secs => %(expiration_duration)s),
+    NOW() AT TIME ZONE 'utc'
+FROM candidates
+ON CONFLICT (img_id, table_ref) DO UPDATE
+SET
+    status = EXCLUDED.status,
+    lease_expiration = EXCLUDED.lease_expiration,
+    updated_at = EXCLUDED.updated_at
+WHERE 1=1
+    AND annotation_status.status = 'sent'
+    AND annotation_status.lease_expiration <= EXCLUDED.updated_at
+RETURNING img_id, lease_expiration, updated_at
+"""
+
+
+# Leases images from the current annotation status instead of the
+# transaction history and records the lease in the history.
+NEXT_N_IMAGES_COMMAND = """
+WITH candidates AS (
+    {candidates}
+),
+leased AS (
+    {lease_status}
+),
+inserted_values AS (
+    INSERT INTO ultitracker.annotation_transaction (img_id, timestamp, table_ref, action)
+    SELECT img_id, updated_at, %(table_ref)s::annotation_table, 'sent'::annotation_action
+    FROM leased
+)
+SELECT A.img_id, B.img_raw_path, A.lease_expiration, B.frame_number
+FROM leased A
+JOIN candidates B ON A.img_id = B.img_id
+"""
+
+
+def candidates_command(queue_params: AnnotatorQueueParams) -> str:
+    join_camera_angle = (
+        "JOIN ultitracker.camera_angle C ON A.img_id = C.img_id AND C.is_valid"
+        if queue_params.annotation_type != models.AnnotationTable.camera_angle
+        else ""
+    )
+
+    if queue_params.order_type == AnnotationOrderType.sequential:
+        return SEQUENTIAL_CANDIDATES_COMMAND.format(
+            after_cursor=CANDIDATES_COMMAND.format(
+                join_camera_angle=join_camera_angle,
+                range_condition=(
+                    "AND (A.frame_number, A.img_id)"
+                    " > (%(after_frame_number)s, %(after_img_id)s)"
+                ),
+                order_by="ORDER BY A.frame_number, A.img_id",
+            ),
+            before_cursor=CANDIDATES_COMMAND.format(
+                join_camera_angle=join_camera_angle,
+                range_condition=(
+                    "AND (A.frame_number, A.img_id)"
+                    " <= (%(after_frame_number)s, %(after_img_id)s)"
+                ),
+                order_by="ORDER BY A.frame_number, A.img_id",
+            ),
+        )
+
+    return RANDOM_CANDIDATES_COMMAND.format(
+        after_start=CANDIDATES_COMMAND.format(
+            join_camera_angle=join_camera_angle,
+            range_condition="AND A.random_key >= %(random_start)s",
+            order_by="ORDER BY A.random_key",
+        ),
+        before_start=CANDIDATES_COMMAND.format(
+            join_camera_angle=join_camera_angle,
+            range_condition="AND A.random_key < %(random_start)s",
+            order_by="ORDER BY A.random_key",
+        ),
+    )
+
+
+# (frame_number, img_id) of the last image leased in sequential order, per
+# game set and annotation table. Kept per process: several processes each
+# walk the frames in order and skip over each other's leases. The game sets
+# come from the clients, so the cursors are bounded and expire when unused.
+FIRST_SEQUENTIAL_CURSOR = (-2 ** 31, "")
+_sequential_cursors = TTLCache(
+    max_size=ultitrackerapi.SEQUENTIAL_CURSOR_CACHE_MAX_SIZE,
+    ttl=ultitrackerapi.SEQUENTIAL_CURSOR_CACHE_TTL,
+)
+_sequential_cursors_lock = threading.Lock()
+
+
+def _sequential_cursor_key(queue_params: AnnotatorQueueParams):
+    return (
+        tuple(sorted(set(queue_params.game_ids))),
+        queue_params.annotation_type.name,
+    )
+
+
+def advance_sequential_cursor(queue_params: AnnotatorQueueParams, leased_keys):
+    """Moves the sequential cursor past the (frame_number, img_id) keys of
+    the images just leased."""
+    if queue_params.order_type != AnnotationOrderType.sequential or not leased_keys:
+        return
+
+    key = _sequential_cursor_key(queue_params)
+    with _sequential_cursors_lock:
+        cursor = _sequential_cursors.get(key, FIRST_SEQUENTIAL_CURSOR)
+        # keys at or before the cursor were read after wrapping around, the
+        # scan ended on the last of those
+        wrapped = [leased_key for leased_key in leased_keys if leased_key <= cursor]
+        _sequential_cursors.set(key, max(wrapped or leased_keys))
+
+
+def next_n_images_statement(queue_params: AnnotatorQueueParams):
+    """Returns the prepared statement name, command and parameters that
+    lease the next images for annotation.
+
+    There is one prepared statement per order type and camera angle join,
+    everything else is a parameter.
+    """
     # get all images that are
     #   1) Not annotated
     #   2) Not been sent out and not expired
-    available_images_query = """
-    WITH images_with_annotations AS (
-        SELECT DISTINCT img_id
-        FROM ultitracker.annotation_transaction
-        WHERE 1=1
-            AND action = 'submitted'
-            AND table_ref = '{table_ref}'
-    ),
-    images_with_camera_angle AS (
-        SELECT DISTINCT img_id
-        FROM ultitracker.camera_angle
-        WHERE 1=1
-            AND is_valid = true
-    ),
-    images_out_for_submission AS (
-        SELECT DISTINCT A.img_id
-        FROM ultitracker.annotation_transaction A
-        JOIN (
-            SELECT
-                img_id,
-                table_ref,
-                MAX(timestamp) AS max_timestamp
-            FROM 
-                ultitracker.annotation_transaction
-            GROUP BY img_id, table_ref
-        ) B ON A.img_id = B.img_id AND A.table_ref = B.table_ref
-        WHERE 1=1
-            AND A.timestamp = B.max_timestamp
-            AND A.action = 'sent'
-            AND A.timestamp + INTERVAL '{expiration_duration} SECONDS' > NOW() AT TIME ZONE 'utc'
-            AND B.table_ref = '{table_ref}'
-    ),
-    unavailable_images AS (
-        SELECT * FROM (
-            SELECT img_id FROM images_with_annotations
-            UNION
-            SELECT img_id FROM images_out_for_submission
-        ) A
-    ),
-    values_to_insert AS (
-        SELECT
-            A.img_id AS img_id,
-            NOW() AT TIME ZONE 'utc' AS timestamp,
-            '{table_ref}' AS table_ref,
-            'sent' AS action
-        FROM ultitracker.img_location A
-        {join_camera_angle}
-        LEFT JOIN unavailable_images B ON A.img_id = B.img_id
-        WHERE 1=1
-            AND B.img_id IS NULL
-            AND A.game_id IN {game_ids}
-        {order_by}
-        LIMIT {num_images}
-    ),
-    inserted_values AS (
-        INSERT INTO ultitracker.annotation_transaction
-        SELECT img_id, timestamp, CAST(table_ref AS annotation_table), CAST(action AS annotation_action)
-        FROM values_to_insert
+    join_camera_angle = (
+        queue_params.annotation_type.name
+        != models.AnnotationTable.camera_angle.name
     )
-    SELECT A.img_id, B.img_raw_path, NOW() AT TIME ZONE 'utc' + INTERVAL '{expiration_duration} SECONDS'
-    FROM values_to_insert A
-    JOIN ultitracker.img_location B ON A.img_id = B.img_id
-    """.format(
-        table_ref=queue_params.annotation_type.name,
-        expiration_duration=ultitrackerapi.ANNOTATION_EXPIRATION_DURATION,
-        num_images=ultitrackerapi.NUM_IMAGES_FOR_ANNOTATION,
-        join_camera_angle="JOIN images_with_camera_angle C ON A.img_id = C.img_id" if queue_params.annotation_type.name != models.AnnotationTable.camera_angle.name else "",
-        game_ids="(" + ", ".join(["'" + game_id + "'" for game_id in queue_params.game_ids]) + ")",
-        order_by="ORDER BY A.frame_number" if queue_params.order_type == AnnotationOrderType.sequential else "ORDER BY RANDOM()"
+
+    name = "next_n_images_{}{}".format(
+        queue_params.order_type.name,
+        "_with_camera_angle" if join_camera_angle else "",
+    )
+
+    command = NEXT_N_IMAGES_COMMAND.format(
+        candidates=candidates_command(queue_params),
+        lease_status=LEASE_STATUS_COMMAND,
     )
 
-    results = backend.client.execute(available_images_query)
+    params = {
+        "table_ref": queue_params.annotation_type.name,
+        "expiration_duration": float(queue_params.lease_duration),
+        "num_images": queue_params.num_images,
+        "game_ids": queue_params.game_ids,
+    }
 
+    if queue_params.order_type == AnnotationOrderType.random:
+        # random_key and the start are both uniform, so over the draws of
+        # the keys every available image is equally likely to come next
+        params["random_start"] = random.random()
+
+    elif queue_params.order_type == AnnotationOrderType.sequential:
+        with _sequential_cursors_lock:
+            after_frame_number, after_img_id = _sequential_cursors.get(
+                _sequential_cursor_key(queue_params), FIRST_SEQUENTIAL_CURSOR
+            )
+
+        params["after_frame_number"] = after_frame_number
+        params["after_img_id"] = after_img_id
+
+    return name, command, params
+
+
+def parse_next_n_images(results) -> models.ImgLocationListResponse:
     logger.debug("get_next_n_images result: {}".format(results))
 
     return models.ImgLocationListResponse(img_locations=[
@@ -134,4 +279,33 @@ def get_next_n_images(
             annotation_expiration_utc_time=result[2]
         )
         for result in results
-    ])
\ No newline at end of file
+    ])
+
+
+def get_next_n_images(
+    backend: sql_backend.SQLBackend, 
+    queue_params: AnnotatorQueueParams
+) -> models.ImgLocationListResponse:
+    results = backend.client.execute_prepared(
+        *next_n_images_statement(queue_params)
+    )
+    advance_sequential_cursor(
+        queue_params, [(result[3], result[0]) for result in results]
+    )
+
+    return parse_next_n_images(results)
+
+
+async def async_get_next_n_images(
+    backend,
+    queue_params: AnnotatorQueueParams
+) -> models.ImgLocationListResponse:
+    """`get_next_n_images` for an `async_sql_backend.AsyncSQLBackend`."""
+    results = await backend.client.execute_prepared(
+        *next_n_images_statement(queue_params)
+    )
+    advance_sequential_cursor(
+        queue_params, [(result[3], result[0]) for result in results]
+    )
+
+    return parse_next_n_images(results)
@@ -0,0 +1,403 @@
+import asyncio
+import asyncpg
+import json
+import time
+import uuid
+
+from typing import List, Union
+from ultitrackerapi import backend, cache, ingest_stages, models, sql_backend
+from ultitrackerapi import (
+    get_logger,
+    ANNOTATION_STREAM_BATCH_SIZE,
+    GAME_LIST_DEFAULT_LIMIT,
+    NUM_CONNECTION_RETRIES,
+    POSTGRES_POOL_CHECKOUT_TIMEOUT,
+    POSTGRES_POOL_MAX_SIZE,
+    POSTGRES_POOL_MIN_SIZE,
+    POSTGRES_USERNAME,
+    POSTGRES_PASSWORD,
+    POSTGRES_HOSTNAME,
+    POSTGRES_PORT,
+    POSTGRES_DATABASE,
+    QUERY_IMAGES_DEFAULT_LIMIT,
+)
+
+# get logger
+logger = get_logger(__name__, level="DEBUG")
+
+
+async def _init_connection(conn):
+    # decode to the same python types psycopg2 hands back so the
+    # sql_backend parsers work unchanged
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=json.dumps,
+        decoder=json.loads,
+        schema="pg_catalog",
+    )
+    for type_name in ["box", "lseg"]:
+        await conn.set_type_codec(
+            type_name,
+            encoder=str,
+            decoder=str,
+            schema="pg_catalog",
+            format="text",
+        )
+
+
+def _to_asyncpg_args(command: str, params: dict = None):
+    positional_command, names = sql_backend.to_positional(command)
+    params = params or {}
+
+    return [positional_command] + [params[name] for name in names]
+
+
+class AsyncSQLClient(object):
+    """asyncpg counterpart of `sql_backend.SQLClient`.
+
+    The pool has to be created from inside the running event loop, so
+    `_establish_connection` is awaited on application startup.
+    """
+
+    def __init__(
+        self,
+        username=POSTGRES_USERNAME,
+        password=POSTGRES_PASSWORD,
+        hostname=POSTGRES_HOSTNAME,
+        port=POSTGRES_PORT,
+        database=POSTGRES_DATABASE,
+        num_connection_retries=NUM_CONNECTION_RETRIES,
+        pool_min_size=POSTGRES_POOL_MIN_SIZE,
+        pool_max_size=POSTGRES_POOL_MAX_SIZE,
+        pool_checkout_timeout=POSTGRES_POOL_CHECKOUT_TIMEOUT,
+    ):
+        self._username = username
+        self._password = password
+        self._hostname = hostname
+        self._port = port
+        self._database = database
+        self._num_connection_retries = num_connection_retries
+        self._pool_min_size = pool_min_size
+        self._pool_max_size = pool_max_size
+        self._pool_checkout_timeout = pool_checkout_timeout
+        self._pool = None
+
+    async def _establish_connection(self):
+        if self._pool is not None:
+            return
+
+        for i in range(self._num_connection_retries):
+            try:
+                self._pool = await asyncpg.create_pool(
+                    user=self._username,
+                    password=self._password,
+                    host=self._hostname,
+                    port=self._port,
+                    database=self._database,
+                    min_size=self._pool_min_size,
+                    max_size=self._pool_max_size,
+                    init=_init_connection,
+                )
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.error("Couldn't connect to database")
+                if i == (self._num_connection_retries - 1):
+                    raise e
+                else:
+                    await asyncio.sleep(1)
+
+    async def close_connection(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def pool_stats(self) -> dict:
+        if self._pool is None:
+            return {}
+
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        return {
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+            "open": size,
+            "in_use": size - idle,
+            "idle": idle,
+        }
+
+    async def execute(self, commands, params: dict = None):
+        """Same contract as `sql_backend.SQLClient.execute`."""
+        if self._pool is None:
+            await self._establish_connection()
+
+        if isinstance(commands, str):
+            commands = [(commands, params)]
+
+        async with self._pool.acquire(timeout=self._pool_checkout_timeout) as conn:
+            try:
+                result = None
+                async with conn.transaction():
+                    for command in commands:
+                        if isinstance(command, str):
+                            command = (command, None)
+
+                        result = await conn.fetch(*_to_asyncpg_args(*command))
+
+                return result
+
+            except asyncpg.PostgresError as error:
+                logger.error(
+                    "Could not complete the transaction: {}".format(commands)
+                )
+                raise error
+
+    async def stream(self, command: str, params: dict = None, batch_size: int = 1000):
+        """Same contract as `sql_backend.SQLClient.stream`."""
+        if self._pool is None:
+            await self._establish_connection()
+
+        async with self._pool.acquire(timeout=self._pool_checkout_timeout) as conn:
+            # asyncpg cursors only live inside a transaction
+            async with conn.transaction():
+                cursor = await conn.cursor(*_to_asyncpg_args(command, params))
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        break
+
+                    yield rows
+
+    async def execute_prepared(self, name: str, command: str, params: dict = None):
+        """asyncpg already prepares every statement once per connection and
+        caches it, so this only exists to match `SQLClient`."""
+        return await self.execute(command, params)
+
+
+class AsyncSQLBackend(backend.Backend):
+    """Same interface as `sql_backend.SQLBackend` with awaitable methods."""
+
+    def __init__(self, client: AsyncSQLClient, user_cache: cache.TTLCache = None):
+        self.client = client
+        self.user_cache = user_cache if user_cache is not None else cache.TTLCache()
+
+    async def get_user(
+        self, username: str, include_password: bool = False
+    ) -> models.UserInDB:
+        row = self.user_cache.get(username)
+        if row is None:
+            result = await self.client.execute_prepared(
+                "get_user", sql_backend.GET_USER_COMMAND, {"username": username}
+            )
+            logger.debug("AsyncSQLBackend.get_user result: {}".format(result))
+
+            row = sql_backend.parse_user_row(result, username)
+            if row is not None:
+                self.user_cache.set(username, row)
+
+        return sql_backend.user_from_row(row, include_password=include_password)
+
+    async def add_user(self, user: models.User, salted_password: str) -> bool:
+        if await self.get_user(user.username):
+            return False
+
+        user.disabled = False
+        user_id = str(uuid.uuid4())
+
+        result = await self.client.execute(
+            *sql_backend.add_user_command(user, user_id, salted_password)
+        )
+        logger.debug("AsyncSQLBackend.add_user result: {}".format(result))
+        self.user_cache.invalidate(user.username)
+
+        return True
+
+    async def disable_user(self, username: str):
+        await self.client.execute(
+            sql_backend.DISABLE_USER_COMMAND, {"username": username}
+        )
+        self.user_cache.invalidate(username)
+
+    async def username_exists(self, username: str) -> bool:
+        return (await self.get_user(username)) is not None
+
+    async def get_game(
+        self, game_id: str, user: models.User
+    ) -> models.GameResponse:
+        user_in_db = await self.get_user(user.username)
+        result = await self.client.execute_prepared(
+            "get_game",
+            sql_backend.GET_GAME_COMMAND,
+            {"game_id": game_id, "user_id": user_in_db.user_id},
+        )
+        logger.debug("AsyncSQLBackend.get_game result: {}".format(result))
+
+        return sql_backend.parse_game(result, game_id)
+
+    async def get_game_list(
+        self,
+        user: models.User,
+        limit: int = GAME_LIST_DEFAULT_LIMIT,
+        cursor: str = None,
+        order_by: models.GameListOrder = models.GameListOrder.game_id,
+        filters: dict = None,
+    ) -> models.GameListResponse:
+        user_in_db = await self.get_user(user.username)
+        result = await self.client.execute_prepared(
+            *sql_backend.get_game_list_statement(
+                user_in_db.user_id,
+                limit=limit,
+                cursor=cursor,
+                order_by=order_by,
+                filters=filters,
+            )
+        )
+        logger.debug("AsyncSQLBackend.get_game_list result: {}".format(result))
+
+        return sql_backend.parse_game_list(result, limit=limit, order_by=order_by)
+
+    async def add_game(
+        self,
+        user: models.User,
+        game_id: str,
+        authorized_users: List[str] = [],
+        data: dict = {},
+        thumbnail_key: str = "",
+        video_key: str = "",
+    ) -> bool:
+        user_in_db = await self.get_user(user.username)
+        result = await self.client.execute(
+            sql_backend.add_game_commands(
+                game_id,
+                user_in_db.user_id,
+                data,
+                thumbnail_key,
+                video_key,
+            )
+        )
+
+        if result:
+            return result
+        else:
+            return None
+
+    async def update_game_data(self, game_id: str, data: dict):
+        await self.client.execute(
+            sql_backend.UPDATE_GAME_DATA_COMMAND,
+            {"game_id": game_id, "data": data},
+        )
+
+    async def find_ingested_game(self, content_sha256: str) -> dict:
+        return sql_backend.parse_ingested_game(
+            await self.client.execute(
+                *sql_backend.find_ingested_game_command(content_sha256)
+            )
+        )
+
+    async def add_deduplicated_game(
+        self,
+        user: models.User,
+        game_id: str,
+        data: dict,
+        source_game: dict,
+    ):
+        user_in_db = await self.get_user(user.username)
+        await self.client.execute(
+            sql_backend.add_deduplicated_game_commands(
+                game_id,
+                user_in_db.user_id,
+                data,
+                source_game,
+            )
+        )
+
+    async def get_processing_status(self, game_id: str) -> models.ProcessingStatusResponse:
+        params = {"game_id": game_id}
+
+        return ingest_stages.parse_processing_status(
+            game_id,
+            await self.client.execute(ingest_stages.GET_PROCESSING_STATUS_COMMAND, params),
+            await self.client.execute(ingest_stages.GET_LATEST_JOB_COMMAND, params),
+        )
+
+    async def get_processing_summary(self, days: int) -> models.ProcessingSummaryResponse:
+        return ingest_stages.parse_processing_summary(
+            await self.client.execute(
+                ingest_stages.GET_PROCESSING_SUMMARY_COMMAND, {"days": days}
+            )
+        )
+
+    async def insert_annotation(
+        self,
+        user: models.User,
+        img_id: str,
+        annotation_table: models.AnnotationTable,
+        annotation_data: Union[models.AnnotationPlayerBboxes, models.AnnotationFieldLines, models.AnnotationCameraAngle]
+    ) -> bool:
+        return await self.client.execute_prepared(
+            *sql_backend.insert_annotation_statement(
+                img_id, annotation_table, annotation_data
+            )
+        )
+
+    async def insert_annotation_batch(
+        self,
+        user: models.User,
+        items: List[models.AnnotationBatchItem],
+    ) -> models.AnnotationBatchResponse:
+        start_time = time.perf_counter()
+        commands, errors = sql_backend.insert_annotation_batch_commands(items)
+        found_img_ids = await self.client.execute(commands) if commands else []
+
+        return sql_backend.parse_annotation_batch(
+            items, errors, found_img_ids, time.perf_counter() - start_time
+        )
+
+    async def get_annotations(self, table: models.AnnotationTable):
+        logger.debug("AsyncSQLBackend.get_annotations: table: {}".format(table))
+
+        result = await self.client.execute(
+            sql_backend.get_annotations_command(table)
+        )
+
+        return [tuple(row) for row in result]
+
+    async def stream_annotations(
+        self,
+        table: models.AnnotationTable,
+        batch_size: int = ANNOTATION_STREAM_BATCH_SIZE,
+    ):
+        command, columns = sql_backend.stream_annotations_command(table)
+
+        async for rows in self.client.stream(command, batch_size=batch_size):
+            yield sql_backend.rows_to_ndjson(columns, rows)
+
+    async def get_image_path(self, img_id: str):
+        result = await self.client.execute(
+            *sql_backend.get_image_path_command(img_id)
+        )
+
+        return result[0][0]
+
+    async def query_images(
+        self,
+        query: dict = None,
+        img_query: dict = None,
+        game_query: dict = None,
+        limit: int = QUERY_IMAGES_DEFAULT_LIMIT,
+        cursor: str = None,
+        count_only: bool = False,
+    ) -> models.ImageQueryResponse:
+        result = await self.client.execute(
+            *sql_backend.query_images_command(
+                query,
+                img_query=img_query,
+                game_query=game_query,
+                limit=limit,
+                cursor=cursor,
+                count_only=count_only,
+            )
+        )
+
+        return sql_backend.parse_query_images(
+            result, limit=limit, count_only=count_only
+        )
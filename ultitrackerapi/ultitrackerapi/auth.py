@@ -1,5 +1,6 @@
 """Schemas and functions for handling authentication."""
 import bleach
+import hashlib
 
 from authlib.jose import jwt
 from authlib.jose.errors import DecodeError, ExpiredTokenError
@@ -8,9 +9,11 @@ from fastapi import Depends, HTTPException, Cookie
 from fastapi.security import OAuth2PasswordBearer
 from passlib.hash import pbkdf2_sha256
 from starlette.requests import Request
-from starlette.status import HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 
-from ultitrackerapi import ULTITRACKER_AUTH_SECRET_KEY, ULTITRACKER_AUTH_TOKEN_EXP_LENGTH, ULTITRACKER_COOKIE_KEY, ULTITRACKER_URL, models, get_backend, get_logger
+from ultitrackerapi import JWT_CLAIMS_CACHE_MAX_SIZE, ULTITRACKER_ADMIN_USERNAMES, ULTITRACKER_AUTH_LOG_CLAIMS, ULTITRACKER_AUTH_SECRET_KEY, ULTITRACKER_AUTH_TOKEN_EXP_LENGTH, ULTITRACKER_COOKIE_KEY, ULTITRACKER_URL, models, get_backend, get_logger
+from ultitrackerapi.backend import call_backend
+from ultitrackerapi.cache import TTLCache
 
 
 EXP_LENGTH = timedelta(seconds=ULTITRACKER_AUTH_TOKEN_EXP_LENGTH)
@@ -19,6 +22,12 @@ LOGGER = get_logger(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 backend_instance = get_backend()
 
+# validated claims keyed by the token digest, each entry lives until the
+# token's exp
+claims_cache = TTLCache(
+    max_size=JWT_CLAIMS_CACHE_MAX_SIZE, ttl=EXP_LENGTH.total_seconds()
+)
+
 
 def verify_password(password, salted_password):
     return pbkdf2_sha256.verify(password, salted_password)
@@ -53,6 +62,37 @@ def construct_jwt(username: str) -> str:
     return encoded_unicode_token
 
 
+def decode_token(token: str) -> dict:
+    """Decodes and validates a token, reusing the claims of a token that was
+    already validated.
+
+    Raises the authlib errors of `jwt.decode` and `claims.validate`.
+    """
+    now = datetime.utcnow().timestamp()
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+
+    claims = claims_cache.get(token_digest)
+    if claims is not None:
+        # the cache entry can outlive exp by clock drift, never trust it
+        # past that point
+        if claims["exp"] <= now:
+            claims_cache.invalidate(token_digest)
+            raise ExpiredTokenError()
+
+        return claims
+
+    claims = jwt.decode(token, ULTITRACKER_AUTH_SECRET_KEY)
+    claims.validate(now=now)
+
+    if ULTITRACKER_AUTH_LOG_CLAIMS:
+        LOGGER.info(f"claims: {claims}")
+
+    if claims.get("exp") is not None:
+        claims_cache.set(token_digest, claims, ttl=claims["exp"] - now)
+
+    return claims
+
+
 async def get_user_from_cookie(request: Request):
     token = request.cookies.get(ULTITRACKER_COOKIE_KEY)
     credentials_exception = HTTPException(
@@ -70,13 +110,11 @@ async def get_user_from_cookie(request: Request):
         raise credentials_exception
     
     try:
-        claims = jwt.decode(token, ULTITRACKER_AUTH_SECRET_KEY)
         try:
-            claims.validate(now=datetime.utcnow().timestamp())
+            claims = decode_token(token)
         except ExpiredTokenError:
             raise timeout_exception
 
-        LOGGER.info(f"claims: {claims}")
         username: str = claims.get("sub")
 
         if username is None:
@@ -87,15 +125,33 @@ async def get_user_from_cookie(request: Request):
     except DecodeError:
         raise credentials_exception
 
-    user = backend_instance.get_user(username=token_data.username)
+    user = await call_backend(
+        backend_instance.get_user, username=token_data.username
+    )
 
-    if user is None:
+    if user is None or user.disabled:
         raise credentials_exception
     return user
 
 
-def authenticate_user(username: str, password: str) -> models.UserInDBwPass:
-    user = backend_instance.get_user(username=username, include_password=True)
+async def get_admin_user_from_cookie(
+    user: models.User = Depends(get_user_from_cookie),
+):
+    """Like `get_user_from_cookie`, but only lets through the users listed
+    in ULTITRACKER_ADMIN_USERNAMES."""
+    if user.username not in ULTITRACKER_ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+
+    return user
+
+
+async def authenticate_user(username: str, password: str) -> models.UserInDBwPass:
+    user = await call_backend(
+        backend_instance.get_user, username=username, include_password=True
+    )
     if not user:
         return
 
@@ -1,11 +1,26 @@
 # import psycopg2 as psql
 # import time
 
+import inspect
+
 from abc import ABC
+from starlette.concurrency import run_in_threadpool
 from typing import List
 from ultitrackerapi import models
 
 
+async def call_backend(method, *args, **kwargs):
+    """Calls a backend method from async code without blocking the event loop.
+
+    Methods of async backends are awaited directly, methods of synchronous
+    backends are run in the threadpool.
+    """
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+
+    return await run_in_threadpool(method, *args, **kwargs)
+
+
 class Backend(ABC):
     def get_user(self, username: str) -> models.User:
         pass
@@ -16,13 +31,23 @@ class Backend(ABC):
     def username_exists(self, username: str) -> bool:
         pass
 
+    def disable_user(self, username: str):
+        pass
+
     def authenticate_user(self, username: str, password: str) -> models.User:
         pass
 
     def get_game(self, game_id: str, user: models.User) -> models.GameResponse:
         pass
 
-    def get_game_list(self, user: models.User) -> models.GameListResponse:
+    def get_game_list(
+        self,
+        user: models.User,
+        limit: int = None,
+        cursor: str = None,
+        order_by: models.GameListOrder = models.GameListOrder.game_id,
+        filters: dict = None,
+    ) -> models.GameListResponse:
         pass
 
     def add_game(
@@ -34,6 +59,27 @@ class Backend(ABC):
     ) -> bool:
         pass
 
+    def update_game_data(self, game_id: str, data: dict):
+        pass
+
+    def find_ingested_game(self, content_sha256: str) -> dict:
+        pass
+
+    def add_deduplicated_game(
+        self,
+        user: models.User,
+        game_id: str,
+        data: dict,
+        source_game: dict,
+    ):
+        pass
+
+    def get_processing_status(self, game_id: str) -> models.ProcessingStatusResponse:
+        pass
+
+    def get_processing_summary(self, days: int) -> models.ProcessingSummaryResponse:
+        pass
+
     def insert_annotation(
         self,
         user: models.User,
@@ -43,6 +89,13 @@ class Backend(ABC):
     ) -> bool:
         pass
 
+    def insert_annotation_batch(
+        self,
+        user: models.User,
+        items: List[models.AnnotationBatchItem],
+    ) -> models.AnnotationBatchResponse:
+        pass
+
 
 class InMemoryBackend(Backend):
     def __init__(self, game_db: dict = {}, user_db: dict = {}):
@@ -69,6 +122,10 @@ class InMemoryBackend(Backend):
     def username_exists(self, username: str) -> bool:
         return username in self._user_db
 
+    def disable_user(self, username: str):
+        if username in self._user_db:
+            self._user_db[username].disabled = True
+
     def get_game(self, game_id: str, user: models.User) -> models.GameResponse:
         self.initialize_user(user)
 
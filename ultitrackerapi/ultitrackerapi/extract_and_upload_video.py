@@ -1,65 +1,369 @@
 import argparse
-import boto3
+import collections
+import contextlib
 import datetime
-import json
 import os
 import posixpath
-import re
-import shutil
 import tempfile
+import time
 import uuid
 
 from concurrent import futures
-from multiprocessing import Pool
-from ultitrackerapi import get_backend, get_logger, get_s3Client, video    
+from ultitrackerapi import CHUNK_UPLOAD_CONCURRENCY, FRAME_DEDUP_HAMMING_THRESHOLD, FRAME_DEDUP_MODE, FRAME_EXTRACTION_FPS, IMG_LOCATION_COPY_BATCH_SIZE, SEGMENT_LIST_POLL_INTERVAL, frame_extraction, get_sync_backend, get_logger, get_s3Client, ingest_stages, sql_models, video
+from ultitrackerapi.ingest_stages import IngestStage
 
-backend_instance = get_backend()
+backend_instance = get_sync_backend()
 logger = get_logger(__name__, level="DEBUG")
 s3Client = get_s3Client()
 
 
 def update_game_video_length(game_id, video_length):
-    command = """
-    UPDATE ultitracker.game_metadata
-    SET data = jsonb_set(data, '{{length}}', '"{video_length}"', true)
-    WHERE game_id = '{game_id}'
-    """.format(
-        video_length=video_length,
-        game_id=game_id
-    )
-    backend_instance.client.execute(command)
+    backend_instance.update_game_data(game_id, {"length": video_length})
+
+
+def parse_frame_key(key):
+    """Returns the chunk name and the 1 based frame index of a frame key
+    like .../frames/chunk_003/frame_000012.png"""
+    frame_index = int(posixpath.splitext(posixpath.basename(key))[0].split("_")[1])
+    chunk_name = posixpath.basename(posixpath.dirname(key))
+    return chunk_name, frame_index
+
+
+def get_video_timestamp(key, chunk_start_times, fps=FRAME_EXTRACTION_FPS):
+    """Seconds into the full video of the frame at `key`, given the start
+    time of every chunk by chunk name."""
+    chunk_name, frame_index = parse_frame_key(key)
+    return chunk_start_times[chunk_name] + (frame_index - 1) / fps
+
 
+def get_frame_number(key, chunk_start_times, fps=FRAME_EXTRACTION_FPS):
+    """Global index of the frame at `key` among the frames extracted from
+    the full video at `fps`."""
+    return int(round(get_video_timestamp(key, chunk_start_times, fps) * fps))
 
-def get_frame_number(key, chunk_multiplier=60):
-    frame_number = int(posixpath.splitext(posixpath.basename(key))[0].split("_")[1])
-    chunk_number = int(posixpath.basename(posixpath.dirname(key)).split("_")[1])
-    return chunk_number * chunk_multiplier + frame_number
 
+IMG_LOCATION_COPY_COLUMNS = [
+    "img_id",
+    "img_raw_path",
+    "img_type",
+    "img_metadata",
+    "game_id",
+    "frame_number",
+]
 
-def insert_images(
-    img_raw_paths, 
-    img_types, 
-    img_metadatas, 
-    game_id, 
+
+# img_raw_path of the frames of a game that are already inserted
+EXISTING_IMG_RAW_PATHS_COMMAND = """
+SELECT img_raw_path
+FROM {img_location_name}
+WHERE game_id = %(game_id)s
+""".format(img_location_name=sql_models.TableImgLocation.full_name)
+
+
+def frame_img_id(game_id, img_raw_path):
+    """The img_id of a frame is derived from its game and path, so every
+    attempt at ingesting a game gives a frame the same img_id."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "{}#{}".format(img_raw_path, game_id)))
+
+
+def img_location_rows(
+    img_raw_paths,
+    img_types,
+    img_metadatas,
+    game_id,
     frame_numbers
 ):
-    command = """
-    INSERT INTO ultitracker.img_location (img_id, img_raw_path, img_type, img_metadata, game_id, frame_number) VALUES
+    for img_raw_path, img_type, img_metadata, frame_number in zip(img_raw_paths, img_types, img_metadatas, frame_numbers):
+        yield (
+            frame_img_id(game_id, img_raw_path),
+            img_raw_path,
+            img_type,
+            img_metadata,
+            game_id,
+            frame_number,
+        )
+
+
+class ImgLocationWriter(object):
+    """Buffers img_location rows from several frame extraction responses and
+    writes them with COPY once `batch_size` rows are buffered, so memory
+    stays bounded however long the game is.
+
+    COPY cannot skip conflicting rows, so rows whose img_raw_path is in
+    `existing_img_raw_paths` are left out. A retried ingestion passes the
+    frames an earlier attempt inserted and kept.
     """
 
-    for i, (img_raw_path, img_type, img_metadata, frame_number) in enumerate(zip(img_raw_paths, img_types, img_metadatas, frame_numbers)):
-        command += """('{img_id}', '{img_raw_path}', '{img_type}', '{img_metadata}', '{game_id}', {frame_number}){include_comma}
-        """.format(
-            img_id=uuid.uuid4(),
-            img_raw_path=img_raw_path,
-            img_type=img_type,
-            img_metadata=json.dumps(img_metadata),
-            game_id=game_id,
-            frame_number=frame_number,
-            include_comma="," if i < (len(img_raw_paths) - 1) else ""
+    _img_raw_path_index = IMG_LOCATION_COPY_COLUMNS.index("img_raw_path")
+
+    def __init__(self, client, batch_size=IMG_LOCATION_COPY_BATCH_SIZE, progress=None, existing_img_raw_paths=()):
+        self._client = client
+        self._batch_size = batch_size
+        self._rows = []
+        self._progress = progress
+        self._existing_img_raw_paths = set(existing_img_raw_paths)
+        self.num_written = 0
+        self.num_skipped = 0
+
+    def add(self, rows):
+        for row in rows:
+            if row[self._img_raw_path_index] in self._existing_img_raw_paths:
+                self.num_skipped += 1
+                continue
+
+            self._rows.append(row)
+            if len(self._rows) >= self._batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        rows, self._rows = self._rows, []
+        num_written = self._client.copy_rows(
+            sql_models.TableImgLocation.full_name,
+            IMG_LOCATION_COPY_COLUMNS,
+            rows,
         )
-    
-    backend_instance.client.execute(command)
+        self.num_written += num_written
+        if self._progress is not None:
+            self._progress.add_frames(num_written)
+        logger.debug("ImgLocationWriter: {} rows written".format(self.num_written))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def frame_img_metadata(bucket, frame, chunk_start_times):
+    img_metadata = {
+        "bucket": bucket,
+        "video_timestamp": get_video_timestamp(frame["key"], chunk_start_times),
+    }
+    if "phash" in frame:
+        img_metadata["phash"] = frame["phash"]
+    # the annotator queue skips frames marked as near duplicates
+    if "duplicate_of" in frame:
+        img_metadata["duplicate_of"] = "s3://" + posixpath.join(frame["bucket"], frame["duplicate_of"])
+
+    return img_metadata
+
+
+def stop_process(process):
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+class ChunkPipeline(object):
+    """Streams the chunks of a video through upload, frame extraction and
+    insertion while ffmpeg is still cutting the next chunks.
+
+    A chunk is uploaded as soon as ffmpeg added it to the segment list and
+    its frames are extracted as soon as it is uploaded. With `upload_video`
+    the original video is uploaded alongside, the video workers get it
+    from S3 where it is already stored at `video_key`. At most `max_uploads` uploads are running or
+    waiting for extraction and at most the extractor's `max_concurrency`
+    chunks are extracted at a time, so a slow stage holds back the stages
+    before it instead of piling up work behind it. Ingestion then takes
+    about as long as its slowest stage rather than the sum of all of them.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        video_filename,
+        video_key,
+        game_id,
+        video_height_width,
+        chunk_size=60,
+        max_uploads=CHUNK_UPLOAD_CONCURRENCY,
+        poll_interval=SEGMENT_LIST_POLL_INTERVAL,
+        upload_video=True,
+    ):
+        self._bucket = bucket
+        self._video_filename = video_filename
+        self._video_key = video_key
+        self._game_id = game_id
+        self._video_height_width = video_height_width
+        self._chunk_size = chunk_size
+        self._max_uploads = max_uploads
+        self._poll_interval = poll_interval
+        self._upload_video = upload_video
+
+        # chunk name -> start time in seconds
+        self.chunk_start_times = {}
+        self.num_dropped = 0
+
+    def _chunk_job(self, chunked_video_dir, chunk_filename):
+        return {
+            "s3_bucket_path": self._bucket,
+            "s3_video_path": posixpath.join(posixpath.dirname(self._video_key), "chunks", chunk_filename),
+            "s3_output_frames_path": posixpath.join(posixpath.dirname(self._video_key), "frames", posixpath.splitext(chunk_filename)[0]),
+            "video_metadata": self._video_height_width,
+            "fps": FRAME_EXTRACTION_FPS,
+            "local_video_path": os.path.join(chunked_video_dir, chunk_filename),
+            "dedup_mode": FRAME_DEDUP_MODE,
+            "dedup_threshold": FRAME_DEDUP_HAMMING_THRESHOLD,
+        }
+
+    def _upload(self, filename, key, progress):
+        with progress.work():
+            s3Client.upload_file(filename, self._bucket, key)
+        progress.add_bytes(os.path.getsize(filename))
+
+    def _insert(self, img_location_writer, extraction_response, extract_progress):
+        extract_progress.add_frames(len(extraction_response["frames"]))
+
+        raw_paths = ["s3://" + posixpath.join(frame["bucket"], frame["key"]) for frame in extraction_response["frames"]]
+
+        img_types = ["png" for frame in extraction_response["frames"]]
+        metadatas = [
+            frame_img_metadata(self._bucket, frame, self.chunk_start_times)
+            for frame in extraction_response["frames"]
+        ]
+        self.num_dropped += extraction_response.get("num_dropped", 0)
+
+        frame_numbers = [
+            get_frame_number(frame["key"], self.chunk_start_times)
+            for frame in extraction_response["frames"]
+        ]
+
+        img_location_writer.add(img_location_rows(
+            raw_paths,
+            img_types,
+            metadatas,
+            self._game_id,
+            frame_numbers
+        ))
+
+    def run(self, chunked_video_dir, segment_list_filename):
+        client = backend_instance.client
+
+        with contextlib.ExitStack() as pipeline:
+            # each stage is recorded as finished once its last piece of work
+            # is done, a failure marks the stages still running as failed.
+            # The stages all start here, so each marks its pieces of work for
+            # its busy time to tell which one holds the pipeline back
+            stages = {}
+            progress = {}
+            for stage in [IngestStage.upload, IngestStage.chunk, IngestStage.extract, IngestStage.insert]:
+                stages[stage] = pipeline.enter_context(contextlib.ExitStack())
+                progress[stage] = stages[stage].enter_context(
+                    ingest_stages.track_stage(client, self._game_id, stage)
+                )
+
+            upload_executor = pipeline.enter_context(futures.ThreadPoolExecutor(self._max_uploads))
+            frame_extractor = pipeline.enter_context(frame_extraction.get_frame_extractor())
+            # frames kept from an earlier attempt at this game
+            existing_img_raw_paths = [
+                img_raw_path for img_raw_path, in client.execute(
+                    EXISTING_IMG_RAW_PATHS_COMMAND, {"game_id": self._game_id}
+                ) or []
+            ]
+            img_location_writer = pipeline.enter_context(ImgLocationWriter(
+                client,
+                progress=progress[IngestStage.insert],
+                existing_img_raw_paths=existing_img_raw_paths,
+            ))
+
+            logger.debug("ChunkPipeline: Chunking video")
+            progress[IngestStage.chunk].start_work()
+            # upload future -> chunk job, None for the original video
+            uploads = {}
+            if self._upload_video:
+                uploads[upload_executor.submit(
+                    self._upload, self._video_filename, self._video_key, progress[IngestStage.upload]
+                )] = None
+            process = video.start_chunk_video(
+                self._video_filename,
+                chunked_video_dir,
+                chunk_size=self._chunk_size,
+                segment_list_filename=segment_list_filename,
+            )
+            pipeline.callback(stop_process, process)
+            watcher = video.SegmentListWatcher(segment_list_filename)
+
+            chunking = True
+            pending_chunks = collections.deque()
+            uploaded_jobs = collections.deque()
+            extractions = set()
+
+            while chunking or pending_chunks or uploads or uploaded_jobs or extractions:
+                if chunking:
+                    finished = process.poll() is not None
+                    # read after polling the process, so the chunks written
+                    # right before it exited are not missed
+                    for chunk_filename, start, _ in watcher.poll():
+                        self.chunk_start_times[posixpath.splitext(chunk_filename)[0]] = start
+                        progress[IngestStage.chunk].add_bytes(
+                            os.path.getsize(os.path.join(chunked_video_dir, chunk_filename))
+                        )
+                        pending_chunks.append(chunk_filename)
+
+                    if finished:
+                        if process.returncode:
+                            raise ValueError("ffmpeg", process.returncode)
+
+                        chunking = False
+                        progress[IngestStage.chunk].finish_work()
+                        stages[IngestStage.chunk].close()
+                        logger.debug("ChunkPipeline: Finished chunking video into {} chunks".format(
+                            len(self.chunk_start_times)
+                        ))
+
+                while pending_chunks and len(uploads) + len(uploaded_jobs) < self._max_uploads:
+                    job = self._chunk_job(chunked_video_dir, pending_chunks.popleft())
+                    uploads[upload_executor.submit(
+                        self._upload, job["local_video_path"], job["s3_video_path"], progress[IngestStage.upload]
+                    )] = job
+
+                while uploaded_jobs and len(extractions) < frame_extractor.max_concurrency:
+                    progress[IngestStage.extract].start_work()
+                    extraction = frame_extractor.submit(uploaded_jobs.popleft())
+                    extraction.add_done_callback(lambda _: progress[IngestStage.extract].finish_work())
+                    extractions.add(extraction)
+
+                in_flight = list(uploads) + list(extractions)
+                if not in_flight:
+                    time.sleep(self._poll_interval)
+                    continue
+
+                # wakes up to look for new chunks while ffmpeg is running
+                done, _ = futures.wait(
+                    in_flight,
+                    timeout=self._poll_interval if chunking else None,
+                    return_when=futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    if future in uploads:
+                        job = uploads.pop(future)
+                        future.result()
+                        if job is not None:
+                            uploaded_jobs.append(job)
+                    else:
+                        extractions.remove(future)
+                        with progress[IngestStage.insert].work():
+                            self._insert(img_location_writer, future.result(), progress[IngestStage.extract])
+
+                if not chunking and not pending_chunks and not uploads:
+                    stages[IngestStage.upload].close()
+
+            stages[IngestStage.upload].close()
+            stages[IngestStage.extract].close()
+            logger.debug("ChunkPipeline: Received all frame extraction responses, {} near duplicate frames dropped".format(
+                self.num_dropped
+            ))
+
+            with progress[IngestStage.insert].work():
+                img_location_writer.flush()
+            stages[IngestStage.insert].close()
+            logger.debug("ChunkPipeline: Finished inserting image metadata, {} frames were already inserted".format(
+                img_location_writer.num_skipped
+            ))
 
 
 def extract_and_upload_video(
@@ -68,118 +372,62 @@ def extract_and_upload_video(
     thumbnail_filename, 
     video_key,
     thumbnail_key,
-    game_id
+    game_id,
+    upload_video=True,
 ):
-    logger.debug("extract_and_upload_video: Getting video length")
-    video_length_seconds = int(video.get_video_duration(video_filename))
-    video_length = str(datetime.timedelta(seconds=video_length_seconds))
-    logger.debug("extract_and_upload_video: Finished getting video length")
-
-    logger.debug("extract_and_upload_video: Getting video height and width")
-    video_height_width = video.get_video_height_width(video_filename)
-    logger.debug("extract_and_upload_video: Finished getting height and width")
-
-    logger.debug("extract_and_upload_video: Updating length in db")
-    update_game_video_length(game_id, video_length)
-    logger.debug("extract_and_upload_video: Finished updating length in db")
-    
-    logger.debug("extract_and_upload_video: Extracting thumbnail")
-    video.get_thumbnail(video_filename, thumbnail_filename, time=video_length_seconds // 2)
-    logger.debug("extract_and_upload_video: Finished extracting thumbnail")
-
-    logger.debug("extract_and_upload_video: Uploading thumbnail")
-    s3Client.upload_file(
-        thumbnail_filename, 
-        bucket, 
-        thumbnail_key
-    )
-    logger.debug("extract_and_upload_video: Finished uploading thumbnail")
-
-    logger.debug("extract_and_upload_video: Uploading video to S3")
-    s3Client.upload_file(
-        video_filename, 
-        bucket, 
-        video_key
-    )
-    logger.debug("extract_and_upload_video: Finished uploading video to S3")
-
-    logger.debug("extract_and_upload_video: Chunking video")
-    chunked_video_dir = tempfile.mkdtemp()
-    video.chunk_video(video_filename, chunked_video_dir, chunk_size=60)
-    logger.debug("extract_and_upload_video: Finished chunking video")
-
-    logger.debug("extract_and_upload_video: Uploading video chunks")
-    with futures.ThreadPoolExecutor(8) as ex:
-        for vid in os.listdir(chunked_video_dir):
-            ex.submit(
-                s3Client.upload_file,
-                os.path.join(chunked_video_dir, vid),
-                bucket,
-                posixpath.join(
-                    posixpath.dirname(video_key),
-                    "chunks",
-                    vid
-                )
-            )
-    logger.debug("extract_and_upload_video: Finished uploading video chunks")
-    
-    logger.debug("extract_and_upload_video: Submitting lambda frame extraction")
+    """Ingests the video at `video_filename` as game `game_id`. Pass
+    `upload_video` False if it is already stored at `video_key`."""
+    with ingest_stages.track_stage(backend_instance.client, game_id, IngestStage.probe):
+        logger.debug("extract_and_upload_video: Probing video")
+        video_probe = video.probe_video(video_filename)
+        video_length_seconds = int(video_probe.duration)
+        video_length = str(datetime.timedelta(seconds=video_length_seconds))
+        video_height_width = video_probe.height_width()
+        logger.debug("extract_and_upload_video: Finished probing video: {} {}x{} at {} fps, {} bit/s".format(
+            video_probe.codec,
+            video_probe.width,
+            video_probe.height,
+            video_probe.fps,
+            video_probe.bit_rate,
+        ))
+
+        logger.debug("extract_and_upload_video: Updating length in db")
+        update_game_video_length(game_id, video_length)
+        logger.debug("extract_and_upload_video: Finished updating length in db")
     
-    aws_lambda_payloads = [
-        json.dumps({
-            "s3_bucket_path": bucket,
-            "s3_video_path": posixpath.join(posixpath.dirname(video_key), "chunks", basename),
-            "s3_output_frames_path": posixpath.join(posixpath.dirname(video_key), "frames", posixpath.splitext(basename)[0]),
-            "video_metadata": video_height_width
-        }).encode()
-        for basename in os.listdir(chunked_video_dir)
-    ]
-
-    client = boto3.client('lambda')
- 
-    aws_lambda_responses = []
-    with futures.ThreadPoolExecutor(max_workers=16) as ex:
-
-        result_futures = []
-        for payload in aws_lambda_payloads:
-            result_futures.append(ex.submit(
-                client.invoke,
-                FunctionName="extractFrames",
-                # InvocationType="Event",
-                Payload=payload
-            ))
-            
-        logger.debug("extract_and_upload_video: Submitted lambda frame extraction")
-
-        for result_future in futures.as_completed(result_futures):
-            aws_lambda_response = json.loads(result_future.result()["Payload"].read().decode("utf-8"))
-            aws_lambda_responses.append(aws_lambda_response)
-
-            raw_paths = ["s3://" + posixpath.join(frame["bucket"], frame["key"]) for frame in aws_lambda_response["frames"]]
-
-            img_types = ["png" for frame in aws_lambda_response["frames"]]
-            metadatas = [
-                {"bucket": bucket}
-                for frame in aws_lambda_response["frames"]
-            ]
-
-            frame_numbers = [-1 for frame in aws_lambda_response["frames"]]
-
-            insert_images(
-                raw_paths,
-                img_types,
-                metadatas,
-                game_id,
-                frame_numbers
-            )
-
-    logger.debug("extract_and_upload_video: Received all lambda responses")
+    with ingest_stages.track_stage(backend_instance.client, game_id, IngestStage.thumbnail) as progress:
+        logger.debug("extract_and_upload_video: Extracting thumbnail")
+        video.get_thumbnail(video_filename, thumbnail_filename, time=video_length_seconds // 2)
+        logger.debug("extract_and_upload_video: Finished extracting thumbnail")
+
+        logger.debug("extract_and_upload_video: Uploading thumbnail")
+        s3Client.upload_file(
+            thumbnail_filename, 
+            bucket, 
+            thumbnail_key
+        )
+        progress.add_bytes(os.path.getsize(thumbnail_filename))
+        logger.debug("extract_and_upload_video: Finished uploading thumbnail")
+
+    # the chunks and the segment list are removed whether or not the
+    # pipeline succeeds, the video workers run many jobs
+    with tempfile.TemporaryDirectory() as work_dir:
+        chunked_video_dir = os.path.join(work_dir, "chunks")
+        os.mkdir(chunked_video_dir)
+        ChunkPipeline(
+            bucket=bucket,
+            video_filename=video_filename,
+            video_key=video_key,
+            game_id=game_id,
+            video_height_width=video_height_width,
+            upload_video=upload_video,
+        ).run(chunked_video_dir, os.path.join(work_dir, "segments.csv"))
 
-    logger.debug("extract_and_upload_video: Finished inserting image metadata")
+    # uploads of the same video are deduplicated against this game from now on
+    backend_instance.update_game_data(game_id, {"ingest_complete": True})
 
     os.remove(video_filename)
     os.remove(thumbnail_filename)
-    shutil.rmtree(chunked_video_dir)
 
 
 def main():
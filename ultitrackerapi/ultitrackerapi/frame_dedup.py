@@ -0,0 +1,85 @@
+"""Near-duplicate frame suppression with perceptual hashes.
+
+Footage extracted at 1 fps has long runs of nearly identical frames during
+timeouts, pulls or with a static camera. Every frame gets a 64 bit DCT
+perceptual hash and is compared, in frame order, to the last frame that was
+kept. Frames within `threshold` differing bits of it are near duplicates:
+
+    * "drop" does not upload or insert them at all.
+    * "mark" keeps them but records the kept frame as `duplicate_of` in
+      their img_metadata, and the annotator queue skips them.
+    * "off" keeps every frame without hashing.
+"""
+import numpy as np
+
+from enum import Enum
+from PIL import Image
+from typing import Optional
+
+
+class DedupMode(Enum):
+    off = 0
+    mark = 1
+    drop = 2
+
+
+# frames are shrunk to IMAGE_SIZE x IMAGE_SIZE grayscale, the hash is the
+# HASH_SIZE x HASH_SIZE lowest frequencies of their DCT
+IMAGE_SIZE = 32
+HASH_SIZE = 8
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, np.newaxis]
+    i = np.arange(n)[np.newaxis, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT_MATRIX = _dct_matrix(IMAGE_SIZE)
+
+
+def phash(frame) -> int:
+    """64 bit perceptual hash of a PIL image or a (height, width, 3) uint8
+    RGB frame."""
+    image = frame if isinstance(frame, Image.Image) else Image.fromarray(frame)
+    pixels = np.asarray(
+        image.convert("L").resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR),
+        dtype=np.float64,
+    )
+    # 2D DCT-II as two matrix products
+    low_frequencies = (_DCT_MATRIX @ pixels @ _DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # the DC term only carries the brightness, leave it out of the median
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count("1")
+
+
+class NearDuplicateFilter(object):
+    """Compares the frames of a chunk, in order, to the last kept frame."""
+
+    def __init__(self, threshold: int):
+        self._threshold = threshold
+        self._kept_hash = None
+        self._kept_key = None
+
+    def check(self, frame_hash: int, key: str) -> Optional[str]:
+        """Returns the key of the kept frame that the frame at `key` is a
+        near duplicate of, or None if the frame is kept."""
+        if (
+            self._kept_hash is not None
+            and hamming_distance(frame_hash, self._kept_hash) <= self._threshold
+        ):
+            return self._kept_key
+
+        self._kept_hash = frame_hash
+        self._kept_key = key
+        return None
+
+
+def format_hash(frame_hash: int) -> str:
+    return "{:016x}".format(frame_hash)
@@ -0,0 +1,305 @@
+"""Executors that extract the frames of the chunks of a video.
+
+Both executors take the same chunk jobs and return the same responses as
+the `extractFrames` Lambda in scripts/python/aws_lambda_extract_frames.py:
+
+    job: {
+        "s3_bucket_path": bucket of the chunk and the frames,
+        "s3_video_path": key of the chunk,
+        "s3_output_frames_path": key prefix the frames are uploaded to,
+        "video_metadata": {"height": ..., "width": ...},
+        "fps": frames extracted per second,
+        "local_video_path": path of the chunk on this machine,
+        "dedup_mode": optional frame_dedup.DedupMode name, "off" by default,
+        "dedup_threshold": optional Hamming threshold of near duplicates,
+    }
+    response: {
+        "frames": [{"frame": filename, "bucket": ..., "key": ...}],
+        "num_dropped": near duplicate frames left out,
+    }
+
+With near-duplicate suppression every frame also gets its "phash" and,
+when it is marked, the key of the kept frame it duplicates as
+"duplicate_of".
+
+`LambdaFrameExtractor` invokes the Lambda per chunk. `LocalFrameExtractor`
+runs the same extraction on the local chunks in a process pool, so on-prem
+workers can use every core and the pipeline runs without AWS Lambda.
+
+With `in_memory` both read raw frames from ffmpeg's stdout and encode and
+upload them from memory rather than writing every frame to disk first.
+"""
+import boto3
+import json
+import multiprocessing
+import os
+import posixpath
+import shutil
+import tempfile
+
+from abc import ABC, abstractmethod
+from concurrent import futures
+from PIL import Image
+from typing import Dict, Iterator, List
+from ultitrackerapi import frame_dedup, get_logger, video
+from ultitrackerapi import (
+    FRAME_DEDUP_HAMMING_THRESHOLD,
+    FRAME_EXTRACTION_EXECUTOR,
+    FRAME_EXTRACTION_FFMPEG_THREADS,
+    FRAME_EXTRACTION_IN_MEMORY,
+    FRAME_EXTRACTION_LAMBDA_CONCURRENCY,
+    FRAME_EXTRACTION_LAMBDA_FUNCTION,
+    FRAME_EXTRACTION_LOCAL_WORKERS,
+    FRAME_EXTRACTION_NUM_BUFFERS,
+    FRAME_EXTRACTION_UPLOAD_THREADS,
+)
+
+
+logger = get_logger(__name__, "DEBUG")
+
+
+class FrameExtractor(ABC):
+    # chunks extracted at the same time
+    max_concurrency = 1
+
+    @abstractmethod
+    def submit(self, job: Dict) -> futures.Future:
+        """Starts extracting the frames of one chunk job, the future
+        resolves to its response."""
+        pass
+
+    def extract(self, jobs: List[Dict]) -> Iterator[Dict]:
+        """Extracts the frames of every chunk job and yields the responses
+        in the order the chunks finish."""
+        result_futures = [self.submit(job) for job in jobs]
+        logger.debug("{}: submitted {} chunks".format(type(self).__name__, len(jobs)))
+
+        for result_future in futures.as_completed(result_futures):
+            yield result_future.result()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LambdaFrameExtractor(FrameExtractor):
+
+    def __init__(
+        self,
+        function_name: str = FRAME_EXTRACTION_LAMBDA_FUNCTION,
+        max_concurrency: int = FRAME_EXTRACTION_LAMBDA_CONCURRENCY,
+        in_memory: bool = FRAME_EXTRACTION_IN_MEMORY,
+    ):
+        self._function_name = function_name
+        self._in_memory = in_memory
+        self.max_concurrency = max_concurrency
+        self._client = boto3.client("lambda")
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _invoke(self, job: Dict) -> Dict:
+        payload = {key: value for key, value in job.items() if key != "local_video_path"}
+        payload["in_memory"] = self._in_memory
+        result = self._client.invoke(
+            FunctionName=self._function_name,
+            Payload=json.dumps(payload).encode(),
+        )
+        response = json.loads(result["Payload"].read().decode("utf-8"))
+        if result.get("FunctionError"):
+            raise RuntimeError("Frame extraction of {} failed: {}".format(
+                job["s3_video_path"], response
+            ))
+
+        return response
+
+    def submit(self, job):
+        return self._executor.submit(self._invoke, job)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def _frame_info(job: Dict, frame_path: str) -> Dict:
+    return {
+        "frame": frame_path,
+        "bucket": job["s3_bucket_path"],
+        "key": posixpath.join(job["s3_output_frames_path"], frame_path),
+    }
+
+
+def _dedup_filter(job: Dict):
+    dedup_mode = frame_dedup.DedupMode[job.get("dedup_mode", "off")]
+    if dedup_mode == frame_dedup.DedupMode.off:
+        return dedup_mode, None
+
+    return dedup_mode, frame_dedup.NearDuplicateFilter(
+        job.get("dedup_threshold", FRAME_DEDUP_HAMMING_THRESHOLD)
+    )
+
+
+def _hash_frame(dedup_filter: frame_dedup.NearDuplicateFilter, frame, frame_info: Dict) -> bool:
+    """Adds the perceptual hash of `frame` to its `frame_info` and the kept
+    frame it duplicates, if any. Returns whether it is a near duplicate."""
+    frame_hash = frame_dedup.phash(frame)
+    frame_info["phash"] = frame_dedup.format_hash(frame_hash)
+
+    duplicate_of = dedup_filter.check(frame_hash, frame_info["key"])
+    if duplicate_of is None:
+        return False
+
+    frame_info["duplicate_of"] = duplicate_of
+    return True
+
+
+def extract_chunk(job: Dict, ffmpeg_threads: int = None, upload: bool = True) -> Dict:
+    """Extracts and uploads the frames of one chunk like the Lambda does.
+
+    Runs in the worker processes of `LocalFrameExtractor`. With `upload`
+    False the frames are only extracted, which is what the offline
+    benchmark measures.
+    """
+    dedup_mode, dedup_filter = _dedup_filter(job)
+    frames_out_directory = tempfile.mkdtemp()
+    try:
+        # scaled the way the Lambda scales them, so both executors produce
+        # the same frames
+        video.extract_frames(
+            job["local_video_path"],
+            frames_out_directory,
+            fps=job["fps"],
+            width=job["video_metadata"]["height"],
+            threads=ffmpeg_threads,
+        )
+
+        frames_info = []
+        num_dropped = 0
+        for frame_path in sorted(os.listdir(frames_out_directory)):
+            frame_info = _frame_info(job, frame_path)
+            if dedup_filter is not None:
+                with Image.open(os.path.join(frames_out_directory, frame_path)) as frame:
+                    is_duplicate = _hash_frame(dedup_filter, frame, frame_info)
+
+                if is_duplicate and dedup_mode == frame_dedup.DedupMode.drop:
+                    num_dropped += 1
+                    continue
+
+            frames_info.append(frame_info)
+
+        if upload:
+            client = boto3.client("s3")
+            with futures.ThreadPoolExecutor(FRAME_EXTRACTION_UPLOAD_THREADS) as ex:
+                upload_futures = [
+                    ex.submit(
+                        client.upload_file,
+                        os.path.join(frames_out_directory, frame_info["frame"]),
+                        frame_info["bucket"],
+                        frame_info["key"],
+                    )
+                    for frame_info in frames_info
+                ]
+
+                # raise the first failed upload
+                for upload_future in upload_futures:
+                    upload_future.result()
+
+        return {"frames": frames_info, "num_dropped": num_dropped}
+    finally:
+        shutil.rmtree(frames_out_directory)
+
+
+def extract_chunk_in_memory(job: Dict, ffmpeg_threads: int = None, upload: bool = True) -> Dict:
+    """Same frames and response as `extract_chunk` without any files.
+
+    Raw frames are read from ffmpeg's stdout into reusable buffers, PNG
+    encoded on a thread pool and uploaded from memory. The frame names come
+    from the order ffmpeg writes the frames in.
+    """
+    dedup_mode, dedup_filter = _dedup_filter(job)
+    video_metadata = job["video_metadata"]
+    # scaled the way the Lambda scales them, see `extract_chunk`
+    width = video_metadata["height"]
+    reader = video.RawFrameReader(
+        job["local_video_path"],
+        width,
+        video.scaled_height(video_metadata["width"], video_metadata["height"], width),
+        fps=job["fps"],
+        threads=ffmpeg_threads,
+        num_buffers=FRAME_EXTRACTION_NUM_BUFFERS,
+    )
+    client = boto3.client("s3") if upload else None
+
+    def encode_and_upload(frame_info, frame):
+        try:
+            data = video.encode_png(frame)
+        finally:
+            reader.release(frame)
+
+        if upload:
+            client.put_object(Bucket=frame_info["bucket"], Key=frame_info["key"], Body=data)
+
+        return frame_info
+
+    with futures.ThreadPoolExecutor(FRAME_EXTRACTION_UPLOAD_THREADS) as ex:
+        frame_futures = []
+        num_dropped = 0
+        for frame_index, frame in reader:
+            frame_info = _frame_info(job, "frame_{:06d}.png".format(frame_index))
+            # hashed in frame order, before the frame is handed to the pool
+            if (
+                dedup_filter is not None
+                and _hash_frame(dedup_filter, frame, frame_info)
+                and dedup_mode == frame_dedup.DedupMode.drop
+            ):
+                reader.release(frame)
+                num_dropped += 1
+                continue
+
+            frame_futures.append(ex.submit(encode_and_upload, frame_info, frame))
+
+        # raise the first failed encoding or upload
+        return {
+            "frames": [frame_future.result() for frame_future in frame_futures],
+            "num_dropped": num_dropped,
+        }
+
+
+class LocalFrameExtractor(FrameExtractor):
+
+    def __init__(
+        self,
+        max_workers: int = FRAME_EXTRACTION_LOCAL_WORKERS,
+        ffmpeg_threads: int = FRAME_EXTRACTION_FFMPEG_THREADS,
+        upload: bool = True,
+        in_memory: bool = FRAME_EXTRACTION_IN_MEMORY,
+    ):
+        self.max_concurrency = max_workers
+        self._extract_chunk = extract_chunk_in_memory if in_memory else extract_chunk
+        self._ffmpeg_threads = ffmpeg_threads
+        self._upload = upload
+        # spawned rather than forked, the video worker runs threads and holds
+        # database connections that must not be copied into the children
+        self._executor = futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def submit(self, job):
+        return self._executor.submit(
+            self._extract_chunk, job, self._ffmpeg_threads, self._upload
+        )
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def get_frame_extractor(executor: str = FRAME_EXTRACTION_EXECUTOR) -> FrameExtractor:
+    if executor == "lambda":
+        return LambdaFrameExtractor()
+    elif executor == "local":
+        return LocalFrameExtractor()
+    else:
+        raise ValueError("Invalid FRAME_EXTRACTION_EXECUTOR: {}".format(executor))
@@ -0,0 +1,277 @@
+"""Progress and timing of the stages of the video ingestion pipeline.
+
+Every stage of a game's ingestion is recorded in `ultitracker.ingest_stage`
+when it starts and when it finishes or fails, together with the bytes and
+frames it processed. A retried stage overwrites the previous attempt.
+
+The stages of the chunk pipeline run side by side, so each also records its
+busy time: how long at least one piece of its work was running. Stages that
+do not mark their work are busy for their whole duration. Latency summaries
+and the bottleneck are computed from the busy time.
+"""
+import contextlib
+import threading
+import time
+
+from enum import Enum
+from ultitrackerapi import get_logger, models, sql_models
+
+
+logger = get_logger(__name__, "DEBUG")
+
+
+class IngestStage(Enum):
+    probe = 0
+    thumbnail = 1
+    upload = 2
+    chunk = 3
+    extract = 4
+    insert = 5
+
+
+START_STAGE_COMMAND = """
+INSERT INTO {table_name} (game_id, stage, status, started_at, finished_at, num_bytes, num_frames, error, busy_seconds)
+VALUES (%(game_id)s, %(stage)s, 'running', NOW() AT TIME ZONE 'utc', NULL, NULL, NULL, NULL, NULL)
+ON CONFLICT (game_id, stage) DO UPDATE
+SET
+    status = EXCLUDED.status,
+    started_at = EXCLUDED.started_at,
+    finished_at = NULL,
+    num_bytes = NULL,
+    num_frames = NULL,
+    error = NULL,
+    busy_seconds = NULL
+""".format(table_name=sql_models.TableIngestStage.full_name)
+
+
+FINISH_STAGE_COMMAND = """
+UPDATE {table_name}
+SET
+    status = %(status)s,
+    finished_at = NOW() AT TIME ZONE 'utc',
+    num_bytes = %(num_bytes)s,
+    num_frames = %(num_frames)s,
+    error = %(error)s,
+    busy_seconds = %(busy_seconds)s
+WHERE game_id = %(game_id)s AND stage = %(stage)s
+""".format(table_name=sql_models.TableIngestStage.full_name)
+
+
+GET_PROCESSING_STATUS_COMMAND = """
+SELECT
+    stage,
+    status,
+    started_at,
+    finished_at,
+    EXTRACT(EPOCH FROM finished_at - started_at)::double precision,
+    busy_seconds,
+    num_bytes,
+    num_frames,
+    error
+FROM {table_name}
+WHERE game_id = %(game_id)s
+ORDER BY started_at
+""".format(table_name=sql_models.TableIngestStage.full_name)
+
+
+GET_LATEST_JOB_COMMAND = """
+SELECT status, attempts, max_attempts, last_error
+FROM {table_name}
+WHERE game_id = %(game_id)s
+ORDER BY created_at DESC
+LIMIT 1
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+# busy time percentiles of the stages that finished in the last `days` days,
+# stages recorded before busy times were tracked count their duration
+GET_PROCESSING_SUMMARY_COMMAND = """
+SELECT
+    stage,
+    COUNT(*) FILTER (WHERE status = 'succeeded'),
+    COUNT(*) FILTER (WHERE status = 'failed'),
+    percentile_cont(0.5) WITHIN GROUP (ORDER BY duration) FILTER (WHERE status = 'succeeded'),
+    percentile_cont(0.9) WITHIN GROUP (ORDER BY duration) FILTER (WHERE status = 'succeeded'),
+    percentile_cont(0.99) WITHIN GROUP (ORDER BY duration) FILTER (WHERE status = 'succeeded'),
+    AVG(duration) FILTER (WHERE status = 'succeeded'),
+    MAX(duration) FILTER (WHERE status = 'succeeded')
+FROM (
+    SELECT
+        stage,
+        status,
+        COALESCE(
+            busy_seconds,
+            EXTRACT(EPOCH FROM finished_at - started_at)::double precision
+        ) AS duration
+    FROM {table_name}
+    WHERE 1=1
+        AND finished_at IS NOT NULL
+        AND finished_at >= NOW() AT TIME ZONE 'utc' - make_interval(days => %(days)s)
+) stages
+GROUP BY stage
+""".format(table_name=sql_models.TableIngestStage.full_name)
+
+
+class StageProgress(object):
+    """Counts and busy time of one running stage, written when the stage
+    finishes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_bytes = None
+        self.num_frames = None
+        self._busy_seconds = None
+        self._num_working = 0
+        self._working_since = None
+
+    def add_bytes(self, num_bytes: int):
+        with self._lock:
+            self.num_bytes = (self.num_bytes or 0) + num_bytes
+
+    def add_frames(self, num_frames: int):
+        with self._lock:
+            self.num_frames = (self.num_frames or 0) + num_frames
+
+    def start_work(self):
+        """Marks a piece of work of the stage as running. Pieces may run at
+        the same time and finish from any thread."""
+        with self._lock:
+            if self._num_working == 0:
+                self._working_since = time.monotonic()
+            self._num_working += 1
+
+    def finish_work(self):
+        with self._lock:
+            self._num_working -= 1
+            if self._num_working == 0:
+                self._busy_seconds = (self._busy_seconds or 0) + time.monotonic() - self._working_since
+
+    @contextlib.contextmanager
+    def work(self):
+        self.start_work()
+        try:
+            yield
+        finally:
+            self.finish_work()
+
+    def busy_seconds(self):
+        """Time with at least one piece of work running so far, None if no
+        work was marked."""
+        with self._lock:
+            if self._num_working == 0:
+                return self._busy_seconds
+
+            return (self._busy_seconds or 0) + time.monotonic() - self._working_since
+
+
+def _record(client, command: str, params: dict):
+    # progress tracking must never fail the ingestion itself
+    try:
+        client.execute(command, params)
+    except Exception as e:
+        logger.error("Could not record ingest stage {}: {}".format(params, e))
+
+
+@contextlib.contextmanager
+def track_stage(client, game_id: str, stage: IngestStage):
+    """Records the start and the end of `stage` for `game_id`.
+
+    Yields a `StageProgress` for the block to count bytes and frames and
+    mark its work on. If the block raises the stage is recorded as failed
+    with the error.
+    """
+    params = {"game_id": game_id, "stage": stage.name}
+    _record(client, START_STAGE_COMMAND, params)
+
+    progress = StageProgress()
+    started = time.monotonic()
+
+    def busy_seconds():
+        busy_seconds = progress.busy_seconds()
+        return time.monotonic() - started if busy_seconds is None else busy_seconds
+
+    try:
+        yield progress
+    except Exception as e:
+        _record(client, FINISH_STAGE_COMMAND, dict(
+            params,
+            status="failed",
+            num_bytes=progress.num_bytes,
+            num_frames=progress.num_frames,
+            error=repr(e),
+            busy_seconds=busy_seconds(),
+        ))
+        raise
+
+    _record(client, FINISH_STAGE_COMMAND, dict(
+        params,
+        status="succeeded",
+        num_bytes=progress.num_bytes,
+        num_frames=progress.num_frames,
+        error=None,
+        busy_seconds=busy_seconds(),
+    ))
+
+
+def parse_processing_status(
+    game_id: str, stage_result, job_result
+) -> models.ProcessingStatusResponse:
+    job = job_result[0] if job_result else None
+
+    return models.ProcessingStatusResponse(
+        game_id=game_id,
+        stages=[
+            models.IngestStageStatus(**dict(zip(
+                [
+                    "stage",
+                    "status",
+                    "started_at",
+                    "finished_at",
+                    "duration_seconds",
+                    "busy_seconds",
+                    "num_bytes",
+                    "num_frames",
+                    "error",
+                ],
+                row,
+            )))
+            for row in stage_result
+        ],
+        job_status=job[0] if job else None,
+        job_attempts=job[1] if job else None,
+        job_max_attempts=job[2] if job else None,
+        job_error=job[3] if job else None,
+    )
+
+
+def parse_processing_summary(result) -> models.ProcessingSummaryResponse:
+    order = {stage.name: stage.value for stage in IngestStage}
+    stages = sorted(
+        [
+            models.IngestStageSummary(**dict(zip(
+                [
+                    "stage",
+                    "num_succeeded",
+                    "num_failed",
+                    "p50_seconds",
+                    "p90_seconds",
+                    "p99_seconds",
+                    "mean_seconds",
+                    "max_seconds",
+                ],
+                row,
+            )))
+            for row in result
+        ],
+        key=lambda summary: order.get(summary.stage, len(order)),
+    )
+
+    timed_stages = [stage for stage in stages if stage.p50_seconds is not None]
+    bottleneck_stage = (
+        max(timed_stages, key=lambda stage: stage.p50_seconds).stage
+        if timed_stages else None
+    )
+
+    return models.ProcessingSummaryResponse(
+        stages=stages, bottleneck_stage=bottleneck_stage
+    )
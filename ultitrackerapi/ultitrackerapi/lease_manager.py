@@ -0,0 +1,416 @@
+"""In-process annotation lease manager for the synchronous backend.
+
+Instead of one database round trip per lease, the manager reserves blocks of
+images in Postgres and hands them out from memory:
+
+    * A reservation marks up to `reservation_size` images as sent until
+      `reservation_duration` seconds from now with the same conditional
+      upsert the annotator queue uses, so other workers and processes never
+      reserve or lease the same images.
+    * Leases are served from the reserved pool of the requested games,
+      table and order. A reserved image is only handed out while more than
+      the requested lease duration is left on its reservation.
+    * Active leases are kept in a min heap ordered by expiration. Leases
+      that expire without a submission are dropped from the pool; their
+      reservation in the database is shortened so the image becomes
+      available again instead of waiting out the whole reservation.
+    * The 'sent' rows of the transaction history and the shortened
+      reservations are written behind by a background thread in batches.
+    * Pools are only created for games that exist and are dropped once
+      they have not been used for a whole reservation, by when every
+      image left in them has run out.
+
+The database stays the source of truth. If the process dies, reserved but
+unleased images become available again once their reservation expires and
+only unflushed history rows are lost.
+"""
+import collections
+import datetime
+import heapq
+import threading
+
+from typing import Dict, List, Tuple
+from ultitrackerapi import annotator_queue, get_logger, models, sql_backend
+from ultitrackerapi import (
+    LEASE_MANAGER_FLUSH_INTERVAL,
+    LEASE_MANAGER_RESERVATION_DURATION,
+    LEASE_MANAGER_RESERVATION_SIZE,
+)
+
+
+logger = get_logger(__name__, "DEBUG")
+
+
+# Same candidates and conditional upsert as the annotator queue, but without
+# the history rows: those are written per lease by the flush thread.
+RESERVE_IMAGES_COMMAND = """
+WITH candidates AS (
+    {candidates}
+),
+leased AS (
+    {lease_status}
+)
+SELECT A.img_id, B.img_raw_path, A.lease_expiration, B.frame_number
+FROM leased A
+JOIN candidates B ON A.img_id = B.img_id
+"""
+
+
+EXISTING_GAMES_COMMAND = """
+SELECT game_id
+FROM ultitracker.game_metadata
+WHERE game_id = ANY(%(game_ids)s::text[])
+"""
+
+
+INSERT_SENT_TRANSACTIONS_COMMAND = """
+INSERT INTO ultitracker.annotation_transaction (img_id, timestamp, table_ref, action)
+SELECT img_id, timestamp, table_ref, 'sent'::annotation_action
+FROM unnest(
+    %(img_ids)s::text[],
+    %(timestamps)s::timestamp[],
+    %(table_refs)s::text[]::annotation_table[]
+) AS T(img_id, timestamp, table_ref)
+ON CONFLICT DO NOTHING
+"""
+
+
+# Only touches reservations that are still ours: a submission replaces the
+# status and a new lease by anyone else replaces the expiration.
+RELEASE_RESERVATIONS_COMMAND = """
+UPDATE ultitracker.annotation_status S
+SET
+    lease_expiration = NOW() AT TIME ZONE 'utc',
+    updated_at = NOW() AT TIME ZONE 'utc'
+FROM unnest(
+    %(img_ids)s::text[],
+    %(table_refs)s::text[]::annotation_table[],
+    %(reservation_expirations)s::timestamp[]
+) AS T(img_id, table_ref, reservation_expiration)
+WHERE 1=1
+    AND S.img_id = T.img_id
+    AND S.table_ref = T.table_ref
+    AND S.status = 'sent'
+    AND S.lease_expiration = T.reservation_expiration
+"""
+
+
+def reserve_images_statement(
+    queue_params: annotator_queue.AnnotatorQueueParams,
+):
+    name, _, params = annotator_queue.next_n_images_statement(queue_params)
+    command = RESERVE_IMAGES_COMMAND.format(
+        candidates=annotator_queue.candidates_command(queue_params),
+        lease_status=annotator_queue.LEASE_STATUS_COMMAND,
+    )
+
+    return "reserve_" + name, command, params
+
+
+# (img_id, img_raw_path, reservation_expiration)
+ReservedImage = Tuple[str, str, datetime.datetime]
+
+
+class LeaseManager(object):
+
+    def __init__(
+        self,
+        client: sql_backend.SQLClient,
+        reservation_size: int = LEASE_MANAGER_RESERVATION_SIZE,
+        reservation_duration: float = LEASE_MANAGER_RESERVATION_DURATION,
+        flush_interval: float = LEASE_MANAGER_FLUSH_INTERVAL,
+    ):
+        self._client = client
+        self._reservation_size = reservation_size
+        self._reservation_duration = reservation_duration
+        self._flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        # pool key -> deque of ReservedImage, in the order they were reserved
+        self._pools = collections.defaultdict(collections.deque)
+        # pool key -> lock held while the pool is refilled, so concurrent
+        # requests for an empty pool reserve once
+        self._refill_locks = collections.defaultdict(threading.Lock)
+        # pool key -> last time a lease was requested from the pool
+        self._pools_last_used = {}
+        # games checked to exist, games are never deleted
+        self._known_game_ids = set()
+        # heap of (lease_expiration, img_id, table_ref)
+        self._lease_heap = []
+        # (img_id, table_ref) -> (lease_expiration, reservation_expiration)
+        self._active_leases = {}
+
+        self._pending_sent = []
+        self._pending_releases = []
+
+        self._num_reservations = 0
+        self._num_reserved = 0
+        self._num_leased = 0
+        self._num_expired = 0
+        self._num_flushed = 0
+        self._num_dropped_pools = 0
+
+        self._stop = threading.Event()
+        self._flush_thread = None
+
+    @staticmethod
+    def _pool_key(queue_params: annotator_queue.AnnotatorQueueParams):
+        return (
+            tuple(sorted(set(queue_params.game_ids))),
+            queue_params.annotation_type.name,
+            queue_params.order_type.name,
+        )
+
+    def start(self):
+        if self._flush_thread is not None:
+            return
+
+        self._stop.clear()
+        self._flush_thread = threading.Thread(
+            target=self._run, name="lease-manager-flush", daemon=True
+        )
+        self._flush_thread.start()
+
+    def close(self):
+        """Stops the flush thread and writes everything still pending."""
+        if self._flush_thread is not None:
+            self._stop.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+
+        self._expire_leases()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            try:
+                self._expire_leases()
+                self.flush()
+            except Exception as e:
+                # the writes stay pending and are retried on the next tick
+                logger.error("LeaseManager flush failed: {}".format(e))
+
+    def _take(
+        self,
+        pool: collections.deque,
+        num_images: int,
+        min_expiration: datetime.datetime,
+    ) -> List[ReservedImage]:
+        taken = []
+        while pool and len(taken) < num_images:
+            image = pool.popleft()
+            # not enough of the reservation left to cover the lease, the
+            # reservation runs out on its own
+            if image[2] > min_expiration:
+                taken.append(image)
+
+        return taken
+
+    def _existing_game_ids(self, game_ids: List[str]) -> List[str]:
+        """The requested games that exist, so that made up game ids do not
+        get pools of their own."""
+        with self._lock:
+            unknown_game_ids = set(game_ids) - self._known_game_ids
+
+        if unknown_game_ids:
+            results = self._client.execute(
+                EXISTING_GAMES_COMMAND, {"game_ids": list(unknown_game_ids)}
+            )
+            with self._lock:
+                self._known_game_ids.update(result[0] for result in results or [])
+
+        with self._lock:
+            return [game_id for game_id in game_ids if game_id in self._known_game_ids]
+
+    def _reserve(self, queue_params: annotator_queue.AnnotatorQueueParams):
+        reservation_params = queue_params.copy(update={
+            "num_images": max(self._reservation_size, queue_params.num_images),
+            "lease_duration": self._reservation_duration,
+        })
+        results = self._client.execute_prepared(
+            *reserve_images_statement(reservation_params)
+        )
+        logger.debug("LeaseManager reserved {} images".format(len(results)))
+        annotator_queue.advance_sequential_cursor(
+            reservation_params,
+            [(result[3], result[0]) for result in results],
+        )
+
+        with self._lock:
+            self._num_reservations += 1
+            self._num_reserved += len(results)
+
+        if queue_params.order_type == annotator_queue.AnnotationOrderType.sequential:
+            results = sorted(results, key=lambda result: (result[3], result[0]))
+
+        return [tuple(result[:3]) for result in results]
+
+    def get_next_n_images(
+        self,
+        backend: sql_backend.SQLBackend,
+        queue_params: annotator_queue.AnnotatorQueueParams,
+    ) -> models.ImgLocationListResponse:
+        """Same contract as `annotator_queue.get_next_n_images`."""
+        if queue_params.lease_duration >= self._reservation_duration:
+            # a reservation could never cover the lease
+            return annotator_queue.get_next_n_images(backend, queue_params)
+
+        self.start()
+
+        game_ids = self._existing_game_ids(queue_params.game_ids)
+        if not game_ids:
+            return models.ImgLocationListResponse(img_locations=[])
+
+        queue_params = queue_params.copy(update={"game_ids": game_ids})
+        key = self._pool_key(queue_params)
+        now = datetime.datetime.utcnow()
+        lease_expiration = now + datetime.timedelta(
+            seconds=queue_params.lease_duration
+        )
+
+        with self._lock:
+            # marked as used in the same critical section that hands out the
+            # refill lock, so the pool is not dropped while it is refilled
+            self._pools_last_used[key] = now
+            refill_lock = self._refill_locks[key]
+            images = self._take(
+                self._pools[key], queue_params.num_images, lease_expiration
+            )
+
+        if len(images) < queue_params.num_images:
+            with refill_lock:
+                # another request may have refilled the pool while waiting
+                with self._lock:
+                    images += self._take(
+                        self._pools[key],
+                        queue_params.num_images - len(images),
+                        lease_expiration,
+                    )
+
+                if len(images) < queue_params.num_images:
+                    reserved = self._reserve(queue_params)
+                    with self._lock:
+                        self._pools[key].extend(reserved)
+                        images += self._take(
+                            self._pools[key],
+                            queue_params.num_images - len(images),
+                            lease_expiration,
+                        )
+
+        table_ref = queue_params.annotation_type.name
+        with self._lock:
+            for img_id, _, reservation_expiration in images:
+                heapq.heappush(
+                    self._lease_heap, (lease_expiration, img_id, table_ref)
+                )
+                self._active_leases[(img_id, table_ref)] = (
+                    lease_expiration, reservation_expiration
+                )
+                self._pending_sent.append((img_id, now, table_ref))
+
+            self._num_leased += len(images)
+
+        return models.ImgLocationListResponse(img_locations=[
+            models.ImgLocationResponse(
+                img_id=img_id,
+                img_path=img_raw_path,
+                annotation_expiration_utc_time=lease_expiration,
+            )
+            for img_id, img_raw_path, _ in images
+        ])
+
+    def release(self, img_id: str, annotation_table: models.AnnotationTable):
+        """Forgets the lease of a submitted image.
+
+        The submission itself already replaced the reservation in the
+        database. Submissions that reach another worker are not seen here,
+        which is why expired leases are never handed out again.
+        """
+        with self._lock:
+            self._active_leases.pop((img_id, annotation_table.name), None)
+
+    def _expire_leases(self):
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            while self._lease_heap and self._lease_heap[0][0] <= now:
+                lease_expiration, img_id, table_ref = heapq.heappop(
+                    self._lease_heap
+                )
+                lease = self._active_leases.get((img_id, table_ref))
+                # released, or leased again after a refill
+                if lease is None or lease[0] != lease_expiration:
+                    continue
+
+                del self._active_leases[(img_id, table_ref)]
+                self._pending_releases.append((img_id, table_ref, lease[1]))
+                self._num_expired += 1
+
+            self._drop_idle_pools(now)
+
+    def _drop_idle_pools(self, now: datetime.datetime):
+        """Drops the pools not used for a whole reservation together with
+        their refill locks. Every image reserved for such a pool has run
+        out, so it is empty as far as leases go. Must hold `_lock`."""
+        idle_since = now - datetime.timedelta(seconds=self._reservation_duration)
+        for key, last_used in list(self._pools_last_used.items()):
+            if last_used > idle_since or self._refill_locks[key].locked():
+                continue
+
+            del self._pools_last_used[key]
+            self._pools.pop(key, None)
+            self._refill_locks.pop(key, None)
+            self._num_dropped_pools += 1
+
+    def flush(self):
+        """Writes the pending history rows and releases in one transaction."""
+        with self._lock:
+            sent, self._pending_sent = self._pending_sent, []
+            releases, self._pending_releases = self._pending_releases, []
+
+        if not sent and not releases:
+            return
+
+        commands = []
+        if sent:
+            img_ids, timestamps, table_refs = zip(*sent)
+            commands.append((INSERT_SENT_TRANSACTIONS_COMMAND, {
+                "img_ids": list(img_ids),
+                "timestamps": list(timestamps),
+                "table_refs": list(table_refs),
+            }))
+
+        if releases:
+            img_ids, table_refs, reservation_expirations = zip(*releases)
+            commands.append((RELEASE_RESERVATIONS_COMMAND, {
+                "img_ids": list(img_ids),
+                "table_refs": list(table_refs),
+                "reservation_expirations": list(reservation_expirations),
+            }))
+
+        try:
+            self._client.execute(commands)
+        except Exception:
+            with self._lock:
+                self._pending_sent = sent + self._pending_sent
+                self._pending_releases = releases + self._pending_releases
+            raise
+
+        with self._lock:
+            self._num_flushed += len(sent) + len(releases)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "pools": {
+                    ",".join(key[0]) + "/" + key[1] + "/" + key[2]: len(pool)
+                    for key, pool in self._pools.items()
+                },
+                "active_leases": len(self._active_leases),
+                "pending_writes": len(self._pending_sent) + len(self._pending_releases),
+                "reservations": self._num_reservations,
+                "reserved": self._num_reserved,
+                "leased": self._num_leased,
+                "expired": self._num_expired,
+                "flushed": self._num_flushed,
+                "dropped_pools": self._num_dropped_pools,
+            }
@@ -1,15 +1,20 @@
 import datetime 
+import math
 import posixpath 
 
 from enum import Enum
 from fastapi import Form
 from pydantic import BaseConfig, BaseModel
-from typing import Dict, List, Optional, Set, Type
-from ultitrackerapi import ANNOTATION_EXPIRATION_DURATION, ULTITRACKER_AUTH_JWT_ALGORITHM, get_logger
+from typing import Dict, List, Optional, Set, Type, Union
+from ultitrackerapi import ANNOTATION_EXPIRATION_DURATION, PRESIGNED_URL_MIN_REMAINING_FRACTION, ULTITRACKER_AUTH_JWT_ALGORITHM, get_logger
 
 
 logger = get_logger(__name__)
 
+# expiry classes of the presigned urls handed out with responses
+THUMBNAIL_URL_EXPIRATION = 10
+VIDEO_URL_EXPIRATION = 60 * 60 * 2
+
 
 # NOTE: Header and Payload information is readable by everyone
 class Header(BaseModel):
@@ -79,29 +84,22 @@ class GameResponse(BaseModel):
     def __init__(self, *args, **kwargs):
 
         # put this import here to not mess with import orders
-        from ultitrackerapi import get_s3Client
-        s3Client = get_s3Client()
+        from ultitrackerapi import get_presigner
+        presigner = get_presigner()
 
         super().__init__(*args, **kwargs)
         
         if len(self.data) != 0:
-            self.data["thumbnail"] = s3Client.generate_presigned_url(
-                "get_object",
-                Params={
-                    "Bucket": self.data["bucket"],
-                    "Key": self.thumbnail_key,
-                },
-                ExpiresIn=10,
+            self.data["thumbnail"], self.data["video"] = presigner.get_urls(
+                self.presign_requests(self.data, self.thumbnail_key, self.video_key)
             )
 
-            self.data["video"] = s3Client.generate_presigned_url(
-                "get_object",
-                Params={
-                    "Bucket": self.data["bucket"],
-                    "Key": self.video_key
-                },
-                ExpiresIn=60 * 60 * 2,
-            )
+    @staticmethod
+    def presign_requests(data: dict, thumbnail_key: str, video_key: str):
+        return [
+            (data["bucket"], thumbnail_key, THUMBNAIL_URL_EXPIRATION),
+            (data["bucket"], video_key, VIDEO_URL_EXPIRATION),
+        ]
     
     
 class GameList(BaseModel):
@@ -111,14 +109,100 @@ class GameList(BaseModel):
         self.game_list.append(game)
 
 
+class GameListOrder(Enum):
+    game_id = 0
+    date = 1
+
+
 class GameListResponse(BaseModel):
     game_list: List[GameResponse]
+    # pass back to get the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+class ImageQueryResponse(BaseModel):
+    # img_location columns of every matching image plus the game data
+    images: List[Dict] = []
+    # number of matching images, only set when counting
+    count: Optional[int] = None
+    # pass back to get the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+class IngestStageStatus(BaseModel):
+    stage: str
+    # running, succeeded or failed
+    status: str
+    started_at: datetime.datetime
+    finished_at: Optional[datetime.datetime] = None
+    duration_seconds: Optional[float] = None
+    # time spent with work of the stage running, at most duration_seconds
+    busy_seconds: Optional[float] = None
+    num_bytes: Optional[int] = None
+    num_frames: Optional[int] = None
+    error: Optional[str] = None
+
+
+class ProcessingStatusResponse(BaseModel):
+    game_id: str
+    # in the order the stages started
+    stages: List[IngestStageStatus] = []
+    # latest processing job of the game
+    job_status: Optional[str] = None
+    job_attempts: Optional[int] = None
+    job_max_attempts: Optional[int] = None
+    job_error: Optional[str] = None
+
+
+class IngestStageSummary(BaseModel):
+    stage: str
+    num_succeeded: int
+    num_failed: int
+    # busy times of the succeeded runs in seconds
+    p50_seconds: Optional[float] = None
+    p90_seconds: Optional[float] = None
+    p99_seconds: Optional[float] = None
+    mean_seconds: Optional[float] = None
+    max_seconds: Optional[float] = None
+
+
+class ProcessingSummaryResponse(BaseModel):
+    stages: List[IngestStageSummary] = []
+    # stage with the highest median busy time
+    bottleneck_stage: Optional[str] = None
 
 
 class ArbitraryModelConfig(BaseConfig):
     arbitrary_types_allowed = True
 
 
+class IndexMethod(Enum):
+    btree = 0
+    gin = 1
+    gist = 2
+
+
+class Index(BaseModel):
+    name: str
+    # columns or expressions, each optionally followed by an operator class
+    # or sort order, e.g. "img_metadata jsonb_path_ops" or "timestamp DESC"
+    columns: List[str]
+    method: IndexMethod = IndexMethod.btree
+    # predicate of a partial index
+    where: Optional[str] = None
+    unique: bool = False
+
+    def create_command(self, table_full_name: str) -> str:
+        return "CREATE {unique}INDEX IF NOT EXISTS {name} ON {table} USING {method} ({columns}){where}".format(
+            unique="UNIQUE " if self.unique else "",
+            name=self.name,
+            table=table_full_name,
+            method=self.method.name,
+            columns=", ".join(self.columns),
+            where=" WHERE {}".format(self.where) if self.where else "",
+        )
+
+
 class Table(BaseModel):
     # Want to allow Type for column_types, so we need
     # to allow aribitrary types for pydantic
@@ -128,6 +212,11 @@ class Table(BaseModel):
     columns: List[str]
     column_types: List[Type]
     create_commands: List[str]
+    # idempotent commands that bring a table created by an older version of
+    # create_commands up to date
+    migration_commands: List[str] = []
+    # created after the create and migration commands, idempotently
+    indexes: List[Index] = []
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -146,6 +235,10 @@ class Table(BaseModel):
     def full_name(self):
         return self.construct_full_name(self.schema_name, self.table_name)
 
+    @property
+    def create_index_commands(self) -> List[str]:
+        return [index.create_command(self.full_name) for index in self.indexes]
+
 
 class ImgEncoding(Enum):
     jpeg = 0
@@ -214,6 +307,23 @@ def is_not_presigned_url(url):
 
     return True
     
+def url_expiration_class(
+    seconds: float,
+    min_remaining_fraction: float = PRESIGNED_URL_MIN_REMAINING_FRACTION,
+) -> int:
+    """Rounds a url lifetime up to a multiple of the default lease duration
+    so urls for leases of similar length share presigned url cache entries.
+
+    A cached url of a class is only guaranteed `min_remaining_fraction` of
+    it, so the class is sized for `seconds` to fit into that part and every
+    url handed out outlives the lease.
+    """
+    required_seconds = seconds / (1 - min_remaining_fraction)
+    num_leases = max(math.ceil(required_seconds / ANNOTATION_EXPIRATION_DURATION), 1)
+
+    return num_leases * ANNOTATION_EXPIRATION_DURATION
+
+
 class ImgLocationResponse(BaseModel):
     img_id: str
     img_path: str
@@ -222,20 +332,22 @@ class ImgLocationResponse(BaseModel):
     def __init__(self, *args, **kwargs):
 
         # put this import here to not mess with import orders
-        from ultitrackerapi import get_s3Client
-        s3Client = get_s3Client()
+        from ultitrackerapi import get_presigner
+        presigner = get_presigner()
 
         super().__init__(*args, **kwargs)
 
         if is_not_presigned_url(self.img_path):
             bucket, key = parse_bucket_key_from_url(self.img_path)
-            self.img_path = s3Client.generate_presigned_url(
-                "get_object",
-                Params={
-                    "Bucket": bucket,
-                    "Key": key,
-                },
-                ExpiresIn=ANNOTATION_EXPIRATION_DURATION,
+            self.img_path = presigner.get_url(
+                bucket,
+                key,
+                url_expiration_class(
+                    (
+                        self.annotation_expiration_utc_time
+                        - datetime.datetime.utcnow()
+                    ).total_seconds()
+                ),
             )
 
 
@@ -280,6 +392,32 @@ class AnnotationCameraAngle(Annotation):
     is_valid: bool
 
 
+class AnnotationBatchItem(BaseModel):
+    img_id: str
+    # name of an AnnotationTable
+    annotation_table: str
+    annotation: Union[AnnotationPlayerBboxes, AnnotationFieldLines, AnnotationCameraAngle]
+
+
+class AnnotationBatchRequest(BaseModel):
+    items: List[AnnotationBatchItem]
+
+
+class AnnotationBatchItemResult(BaseModel):
+    img_id: str
+    annotation_table: str
+    inserted: bool
+    error: Optional[str] = None
+
+
+class AnnotationBatchResponse(BaseModel):
+    # in the order of the request items
+    results: List[AnnotationBatchItemResult]
+    num_inserted: int
+    elapsed_seconds: float
+    items_per_second: float
+
+
 class Database(BaseModel):
     name: str
     tables: Set[Table]
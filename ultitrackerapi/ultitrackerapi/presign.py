@@ -0,0 +1,74 @@
+from typing import List, Tuple
+from ultitrackerapi.cache import TTLCache
+
+
+class PresignedUrlCache(object):
+    """Hands out presigned S3 GET urls, reusing a url while enough of its
+    lifetime is left.
+
+    Urls are cached by (bucket, key, expires_in), where `expires_in` is the
+    expiry class the caller asks for. A cached url is reused until less than
+    `min_remaining_fraction` of its lifetime is left, so every url handed
+    out stays valid for at least `min_remaining_fraction * expires_in`
+    seconds.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        max_size: int = 10000,
+        min_remaining_fraction: float = 0.5,
+    ):
+        if not 0 <= min_remaining_fraction < 1:
+            raise ValueError("min_remaining_fraction must be in [0, 1)")
+
+        self._s3_client = s3_client
+        self._min_remaining_fraction = min_remaining_fraction
+        self._cache = TTLCache(max_size=max_size)
+
+    def _sign(self, bucket: str, key: str, expires_in: int) -> str:
+        url = self._s3_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": bucket,
+                "Key": key,
+            },
+            ExpiresIn=expires_in,
+        )
+        self._cache.set(
+            (bucket, key, expires_in),
+            url,
+            ttl=expires_in * (1 - self._min_remaining_fraction),
+        )
+
+        return url
+
+    def get_url(self, bucket: str, key: str, expires_in: int) -> str:
+        url = self._cache.get((bucket, key, expires_in))
+        if url is None:
+            url = self._sign(bucket, key, expires_in)
+
+        return url
+
+    def get_urls(self, requests: List[Tuple[str, str, int]]) -> List[str]:
+        """Presigns a list of (bucket, key, expires_in) requests.
+
+        Duplicate requests are signed once and urls that are still cached
+        are not signed again.
+        """
+        urls = {}
+        for request in requests:
+            if request not in urls:
+                urls[request] = self._cache.get(request)
+
+        for request, url in urls.items():
+            if url is None:
+                urls[request] = self._sign(*request)
+
+        return [urls[request] for request in requests]
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        stats["min_remaining_fraction"] = self._min_remaining_fraction
+
+        return stats
@@ -1,21 +1,36 @@
+import base64
+import binascii
+import collections
+import contextlib
 import datetime
 import json
+import re
 import textwrap
+import threading
 import uuid
 
 from typing import List, Union
-from ultitrackerapi import backend, get_s3Client, models, sql_models
+from ultitrackerapi import backend, cache, get_presigner, get_s3Client, ingest_stages, models, sql_models
 
 import psycopg2 as psql
+import psycopg2.extensions
+import psycopg2.extras
 import time
 from ultitrackerapi import (
     get_logger,
+    ANNOTATION_STREAM_BATCH_SIZE,
+    GAME_LIST_DEFAULT_LIMIT,
     NUM_CONNECTION_RETRIES,
+    POSTGRES_POOL_CHECKOUT_TIMEOUT,
+    POSTGRES_POOL_HEALTH_CHECK_INTERVAL,
+    POSTGRES_POOL_MAX_SIZE,
+    POSTGRES_POOL_MIN_SIZE,
     POSTGRES_USERNAME,
     POSTGRES_PASSWORD,
     POSTGRES_HOSTNAME,
     POSTGRES_PORT,
     POSTGRES_DATABASE,
+    QUERY_IMAGES_DEFAULT_LIMIT,
 )
 
 # get logger
@@ -24,6 +39,305 @@ logger = get_logger(__name__, level="DEBUG")
 # start s3 client
 s3Client = get_s3Client()
 
+# pass dicts as jsonb parameters
+psql.extensions.register_adapter(dict, psql.extras.Json)
+
+NAMED_PARAMETER_PATTERN = re.compile(r"%\((\w+)\)s|%%")
+
+
+def to_positional(command: str):
+    """Rewrites a command with psycopg2 style `%(name)s` parameters to
+    Postgres `$n` parameters.
+
+    Returns the rewritten command and the parameter names in positional
+    order. A name that appears more than once maps to the same `$n`.
+    """
+    names = []
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+
+        return "${}".format(names.index(name) + 1)
+
+    return NAMED_PARAMETER_PATTERN.sub(replace, command), names
+
+
+class PreparingConnection(psql.extensions.connection):
+    """Connection that remembers which statements were prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out of the pool in time."""
+    pass
+
+
+class ConnectionPool(object):
+    """Thread safe pool of psycopg2 connections.
+
+    Connections are opened lazily up to `max_size`, `min_size` of them are
+    opened up front by `fill`. A checkout waits at most `checkout_timeout`
+    seconds for a connection to be returned before raising
+    `PoolTimeoutError`. Connections that sat idle for longer than
+    `health_check_interval` seconds are tested with a `SELECT 1` before they
+    are handed out and replaced if the test fails.
+    """
+
+    def __init__(
+        self,
+        connect,
+        min_size=1,
+        max_size=10,
+        checkout_timeout=30,
+        health_check_interval=30,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(
+                "Invalid pool size: min_size={}, max_size={}".format(
+                    min_size, max_size
+                )
+            )
+
+        self._connect = connect
+        self._min_size = min_size
+        self._max_size = max_size
+        self._checkout_timeout = checkout_timeout
+        self._health_check_interval = health_check_interval
+
+        # idle connections as (connection, time it was returned)
+        self._idle = collections.deque()
+        self._num_open = 0
+        self._num_in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self._num_checkouts = 0
+        self._num_timeouts = 0
+        self._num_connections_opened = 0
+        self._num_connections_discarded = 0
+        self._num_health_check_failures = 0
+        self._total_wait_seconds = 0.0
+
+    def fill(self):
+        with self._condition:
+            num_to_open = self._min_size - self._num_open
+            self._num_open += max(num_to_open, 0)
+
+        for i in range(num_to_open):
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._condition:
+                    self._num_open -= num_to_open - i
+                    self._condition.notify_all()
+                raise
+
+            with self._condition:
+                self._num_connections_opened += 1
+                self._idle.append((conn, time.monotonic()))
+                self._condition.notify()
+
+    def getconn(self):
+        start_time = time.monotonic()
+        deadline = start_time + self._checkout_timeout
+
+        while True:
+            conn = None
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise psql.InterfaceError("connection pool is closed")
+
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+
+                    if self._num_open < self._max_size:
+                        # reserve the slot, the connection is opened outside
+                        # of the lock
+                        self._num_open += 1
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._num_timeouts += 1
+                        raise PoolTimeoutError(
+                            "Timed out after {} seconds waiting for a "
+                            "database connection".format(self._checkout_timeout)
+                        )
+
+                    self._condition.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._num_open -= 1
+                        self._condition.notify()
+                    raise
+
+                with self._condition:
+                    self._num_connections_opened += 1
+
+            elif not self._is_healthy(conn, last_used):
+                logger.warning("ConnectionPool: discarding unhealthy connection")
+                with self._condition:
+                    self._num_health_check_failures += 1
+                self._discard(conn)
+                continue
+
+            with self._condition:
+                self._num_in_use += 1
+                self._num_checkouts += 1
+                self._total_wait_seconds += time.monotonic() - start_time
+
+            return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if (
+                    conn.get_transaction_status()
+                    != psql.extensions.TRANSACTION_STATUS_IDLE
+                ):
+                    conn.rollback()
+            except psql.Error:
+                discard = True
+
+        with self._condition:
+            self._num_in_use -= 1
+
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._condition.notify_all()
+
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "min_size": self._min_size,
+                "max_size": self._max_size,
+                "open": self._num_open,
+                "in_use": self._num_in_use,
+                "idle": len(self._idle),
+                "checkouts": self._num_checkouts,
+                "timeouts": self._num_timeouts,
+                "connections_opened": self._num_connections_opened,
+                "connections_discarded": self._num_connections_discarded,
+                "health_check_failures": self._num_health_check_failures,
+                "average_wait_seconds": (
+                    self._total_wait_seconds / self._num_checkouts
+                    if self._num_checkouts
+                    else 0.0
+                ),
+            }
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+
+        if time.monotonic() - last_used < self._health_check_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psql.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psql.Error:
+            pass
+
+        with self._condition:
+            self._num_open -= 1
+            self._num_connections_discarded += 1
+            self._condition.notify()
+
+
+# backslash first, so the escapes added for the other characters are kept
+COPY_TEXT_ESCAPES = [
+    ("\\", "\\\\"),
+    ("\t", "\\t"),
+    ("\n", "\\n"),
+    ("\r", "\\r"),
+]
+
+
+def format_copy_value(value) -> str:
+    """Formats a value for COPY's text format."""
+    if value is None:
+        return "\\N"
+
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, bool):
+        value = "t" if value else "f"
+    else:
+        value = str(value)
+
+    for character, escaped in COPY_TEXT_ESCAPES:
+        value = value.replace(character, escaped)
+
+    return value
+
+
+class CopyRowsFile(object):
+    """Read only file object over an iterable of rows in COPY's text format.
+
+    Rows are formatted as they are read, so the rows are never held in
+    memory as one string.
+    """
+
+    def __init__(self, rows):
+        self._lines = (
+            "\t".join(format_copy_value(value) for value in row) + "\n"
+            for row in rows
+        )
+        self._buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+
+            self._buffer += line
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
 
 class SQLClient(object):
     def __init__(
@@ -34,6 +348,10 @@ class SQLClient(object):
         port=POSTGRES_PORT,
         database=POSTGRES_DATABASE,
         num_connection_retries=NUM_CONNECTION_RETRIES,
+        pool_min_size=POSTGRES_POOL_MIN_SIZE,
+        pool_max_size=POSTGRES_POOL_MAX_SIZE,
+        pool_checkout_timeout=POSTGRES_POOL_CHECKOUT_TIMEOUT,
+        pool_health_check_interval=POSTGRES_POOL_HEALTH_CHECK_INTERVAL,
     ):
         self._username = username
         self._password = password
@@ -41,16 +359,19 @@ class SQLClient(object):
         self._port = port
         self._database = database
         self._num_connection_retries = num_connection_retries
-        self._conn = None
-
-    def _establish_connection(self):
-        if self._conn is not None:
-            return
-
+        self._pool_min_size = pool_min_size
+        self._pool_max_size = pool_max_size
+        self._pool_checkout_timeout = pool_checkout_timeout
+        self._pool_health_check_interval = pool_health_check_interval
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _connect(self):
         for i in range(self._num_connection_retries):
             try:
                 try:
-                    self._conn = psql.connect(
+                    return psql.connect(
+                        connection_factory=PreparingConnection,
                         user=self._username,
                         password=self._password,
                         host=self._hostname,
@@ -60,135 +381,1167 @@ class SQLClient(object):
                 except (Exception, psql.DatabaseError) as error:
                     logger.error("Couldn't connect to database")
                     raise error
-                except Exception as e:
-                    raise e
             except Exception as e:
                 if i == (self._num_connection_retries - 1):
                     raise e
                 else:
                     time.sleep(1)
 
+    def _establish_connection(self):
+        if self._pool is not None:
+            return
+
+        with self._pool_lock:
+            if self._pool is not None:
+                return
+
+            pool = ConnectionPool(
+                self._connect,
+                min_size=self._pool_min_size,
+                max_size=self._pool_max_size,
+                checkout_timeout=self._pool_checkout_timeout,
+                health_check_interval=self._pool_health_check_interval,
+            )
+            pool.fill()
+            self._pool = pool
+
     def close_connection(self):
-        if self._conn is not None:
-            self._conn.close()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+    def pool_stats(self) -> dict:
+        if self._pool is None:
+            return {}
 
-    def execute(self, commands):
-        if self._conn is None:
+        return self._pool.stats()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks a connection out of the pool for the duration of the block.
+
+        The connection is rolled back if the block raises, and thrown away
+        instead of being returned to the pool if it was broken.
+        """
+        if self._pool is None:
             self._establish_connection()
 
-        cursor = None
-        result = None
+        pool = self._pool
+        conn = pool.getconn()
+        discard = False
         try:
-            cursor = self._conn.cursor()
-            if isinstance(commands, str):
-                cursor.execute(commands)
-            else:
+            yield conn
+        except (psql.OperationalError, psql.InterfaceError):
+            discard = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except psql.Error:
+                discard = True
+            raise
+        finally:
+            pool.putconn(conn, discard=discard)
+
+    def execute(self, commands, params: dict = None):
+        """Runs one command, or a list of commands in a single transaction.
+
+        Commands take psycopg2 style named parameters. A list may hold
+        plain commands or (command, params) pairs. Returns the rows of the
+        last command, or None if it returned none.
+        """
+        if isinstance(commands, str):
+            commands = [(commands, params)]
+
+        with self.connection() as conn:
+            cursor = None
+            result = None
+            try:
+                cursor = conn.cursor()
                 for command in commands:
-                    cursor.execute(command)
+                    if isinstance(command, str):
+                        cursor.execute(command)
+                    else:
+                        cursor.execute(*command)
+
+                try:
+                    result = cursor.fetchall()
+                except psql.ProgrammingError:
+                    """Happens when nothing to fetch"""
+                    pass
 
+                conn.commit()
+                return result
+
+            except psql.DatabaseError as error:
+                logger.error(
+                    "Could not complete the transaction: {}".format(commands)
+                )
+                raise error
+
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+    def copy_rows(self, table_name: str, columns: List[str], rows) -> int:
+        """Writes an iterable of rows to `table_name` with COPY FROM STDIN
+        in one transaction and returns the number of rows written.
+
+        The rows are read lazily, so `rows` may be a generator.
+        """
+        command = "COPY {} ({}) FROM STDIN".format(table_name, ", ".join(columns))
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
             try:
-                result = cursor.fetchall()
-            except psql.ProgrammingError:
-                """Happens when nothing to fetch"""
-                pass
+                cursor.copy_expert(command, CopyRowsFile(rows))
+                conn.commit()
+                return cursor.rowcount
 
-            cursor.close()
-            self._conn.commit()
-            return result
+            except psql.DatabaseError as error:
+                logger.error("Could not copy rows into {}".format(table_name))
+                raise error
 
-        except psql.DatabaseError as error:
-            logger.error(
-                "Could not complete the transaction: {}".format(commands)
-            )
-            raise error
+            finally:
+                cursor.close()
 
-        finally:
-            if cursor is not None:
+    def stream(self, command: str, params: dict = None, batch_size: int = 1000):
+        """Yields the rows of `command` in lists of at most `batch_size`.
+
+        Rows are read through a named server side cursor, so only one batch
+        is held in memory at a time. The pooled connection stays checked out
+        until the generator is exhausted or closed.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor(name="stream_{}".format(uuid.uuid4().hex))
+            cursor.itersize = batch_size
+            try:
+                cursor.execute(command, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+
+                    yield rows
+
+            except psql.DatabaseError as error:
+                logger.error(
+                    "Could not complete the streamed query: {}".format(command)
+                )
+                raise error
+
+            finally:
                 cursor.close()
-            self._conn.commit()
 
+    def execute_prepared(self, name: str, command: str, params: dict = None):
+        """Runs `command` as the server side prepared statement `name`.
+
+        The statement is prepared the first time it runs on each pooled
+        connection, after that only EXECUTE and the parameters are sent, so
+        Postgres skips parsing and planning. Prepared statements are not
+        transactional, a failed EXECUTE leaves the statement in place.
+        """
+        positional_command, names = to_positional(command)
+        execute_command = "EXECUTE {}".format(name)
+        if names:
+            execute_command += " ({})".format(
+                ", ".join("%({})s".format(param) for param in names)
+            )
+
+        with self.connection() as conn:
+            cursor = None
+            result = None
+            try:
+                cursor = conn.cursor()
+                if name not in conn.prepared_statements:
+                    cursor.execute(
+                        "PREPARE {} AS {}".format(name, positional_command)
+                    )
+                    conn.prepared_statements.add(name)
+
+                cursor.execute(execute_command, params or {})
 
-def annotation_to_sql_values(annotation: models.Annotation):
+                try:
+                    result = cursor.fetchall()
+                except psql.ProgrammingError:
+                    """Happens when nothing to fetch"""
+                    pass
+
+                conn.commit()
+                return result
+
+            except psql.DatabaseError as error:
+                logger.error(
+                    "Could not complete prepared statement {}: {}".format(
+                        name, params
+                    )
+                )
+                raise error
+
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+
+def annotation_to_sql_params(annotation: models.Annotation) -> dict:
     if isinstance(annotation, models.AnnotationPlayerBboxes):
-        init_string = ""
-        for i, bbox in enumerate(annotation.bboxes):
-            if i > 0:
-                init_string += ",\n"
-
-            init_string += "('{img_id}', '{bbox}'{player_id})".format(
-                img_id=annotation.img_id,
-                bbox=(
-                    (bbox.x1, bbox.y1),
-                    (bbox.x2, bbox.y2),
-                ),
-                player_id=", {}".format("'{}'".format(bbox.player_id if bbox.player_id else "NULL"))
+        return {
+            "bboxes": [
+                "(({}, {}), ({}, {}))".format(bbox.x1, bbox.y1, bbox.x2, bbox.y2)
+                for bbox in annotation.bboxes
+            ],
+            "player_ids": [bbox.player_id for bbox in annotation.bboxes],
+        }
+
+    elif isinstance(annotation, models.AnnotationFieldLines):
+        return {
+            "line_coords": [
+                "(({}, {}), ({}, {}))".format(
+                    coords.x1, coords.y1, coords.x2, coords.y2
+                )
+                for coords in annotation.line_coords
+            ],
+            "line_types": [coords.line_id.name for coords in annotation.line_coords],
+        }
+
+    elif isinstance(annotation, models.AnnotationCameraAngle):
+        return {"is_valid": annotation.is_valid}
+
+
+GET_USER_COMMAND = """
+SELECT {columns}
+FROM {table}
+WHERE 1=1
+    AND username = %(username)s
+""".format(
+    columns=", ".join(sql_models.TableUsers.columns),
+    table=sql_models.TableUsers.full_name,
+)
+
+
+GET_GAME_COMMAND = """
+SELECT {columns}
+FROM {table_name} games
+JOIN {authorization_name} auth
+    ON games.game_id = auth.game_id
+WHERE 1=1
+    AND games.game_id = %(game_id)s
+    AND auth.user_id = %(user_id)s
+""".format(
+    columns=", ".join([
+        "games.{}".format(col) 
+        for col in sql_models.TableGameMetadata.columns
+    ]),
+    table_name=sql_models.TableGameMetadata.full_name,
+    authorization_name=sql_models.TableAuthorizationScheme.full_name,
+)
+
+
+# keyset pagination, the cursor holds the sort key of the last game of the
+# previous page and the page is read one row past `limit` to tell whether
+# there is a next one
+GET_GAME_LIST_COMMANDS = {
+    models.GameListOrder.game_id: """
+    SELECT {columns}
+    FROM {table_name} games
+    JOIN {authorization_name} auth
+        ON games.game_id = auth.game_id
+    WHERE 1=1
+        AND auth.user_id = %(user_id)s
+        AND games.data @> %(filters)s::jsonb
+        AND (
+            %(after_game_id)s::text IS NULL
+            OR games.game_id > %(after_game_id)s::text
+        )
+    ORDER BY games.game_id
+    LIMIT %(limit)s
+    """,
+    models.GameListOrder.date: """
+    SELECT {columns}
+    FROM {table_name} games
+    JOIN {authorization_name} auth
+        ON games.game_id = auth.game_id
+    WHERE 1=1
+        AND auth.user_id = %(user_id)s
+        AND games.data @> %(filters)s::jsonb
+        AND (
+            %(after_game_id)s::text IS NULL
+            OR (COALESCE(games.data->>'date', ''), games.game_id)
+                > (%(after_date)s::text, %(after_game_id)s::text)
+        )
+    ORDER BY COALESCE(games.data->>'date', ''), games.game_id
+    LIMIT %(limit)s
+    """,
+}
+GET_GAME_LIST_COMMANDS = {
+    order: command.format(
+        columns=", ".join([
+            "games.{}".format(col) 
+            for col in sql_models.TableGameMetadata.columns
+        ]),
+        table_name=sql_models.TableGameMetadata.full_name,
+        authorization_name=sql_models.TableAuthorizationScheme.full_name,
+    )
+    for order, command in GET_GAME_LIST_COMMANDS.items()
+}
+
+
+INSERT_ANNOTATION_TRANSACTION_COMMAND = """
+INSERT INTO {table_name} ({table_columns})
+VALUES (
+    %(img_id)s,
+    %(timestamp)s,
+    %(table_ref)s::annotation_table,
+    %(action)s::annotation_action
+)
+""".format(
+    table_name=sql_models.TableAnnotationTransaction.full_name,
+    table_columns=", ".join(sql_models.TableAnnotationTransaction.columns),
+)
+
+
+UPSERT_ANNOTATION_STATUS_COMMAND = """
+INSERT INTO {table_name} ({table_columns})
+VALUES (
+    %(img_id)s,
+    %(table_ref)s::annotation_table,
+    %(action)s::annotation_action,
+    NULL,
+    %(timestamp)s
+)
+ON CONFLICT (img_id, table_ref) DO UPDATE
+SET
+    status = EXCLUDED.status,
+    lease_expiration = EXCLUDED.lease_expiration,
+    updated_at = EXCLUDED.updated_at
+""".format(
+    table_name=sql_models.TableAnnotationStatus.full_name,
+    table_columns=", ".join(sql_models.TableAnnotationStatus.columns),
+)
+
+
+# records the submission in the history and the current status in one
+# statement
+SUBMIT_ANNOTATION_COMMAND = """
+WITH insert_annotation_transaction AS (
+    {annotation_transaction_insert}
+)
+{annotation_status_upsert}
+""".format(
+    annotation_transaction_insert=INSERT_ANNOTATION_TRANSACTION_COMMAND,
+    annotation_status_upsert=UPSERT_ANNOTATION_STATUS_COMMAND,
+)
+
+
+# the annotation inserts take one array per column so that a single prepared
+# statement covers any number of rows
+INSERT_ANNOTATION_COMMANDS = {
+    models.AnnotationTable.player_bbox: """
+    INSERT INTO {table_name} (img_id, bbox, player_id)
+    SELECT %(img_id)s, bbox, player_id
+    FROM unnest(
+        %(bboxes)s::text[]::box[],
+        %(player_ids)s::text[]
+    ) AS annotations(bbox, player_id)
+    """.format(
+        table_name=sql_models.TablePlayerBbox.full_name,
+    ),
+    models.AnnotationTable.field_lines: """
+    INSERT INTO {table_name} (img_id, line_coords, line_type)
+    SELECT %(img_id)s, line_coords, line_type
+    FROM unnest(
+        %(line_coords)s::text[]::lseg[],
+        %(line_types)s::text[]::line_id[]
+    ) AS annotations(line_coords, line_type)
+    """.format(
+        table_name=sql_models.TableFieldLines.full_name,
+    ),
+    models.AnnotationTable.camera_angle: """
+    INSERT INTO {table_name} (img_id, is_valid)
+    VALUES (%(img_id)s, %(is_valid)s)
+    """.format(
+        table_name=sql_models.TableCameraAngle.full_name,
+    ),
+}
+INSERT_ANNOTATION_COMMANDS = {
+    annotation_table: """
+    WITH insert_annotation_transaction AS (
+        {annotation_transaction_insert}
+    ),
+    upsert_annotation_status AS (
+        {annotation_status_upsert}
+    )
+    {annotation_insert}
+    """.format(
+        annotation_transaction_insert=INSERT_ANNOTATION_TRANSACTION_COMMAND,
+        annotation_status_upsert=UPSERT_ANNOTATION_STATUS_COMMAND,
+        annotation_insert=command,
+    )
+    for annotation_table, command in INSERT_ANNOTATION_COMMANDS.items()
+}
+
+
+# A batch of submissions is written with one multi row statement per table.
+# Every statement joins img_location so that items with an unknown img_id
+# are skipped instead of failing the whole transaction, and resubmissions
+# replace the stored camera angle or field line instead of violating their
+# primary keys.
+BATCH_INSERT_ANNOTATION_TRANSACTION_COMMAND = """
+INSERT INTO {table_name} ({table_columns})
+SELECT
+    T.img_id,
+    %(timestamp)s::timestamp,
+    T.table_ref::annotation_table,
+    'submitted'::annotation_action
+FROM unnest(
+    %(img_ids)s::text[],
+    %(table_refs)s::text[]
+) AS T(img_id, table_ref)
+JOIN {img_location_name} L ON L.img_id = T.img_id
+ON CONFLICT DO NOTHING
+""".format(
+    table_name=sql_models.TableAnnotationTransaction.full_name,
+    table_columns=", ".join(sql_models.TableAnnotationTransaction.columns),
+    img_location_name=sql_models.TableImgLocation.full_name,
+)
+
+
+BATCH_UPSERT_ANNOTATION_STATUS_COMMAND = """
+INSERT INTO {table_name} ({table_columns})
+SELECT
+    T.img_id,
+    T.table_ref::annotation_table,
+    'submitted'::annotation_action,
+    NULL::timestamp,
+    %(timestamp)s::timestamp
+FROM unnest(
+    %(img_ids)s::text[],
+    %(table_refs)s::text[]
+) AS T(img_id, table_ref)
+JOIN {img_location_name} L ON L.img_id = T.img_id
+ON CONFLICT (img_id, table_ref) DO UPDATE
+SET
+    status = EXCLUDED.status,
+    lease_expiration = EXCLUDED.lease_expiration,
+    updated_at = EXCLUDED.updated_at
+""".format(
+    table_name=sql_models.TableAnnotationStatus.full_name,
+    table_columns=", ".join(sql_models.TableAnnotationStatus.columns),
+    img_location_name=sql_models.TableImgLocation.full_name,
+)
+
+
+BATCH_INSERT_ANNOTATION_COMMANDS = {
+    models.AnnotationTable.player_bbox: """
+    INSERT INTO {table_name} (img_id, bbox, player_id)
+    SELECT T.img_id, T.bbox, T.player_id
+    FROM unnest(
+        %(img_ids)s::text[],
+        %(bboxes)s::text[]::box[],
+        %(player_ids)s::text[]
+    ) AS T(img_id, bbox, player_id)
+    JOIN {img_location_name} L ON L.img_id = T.img_id
+    """.format(
+        table_name=sql_models.TablePlayerBbox.full_name,
+        img_location_name=sql_models.TableImgLocation.full_name,
+    ),
+    models.AnnotationTable.field_lines: """
+    INSERT INTO {table_name} (img_id, line_coords, line_type)
+    SELECT T.img_id, T.line_coords, T.line_type
+    FROM unnest(
+        %(img_ids)s::text[],
+        %(line_coords)s::text[]::lseg[],
+        %(line_types)s::text[]::line_id[]
+    ) AS T(img_id, line_coords, line_type)
+    JOIN {img_location_name} L ON L.img_id = T.img_id
+    ON CONFLICT (img_id, line_type) DO UPDATE
+    SET line_coords = EXCLUDED.line_coords
+    """.format(
+        table_name=sql_models.TableFieldLines.full_name,
+        img_location_name=sql_models.TableImgLocation.full_name,
+    ),
+    models.AnnotationTable.camera_angle: """
+    INSERT INTO {table_name} (img_id, is_valid)
+    SELECT T.img_id, T.is_valid
+    FROM unnest(
+        %(img_ids)s::text[],
+        %(is_valids)s::boolean[]
+    ) AS T(img_id, is_valid)
+    JOIN {img_location_name} L ON L.img_id = T.img_id
+    ON CONFLICT (img_id) DO UPDATE
+    SET is_valid = EXCLUDED.is_valid
+    """.format(
+        table_name=sql_models.TableCameraAngle.full_name,
+        img_location_name=sql_models.TableImgLocation.full_name,
+    ),
+}
+
+
+BATCH_FIND_IMAGES_COMMAND = """
+SELECT img_id
+FROM {table_name}
+WHERE img_id = ANY(%(img_ids)s::text[])
+""".format(table_name=sql_models.TableImgLocation.full_name)
+
+
+ANNOTATION_TYPES = {
+    models.AnnotationTable.player_bbox: models.AnnotationPlayerBboxes,
+    models.AnnotationTable.field_lines: models.AnnotationFieldLines,
+    models.AnnotationTable.camera_angle: models.AnnotationCameraAngle,
+}
+
+
+DISABLE_USER_COMMAND = """
+UPDATE {table}
+SET disabled = true
+WHERE username = %(username)s
+""".format(table=sql_models.TableUsers.full_name)
+
+
+def parse_user_row(result, username: str):
+    if len(result) == 1:
+        return dict(zip(sql_models.TableUsers.columns, result[0]))
+    elif len(result) > 1:
+        logger.error(
+            "SQLBackend.get_user returns multiple "
+            "results for username: {}".format(username)
+        )
+        return dict(zip(sql_models.TableUsers.columns, result[0]))
+    else:
+        return None
+
+
+def user_from_row(row: dict, include_password: bool = False):
+    if row is None:
+        return None
+
+    if include_password:
+        return models.UserInDBwPass(**row)
+    else:
+        return models.UserInDB(**row)
+
+
+def add_user_command(user: models.User, user_id: str, salted_password: str):
+    command = """
+    INSERT INTO {table_name} ({table_columns})
+    VALUES ({table_values})
+    """.format(
+        table_name=sql_models.TableUsers.full_name,
+        table_columns=", ".join(sql_models.TableUsers.columns),
+        table_values=", ".join(
+            "%({})s".format(col) for col in sql_models.TableUsers.columns
+        ),
+    )
+
+    params = {
+        "user_id": user_id,
+        "username": user.username,
+        "email": user.email,
+        "full_name": user.full_name,
+        "salted_password": salted_password,
+        "disabled": user.disabled,
+    }
+
+    return command, params
+
+
+def parse_game(result, game_id: str) -> models.GameResponse:
+    if len(result) == 1:
+        return models.GameResponse(
+            **dict(zip(sql_models.TableGameMetadata.columns, result[0]))
+        )
+    elif len(result) > 1:
+        logger.error(
+            "SQLBackend.get_game returns multiple results "
+            "for game_id: {}".format(game_id)
+        )
+        return models.GameResponse(
+            **dict(zip(sql_models.TableGameMetadata.columns, result[0]))
+        )
+    else:
+        return None
+
+
+def encode_cursor(values: list) -> str:
+    """Opaque pagination cursor holding the sort key of the last row."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, num_values: int) -> list:
+    """Inverse of `encode_cursor`, raises ValueError for a malformed cursor."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+
+    if not isinstance(values, list) or len(values) != num_values:
+        raise ValueError("Invalid cursor: {}".format(cursor))
+
+    return values
+
+
+def get_game_list_statement(
+    user_id: str,
+    limit: int = GAME_LIST_DEFAULT_LIMIT,
+    cursor: str = None,
+    order_by: models.GameListOrder = models.GameListOrder.game_id,
+    filters: dict = None,
+):
+    """Returns the prepared statement name, command and parameters for one
+    page of the games `user_id` is authorized for.
+
+    `filters` is matched against the game's data by jsonb containment.
+    """
+    params = {
+        "user_id": user_id,
+        "filters": filters or {},
+        "after_game_id": None,
+        "limit": limit + 1,
+    }
+
+    if order_by == models.GameListOrder.date:
+        params["after_date"] = None
+        if cursor is not None:
+            params["after_date"], params["after_game_id"] = decode_cursor(cursor, 2)
+
+    elif cursor is not None:
+        params["after_game_id"], = decode_cursor(cursor, 1)
+
+    return (
+        "get_game_list_by_{}".format(order_by.name),
+        GET_GAME_LIST_COMMANDS[order_by],
+        params,
+    )
+
+
+def parse_game_list(
+    result,
+    limit: int = None,
+    order_by: models.GameListOrder = models.GameListOrder.game_id,
+) -> models.GameListResponse:
+    # sign every url of the list in one batch, the responses below then
+    # only hit the presigned url cache
+    games = [dict(zip(sql_models.TableGameMetadata.columns, game)) for game in result]
+
+    next_cursor = None
+    if limit is not None and len(games) > limit:
+        games = games[:limit]
+        last_game = games[-1]
+        if order_by == models.GameListOrder.date:
+            next_cursor = encode_cursor(
+                [last_game["data"].get("date") or "", last_game["game_id"]]
             )
+        else:
+            next_cursor = encode_cursor([last_game["game_id"]])
+
+    get_presigner().get_urls([
+        request
+        for game in games
+        if len(game["data"]) != 0
+        for request in models.GameResponse.presign_requests(
+            game["data"], game["thumbnail_key"], game["video_key"]
+        )
+    ])
+
+    return models.GameListResponse(
+        game_list=[models.GameResponse(**game) for game in games],
+        next_cursor=next_cursor,
+    )
+
+
+def add_game_commands(
+    game_id: str,
+    user_id: str,
+    data: dict,
+    thumbnail_key: str,
+    video_key: str,
+):
+    game_command = """
+    INSERT INTO {table_name} ({table_columns})
+    VALUES (%(game_id)s, %(data)s::jsonb, %(thumbnail_key)s, %(video_key)s)
+    """.format(
+        table_name=sql_models.TableGameMetadata.full_name,
+        table_columns=", ".join(sql_models.TableGameMetadata.columns),
+    )
+
+    auth_command = """
+    INSERT INTO {table_name} ({table_columns})
+    VALUES (%(game_id)s, %(user_id)s)
+    """.format(
+        table_name=sql_models.TableAuthorizationScheme.full_name,
+        table_columns=", ".join(sql_models.TableAuthorizationScheme.columns),
+    )
+
+    return [
+        (
+            game_command,
+            {
+                "game_id": game_id,
+                "data": data,
+                "thumbnail_key": thumbnail_key,
+                "video_key": video_key,
+            },
+        ),
+        (auth_command, {"game_id": game_id, "user_id": user_id}),
+    ]
+
+
+# merges `data` into a game's data, keys of `data` win
+UPDATE_GAME_DATA_COMMAND = """
+UPDATE {table_name}
+SET data = data || %(data)s::jsonb
+WHERE game_id = %(game_id)s
+""".format(table_name=sql_models.TableGameMetadata.full_name)
+
+
+# a fully ingested game whose video has the same content, served by the
+# GIN index on data
+FIND_INGESTED_GAME_COMMAND = """
+SELECT {columns}
+FROM {table_name}
+WHERE data @> %(query)s::jsonb
+LIMIT 1
+""".format(
+    columns=", ".join(sql_models.TableGameMetadata.columns),
+    table_name=sql_models.TableGameMetadata.full_name,
+)
 
-        return init_string
 
-    elif isinstance(annotation, models.AnnotationFieldLines):
-        values = [
-            "('{img_id}', '{line_coords}', '{line_type}')".format(
-                img_id=annotation.img_id,
-                line_coords=(
-                    (coords.x1, coords.y1),
-                    (coords.x2, coords.y2),
-                ),
-                line_type=coords.line_id.name,
+# the copies point at the same frames in S3, their ids are derived from the
+# source image and the new game so copying twice cannot duplicate them
+COPY_GAME_IMAGES_COMMAND = """
+INSERT INTO {table_name} (img_id, img_raw_path, img_type, img_metadata, game_id, frame_number)
+SELECT
+    md5(img_id || %(game_id)s),
+    img_raw_path,
+    img_type,
+    img_metadata,
+    %(game_id)s,
+    frame_number
+FROM {table_name}
+WHERE game_id = %(source_game_id)s
+ON CONFLICT (img_id) DO NOTHING
+""".format(table_name=sql_models.TableImgLocation.full_name)
+
+
+def find_ingested_game_command(content_sha256: str):
+    return FIND_INGESTED_GAME_COMMAND, {
+        "query": {"content_sha256": content_sha256, "ingest_complete": True},
+    }
+
+
+def parse_ingested_game(result) -> dict:
+    if not result:
+        return None
+
+    return dict(zip(sql_models.TableGameMetadata.columns, result[0]))
+
+
+def add_deduplicated_game_commands(
+    game_id: str,
+    user_id: str,
+    data: dict,
+    source_game: dict,
+):
+    """Commands that add a game sharing the video, thumbnail and frames of
+    the already ingested `source_game`."""
+    data = dict(data)
+    for key in ["length", "content_sha256", "ingest_complete"]:
+        if key in source_game["data"]:
+            data[key] = source_game["data"][key]
+
+    data["deduplicated_from"] = source_game["game_id"]
+
+    return add_game_commands(
+        game_id,
+        user_id,
+        data,
+        source_game["thumbnail_key"],
+        source_game["video_key"],
+    ) + [
+        (
+            COPY_GAME_IMAGES_COMMAND,
+            {"game_id": game_id, "source_game_id": source_game["game_id"]},
+        ),
+    ]
+
+
+def get_annotation_table(annotation_table: models.AnnotationTable) -> models.Table:
+    if annotation_table == models.AnnotationTable.player_bbox:
+        return sql_models.TablePlayerBbox
+
+    elif annotation_table == models.AnnotationTable.field_lines:
+        return sql_models.TableFieldLines
+
+    elif annotation_table == models.AnnotationTable.camera_angle:
+        return sql_models.TableCameraAngle
+
+    else:
+        raise ValueError("Invalid annotation_table: {}".format(annotation_table))
+
+
+def insert_annotation_statement(
+    img_id: str,
+    annotation_table: models.AnnotationTable,
+    annotation_data: Union[models.AnnotationPlayerBboxes, models.AnnotationFieldLines, models.AnnotationCameraAngle]
+):
+    """Returns the prepared statement name, command and parameters that
+    record the submitted annotation."""
+    table = get_annotation_table(annotation_table)
+
+    params = {
+        "img_id": img_id,
+        "timestamp": datetime.datetime.utcnow(),
+        "table_ref": table.table_name,
+        "action": models.AnnotationAction.submitted.name,
+    }
+
+    is_empty = (
+        annotation_table == models.AnnotationTable.player_bbox
+        and len(annotation_data.bboxes) == 0
+    )
+
+    if is_empty:
+        return (
+            "submit_annotation",
+            SUBMIT_ANNOTATION_COMMAND,
+            params,
+        )
+
+    params.update(annotation_to_sql_params(annotation_data))
+
+    return (
+        "insert_{}".format(table.table_name),
+        INSERT_ANNOTATION_COMMANDS[annotation_table],
+        params,
+    )
+
+
+def insert_annotation_batch_commands(items: List[models.AnnotationBatchItem]):
+    """Returns the commands that write a batch of annotations in a single
+    transaction and the errors of the items rejected up front, by index.
+
+    Items are rejected up front if their table is invalid or does not match
+    the annotation, if they repeat an earlier item's image and table, or if
+    they contain the same field line twice. Everything else either conflicts
+    with nothing or replaces the stored annotation, so the transaction does
+    not fail on existing data.
+
+    The last command returns the img_ids that exist, items whose img_id is
+    missing from it were skipped by the inserts.
+    """
+    errors = {}
+    seen = {}
+    valid_items = []
+    for i, item in enumerate(items):
+        if item.annotation_table not in models.AnnotationTable.__members__:
+            errors[i] = "Invalid annotation_table: {}".format(item.annotation_table)
+            continue
+
+        annotation_table = models.AnnotationTable[item.annotation_table]
+        if not isinstance(item.annotation, ANNOTATION_TYPES[annotation_table]):
+            errors[i] = "Annotation does not match annotation_table: {}".format(
+                item.annotation_table
             )
-            for coords in annotation.line_coords
-        ]
+            continue
 
-        values_string = ""
-        for i, value in enumerate(values):
-            if i > 0:
-                values_string += ", "
-            
-            values_string += value
+        # a second submission of the same image and table at the same
+        # timestamp would violate the transaction primary key
+        if (item.img_id, annotation_table) in seen:
+            errors[i] = "Duplicate of item {}".format(
+                seen[(item.img_id, annotation_table)]
+            )
+            continue
+
+        # an upsert cannot touch the same field line twice in one statement
+        if annotation_table == models.AnnotationTable.field_lines:
+            line_ids = [coords.line_id.name for coords in item.annotation.line_coords]
+            duplicate_line_ids = sorted(set(
+                line_id for line_id in line_ids if line_ids.count(line_id) > 1
+            ))
+            if duplicate_line_ids:
+                errors[i] = "Duplicate line_type: {}".format(", ".join(duplicate_line_ids))
+                continue
+
+        seen[(item.img_id, annotation_table)] = i
+        valid_items.append((item, annotation_table))
+
+    if not valid_items:
+        return [], errors
+
+    img_ids = [item.img_id for item, _ in valid_items]
+    timestamp = datetime.datetime.utcnow()
+
+    rows = {
+        annotation_table: collections.defaultdict(list)
+        for annotation_table in models.AnnotationTable
+    }
+    for item, annotation_table in valid_items:
+        table_rows = rows[annotation_table]
+        params = annotation_to_sql_params(item.annotation)
+        num_rows = 1
+        for key, value in params.items():
+            if isinstance(value, list):
+                num_rows = len(value)
+                table_rows[key] += value
+            else:
+                table_rows[key].append(value)
+
+        table_rows["img_ids"] += [item.img_id] * num_rows
+
+    commands = [
+        (
+            BATCH_INSERT_ANNOTATION_TRANSACTION_COMMAND,
+            {
+                "img_ids": img_ids,
+                "table_refs": [annotation_table.name for _, annotation_table in valid_items],
+                "timestamp": timestamp,
+            },
+        ),
+        (
+            BATCH_UPSERT_ANNOTATION_STATUS_COMMAND,
+            {
+                "img_ids": img_ids,
+                "table_refs": [annotation_table.name for _, annotation_table in valid_items],
+                "timestamp": timestamp,
+            },
+        ),
+    ]
+
+    for annotation_table, table_rows in rows.items():
+        if table_rows["img_ids"]:
+            params = dict(table_rows)
+            if annotation_table == models.AnnotationTable.camera_angle:
+                params["is_valids"] = params.pop("is_valid")
+
+            commands.append(
+                (BATCH_INSERT_ANNOTATION_COMMANDS[annotation_table], params)
+            )
 
-        return values_string
+    commands.append((BATCH_FIND_IMAGES_COMMAND, {"img_ids": img_ids}))
 
-    elif isinstance(annotation, models.AnnotationCameraAngle):
-        return "('{img_id}', '{is_valid}')".format(
-            img_id=annotation.img_id, is_valid=annotation.is_valid
+    return commands, errors
+
+
+def parse_annotation_batch(
+    items: List[models.AnnotationBatchItem],
+    errors: dict,
+    found_img_ids,
+    elapsed_seconds: float,
+) -> models.AnnotationBatchResponse:
+    found_img_ids = set(row[0] for row in (found_img_ids or []))
+
+    results = []
+    for i, item in enumerate(items):
+        error = errors.get(i)
+        if error is None and item.img_id not in found_img_ids:
+            error = "Unknown img_id: {}".format(item.img_id)
+
+        results.append(models.AnnotationBatchItemResult(
+            img_id=item.img_id,
+            annotation_table=item.annotation_table,
+            inserted=error is None,
+            error=error,
+        ))
+
+    num_inserted = sum(result.inserted for result in results)
+    logger.info(
+        "Inserted {} of {} annotations in {:.3f}s".format(
+            num_inserted, len(items), elapsed_seconds
+        )
+    )
+
+    return models.AnnotationBatchResponse(
+        results=results,
+        num_inserted=num_inserted,
+        elapsed_seconds=elapsed_seconds,
+        items_per_second=(
+            len(items) / elapsed_seconds if elapsed_seconds > 0 else 0.0
+        ),
+    )
+
+
+def get_annotations_command(table: models.AnnotationTable) -> str:
+    table_instance = sql_models.match_table_from_string(
+        table.name,
+        sql_models.DatabaseUltitracker
+    )
+
+    return textwrap.dedent(
+        f"""
+        SELECT * FROM {table_instance.full_name}
+        """
+    )
+
+
+def stream_annotations_command(table: models.AnnotationTable):
+    table_instance = sql_models.match_table_from_string(
+        table.name,
+        sql_models.DatabaseUltitracker
+    )
+
+    command = textwrap.dedent(
+        f"""
+        SELECT {", ".join(table_instance.columns)}
+        FROM {table_instance.full_name}
+        """
+    )
+
+    return command, table_instance.columns
+
+
+def rows_to_ndjson(columns: List[str], rows) -> bytes:
+    """Encodes rows as newline delimited json objects keyed by column."""
+    return "".join(
+        json.dumps(dict(zip(columns, row)), default=str) + "\n"
+        for row in rows
+    ).encode()
+
+
+def get_image_path_command(img_id: str):
+    command = textwrap.dedent(
+        f"""
+        SELECT img_raw_path FROM {sql_models.TableImgLocation.full_name}
+        WHERE img_id = %(img_id)s
+        """
+    )
+
+    return command, {"img_id": img_id}
+
+
+# img_query and game_query are matched by containment so the GIN indexes on
+# img_metadata and game data can be used, pages are keyset paginated on
+# img_id
+QUERY_IMAGES_COMMAND = """
+SELECT {columns}, gm.data
+FROM {img_location_name} il
+JOIN {game_metadata_name} gm ON il.game_id = gm.game_id
+WHERE 1=1
+    AND il.img_metadata @> %(img_query)s::jsonb
+    AND gm.data @> %(game_query)s::jsonb
+    {legacy_conditions}
+    AND (
+        %(after_img_id)s::text IS NULL
+        OR il.img_id > %(after_img_id)s::text
+    )
+ORDER BY il.img_id
+LIMIT %(limit)s
+"""
+
+
+COUNT_IMAGES_COMMAND = """
+SELECT COUNT(*)
+FROM {img_location_name} il
+JOIN {game_metadata_name} gm ON il.game_id = gm.game_id
+WHERE 1=1
+    AND il.img_metadata @> %(img_query)s::jsonb
+    AND gm.data @> %(game_query)s::jsonb
+    {legacy_conditions}
+"""
+
+
+def legacy_query_conditions(query: dict):
+    """Conditions of the original `query` parameter: every key has to match
+    as text in either the image metadata or the game data. Each key needs
+    both tables, so these cannot use the indexes."""
+    conditions = ""
+    params = {}
+    for i, (k, v) in enumerate((query or {}).items()):
+        conditions += (
+            f" AND (il.img_metadata->>%(key_{i})s = %(value_{i})s"
+            f" OR gm.data->>%(key_{i})s = %(value_{i})s)"
         )
+        params[f"key_{i}"] = k
+        params[f"value_{i}"] = str(v)
+
+    return conditions, params
+
+
+def query_images_command(
+    query: dict = None,
+    img_query: dict = None,
+    game_query: dict = None,
+    limit: int = QUERY_IMAGES_DEFAULT_LIMIT,
+    cursor: str = None,
+    count_only: bool = False,
+):
+    """Returns the command and parameters of one page of an image query, or
+    of the number of matching images if `count_only`.
+
+    Raises ValueError for a malformed cursor.
+    """
+    legacy_conditions, params = legacy_query_conditions(query)
+    params.update({
+        "img_query": img_query or {},
+        "game_query": game_query or {},
+    })
+
+    format_params = {
+        "columns": ", ".join([
+            "il.{}".format(col) for col in sql_models.TableImgLocation.columns
+        ]),
+        "img_location_name": sql_models.TableImgLocation.full_name,
+        "game_metadata_name": sql_models.TableGameMetadata.full_name,
+        "legacy_conditions": legacy_conditions,
+    }
+
+    if count_only:
+        return COUNT_IMAGES_COMMAND.format(**format_params), params
+
+    params.update({
+        "after_img_id": decode_cursor(cursor, 1)[0] if cursor else None,
+        # one past the page to tell whether there is a next one
+        "limit": limit + 1,
+    })
+
+    return QUERY_IMAGES_COMMAND.format(**format_params), params
+
+
+def parse_query_images(
+    result,
+    limit: int = None,
+    count_only: bool = False,
+) -> models.ImageQueryResponse:
+    if count_only:
+        return models.ImageQueryResponse(count=result[0][0])
+
+    keys = sql_models.TableImgLocation.columns + ["data"]
+    images = [
+        {k: v for k, v in zip(keys, line)}
+        for line in result
+    ]
+
+    next_cursor = None
+    if limit is not None and len(images) > limit:
+        images = images[:limit]
+        next_cursor = encode_cursor([images[-1]["img_id"]])
+
+    return models.ImageQueryResponse(images=images, next_cursor=next_cursor)
 
 
 class SQLBackend(backend.Backend):
-    def __init__(self, client: SQLClient):
+    def __init__(self, client: SQLClient, user_cache: cache.TTLCache = None):
         self.client = client
+        # rows of ultitracker.users by username, a cached row lives at most
+        # the cache ttl in processes that did not change it themselves
+        self.user_cache = user_cache if user_cache is not None else cache.TTLCache()
 
     def get_user(
         self, username: str, include_password: bool = False
     ) -> models.UserInDB:
-        command = """
-        SELECT {columns}
-        FROM {table}
-        WHERE 1=1
-            AND username='{username}'
-        """.format(
-            columns=", ".join(sql_models.TableUsers.columns),
-            table=sql_models.TableUsers.full_name,
-            username=username,
-        )
-
-        result = self.client.execute(command)
-        logger.debug("SQLBackend.get_user result: {}".format(result))
-        if include_password:
-            model = models.UserInDBwPass
-        else:
-            model = models.UserInDB
-
-        if len(result) == 1:
-            return model(**dict(zip(sql_models.TableUsers.columns, result[0])))
-        elif len(result) > 1:
-            logger.error(
-                "SQLBackend.get_user returns multiple "
-                "results for username: {}".format(username)
+        row = self.user_cache.get(username)
+        if row is None:
+            result = self.client.execute_prepared(
+                "get_user", GET_USER_COMMAND, {"username": username}
             )
-            return model(**dict(zip(sql_models.TableUsers.columns, result[0])))
-        else:
-            return None
+            logger.debug("SQLBackend.get_user result: {}".format(result))
+
+            row = parse_user_row(result, username)
+            if row is not None:
+                self.user_cache.set(username, row)
+
+        return user_from_row(row, include_password=include_password)
 
     def add_user(self, user: models.User, salted_password: str) -> bool:
         if self.get_user(user.username):
@@ -197,29 +1550,18 @@ class SQLBackend(backend.Backend):
         user.disabled = False
         user_id = str(uuid.uuid4())
 
-        command = """
-        INSERT INTO {table_name} {table_columns}
-        VALUES {table_values}
-        """.format(
-            table_name=sql_models.TableUsers.full_name,
-            table_columns="(" + ", ".join(sql_models.TableUsers.columns) + ")",
-            table_values=tuple(
-                [
-                    user_id,
-                    user.username,
-                    user.email,
-                    user.full_name,
-                    salted_password,
-                    user.disabled,
-                ]
-            ),
+        result = self.client.execute(
+            *add_user_command(user, user_id, salted_password)
         )
-
-        result = self.client.execute(command)
         logger.debug("SQLBackend.add_user result: {}".format(result))
+        self.user_cache.invalidate(user.username)
 
         return True
 
+    def disable_user(self, username: str):
+        self.client.execute(DISABLE_USER_COMMAND, {"username": username})
+        self.user_cache.invalidate(username)
+
     def username_exists(self, username: str) -> bool:
         if self.get_user(username) is not None:
             return True
@@ -227,72 +1569,38 @@ class SQLBackend(backend.Backend):
             return False
 
     def get_game(self, game_id: str, user: models.User) -> models.GameResponse:
-        command = """
-        SELECT {columns}
-        FROM {table_name} games
-        JOIN {authorization_name} auth
-            ON games.game_id = auth.game_id
-        WHERE 1=1
-            AND games.game_id='{game_id}'
-            AND auth.user_id='{user_id}'
-        """.format(
-            columns=", ".join([
-                "games.{}".format(col) 
-                for col in sql_models.TableGameMetadata.columns
-            ]),
-            table_name=sql_models.TableGameMetadata.full_name,
-            authorization_name=sql_models.TableAuthorizationScheme.full_name,
-            game_id=game_id,
-            user_id=self.get_user(user.username).user_id,
+        result = self.client.execute_prepared(
+            "get_game",
+            GET_GAME_COMMAND,
+            {
+                "game_id": game_id,
+                "user_id": self.get_user(user.username).user_id,
+            },
         )
-
-        result = self.client.execute(command)
         logger.debug("SQLBackend.get_game result: {}".format(result))
 
-        if len(result) == 1:
-            return models.GameResponse(
-                **dict(zip(sql_models.TableGameMetadata.columns, result[0]))
-            )
-        elif len(result) > 1:
-            logger.error(
-                "SQLBackend.get_game returns multiple results "
-                "for game_id: {}".format(game_id)
-            )
-            return models.GameResponse(
-                **dict(zip(sql_models.TableGameMetadata.columns, result[0]))
-            )
-        else:
-            return None
+        return parse_game(result, game_id)
 
-    def get_game_list(self, user: models.User) -> models.GameListResponse:
-        command = """
-        SELECT {columns}
-        FROM {table_name} games
-        JOIN {authorization_name} auth
-            ON games.game_id = auth.game_id
-        WHERE 1=1
-            AND auth.user_id='{user_id}'
-        """.format(
-            columns=", ".join([
-                "games.{}".format(col) 
-                for col in sql_models.TableGameMetadata.columns
-            ]),
-            table_name=sql_models.TableGameMetadata.full_name,
-            authorization_name=sql_models.TableAuthorizationScheme.full_name,
-            user_id=self.get_user(user.username).user_id,
+    def get_game_list(
+        self,
+        user: models.User,
+        limit: int = GAME_LIST_DEFAULT_LIMIT,
+        cursor: str = None,
+        order_by: models.GameListOrder = models.GameListOrder.game_id,
+        filters: dict = None,
+    ) -> models.GameListResponse:
+        result = self.client.execute_prepared(
+            *get_game_list_statement(
+                self.get_user(user.username).user_id,
+                limit=limit,
+                cursor=cursor,
+                order_by=order_by,
+                filters=filters,
+            )
         )
-
-        result = self.client.execute(command)
         logger.debug("SQLBackend.get_game result: {}".format(result))
 
-        return models.GameListResponse(
-            game_list=[
-                models.GameResponse(
-                    **dict(zip(sql_models.TableGameMetadata.columns, game))
-                )
-                for game in result
-            ]
-        )
+        return parse_game_list(result, limit=limit, order_by=order_by)
 
     def add_game(
         self,
@@ -303,165 +1611,134 @@ class SQLBackend(backend.Backend):
         thumbnail_key: str = "",
         video_key: str = "",
     ) -> bool:
-        game_command = """
-        INSERT INTO {table_name} {table_columns}
-        VALUES {table_values}
-        """.format(
-            table_name=sql_models.TableGameMetadata.full_name,
-            table_columns=(
-                "(" 
-                + ", ".join(sql_models.TableGameMetadata.columns) 
-                + ")"
-            ),
-            table_values=tuple(
-                [game_id, json.dumps(data), thumbnail_key, video_key]
-            ),
-        )
-
-        auth_command = """
-        INSERT INTO {table_name} {table_columns}
-        VALUES {table_values}
-        """.format(
-            table_name=sql_models.TableAuthorizationScheme.full_name,
-            table_columns=(
-                "("
-                + ", ".join(sql_models.TableAuthorizationScheme.columns)
-                + ")"
-            ),
-            table_values=tuple(
-                [game_id, self.get_user(user.username).user_id]
-            ),
+        result = self.client.execute(
+            add_game_commands(
+                game_id,
+                self.get_user(user.username).user_id,
+                data,
+                thumbnail_key,
+                video_key,
+            )
         )
 
-        result = self.client.execute([game_command, auth_command])
-
         if result:
             return result
         else:
             return None
 
-    def insert_annotation(
-        self,
-        user: models.User,
-        img_id: str,
-        annotation_table: models.AnnotationTable,
-        annotation_data: Union[models.AnnotationPlayerBboxes, models.AnnotationFieldLines, models.AnnotationCameraAngle]
-    ) -> bool:
-        current_time = datetime.datetime.utcnow()
+    def update_game_data(self, game_id: str, data: dict):
+        self.client.execute(
+            UPDATE_GAME_DATA_COMMAND, {"game_id": game_id, "data": data}
+        )
 
-        is_empty = False
-        if annotation_table == models.AnnotationTable.player_bbox:
-            table = sql_models.TablePlayerBbox
-            
-            if len(annotation_data.bboxes) == 0:
-                is_empty = True
+    def find_ingested_game(self, content_sha256: str) -> dict:
+        """Returns the game_metadata row of a fully ingested game whose video
+        has the sha256 `content_sha256`, or None."""
+        return parse_ingested_game(
+            self.client.execute(*find_ingested_game_command(content_sha256))
+        )
 
-        elif annotation_table == models.AnnotationTable.field_lines:
-            table = sql_models.TableFieldLines
+    def add_deduplicated_game(
+        self,
+        user: models.User,
+        game_id: str,
+        data: dict,
+        source_game: dict,
+    ):
+        self.client.execute(
+            add_deduplicated_game_commands(
+                game_id,
+                self.get_user(user.username).user_id,
+                data,
+                source_game,
+            )
+        )
 
-        elif annotation_table == models.AnnotationTable.camera_angle:
-            table = sql_models.TableCameraAngle
+    def get_processing_status(self, game_id: str) -> models.ProcessingStatusResponse:
+        params = {"game_id": game_id}
 
-        else:
-            raise ValueError("Invalid annotation_table: {}".format(annotation_table))
-
-        annotation_transaction_command = """
-            INSERT INTO {annotation_transaction_table} {annotation_transaction_columns}
-            VALUES {annotation_transaction_values}
-        """.format(
-            annotation_transaction_table=sql_models.TableAnnotationTransaction.full_name,
-            annotation_transaction_columns="("
-            + ", ".join(sql_models.TableAnnotationTransaction.columns)
-            + ")",
-            annotation_transaction_values=(
-                "(" + 
-                ", ".join([
-                    "'{}'".format(img_id),
-                    "'{}'".format(current_time.strftime("%Y-%m-%d %H:%M:%S.%f")),
-                    "'{}'".format(table.table_name),
-                    "'{}'".format(models.AnnotationAction.submitted.name),
-                ]) + 
-                ")"
-            ),
+        return ingest_stages.parse_processing_status(
+            game_id,
+            self.client.execute(ingest_stages.GET_PROCESSING_STATUS_COMMAND, params),
+            self.client.execute(ingest_stages.GET_LATEST_JOB_COMMAND, params),
         )
 
-        if is_empty:
-            command = annotation_transaction_command
-        else:
-            command = """
-                WITH insert_annotation_status AS (
-                    {annotation_transaction_insert}
-                )
-                INSERT INTO {annotation_table} {annotation_columns}
-                VALUES {annotation_values}
-            """.format(
-                annotation_transaction_insert=annotation_transaction_command,
-                annotation_table=table.full_name,
-                annotation_columns="(" + ", ".join(table.columns) + ")",
-                annotation_values=annotation_to_sql_values(annotation_data),
+    def get_processing_summary(self, days: int) -> models.ProcessingSummaryResponse:
+        return ingest_stages.parse_processing_summary(
+            self.client.execute(
+                ingest_stages.GET_PROCESSING_SUMMARY_COMMAND, {"days": days}
             )
+        )
 
-        result = self.client.execute(command)
+    def insert_annotation(
+        self,
+        user: models.User,
+        img_id: str,
+        annotation_table: models.AnnotationTable,
+        annotation_data: Union[models.AnnotationPlayerBboxes, models.AnnotationFieldLines, models.AnnotationCameraAngle]
+    ) -> bool:
+        result = self.client.execute_prepared(
+            *insert_annotation_statement(
+                img_id, annotation_table, annotation_data
+            )
+        )
 
         return result
 
+    def insert_annotation_batch(
+        self,
+        user: models.User,
+        items: List[models.AnnotationBatchItem],
+    ) -> models.AnnotationBatchResponse:
+        start_time = time.perf_counter()
+        commands, errors = insert_annotation_batch_commands(items)
+        found_img_ids = self.client.execute(commands) if commands else []
+
+        return parse_annotation_batch(
+            items, errors, found_img_ids, time.perf_counter() - start_time
+        )
+
     def get_annotations(self, table: models.AnnotationTable):
         logger.debug("sql_backend:SQLBackend:get_annotations: table: {}".format(table))
 
-        table_instance = sql_models.match_table_from_string(
-            table.name,
-            sql_models.DatabaseUltitracker
-        )
+        result = self.client.execute(get_annotations_command(table))
 
-        command = textwrap.dedent(
-            f"""
-            SELECT * FROM {table_instance.full_name}
-            """
-        )
+        return result
 
-        result = self.client.execute(command)
+    def stream_annotations(
+        self,
+        table: models.AnnotationTable,
+        batch_size: int = ANNOTATION_STREAM_BATCH_SIZE,
+    ):
+        """Yields the whole annotation table as NDJSON, one chunk per batch."""
+        command, columns = stream_annotations_command(table)
 
-        return result
+        for rows in self.client.stream(command, batch_size=batch_size):
+            yield rows_to_ndjson(columns, rows)
 
     def get_image_path(self, img_id: str):
-        command = textwrap.dedent(
-            f"""
-            SELECT img_raw_path FROM {sql_models.TableImgLocation.full_name}
-            WHERE img_id = '{img_id}'
-            """
-        )
-
-        result = self.client.execute(command)
+        result = self.client.execute(*get_image_path_command(img_id))
 
         return result[0][0]
 
-    def query_images(self, query: dict):
-
-        where_query_command = ""
-        for i, (k, v) in enumerate(query.items()):
-            if i == 0:
-                where_query_command += "WHERE"
-
-            else:
-                where_query_command += " AND"
-
-            where_query_command += f" (il.img_metadata->>'{k}' = '{v}' OR gm.data->>'{k}' = '{v}')"
-
-        command = textwrap.dedent(
-            f"""
-            SELECT
-                il.*,
-                gm.data
-            FROM {sql_models.TableImgLocation.full_name} il
-            JOIN {sql_models.TableGameMetadata.full_name} gm ON il.game_id=gm.game_id
-            {where_query_command}
-            """
+    def query_images(
+        self,
+        query: dict = None,
+        img_query: dict = None,
+        game_query: dict = None,
+        limit: int = QUERY_IMAGES_DEFAULT_LIMIT,
+        cursor: str = None,
+        count_only: bool = False,
+    ) -> models.ImageQueryResponse:
+        result = self.client.execute(
+            *query_images_command(
+                query,
+                img_query=img_query,
+                game_query=game_query,
+                limit=limit,
+                cursor=cursor,
+                count_only=count_only,
+            )
         )
 
-        result = self.client.execute(command)
-        keys = sql_models.TableImgLocation.columns + ["data"]
-
-        return [
-            {k: v for k, v in zip(keys, line)}
-            for line in result
-        ]
+        return parse_query_images(result, limit=limit, count_only=count_only)
@@ -4,7 +4,7 @@ import datetime
 # from enum import Enum
 # from pydantic import BaseConfig, BaseModel
 from typing import Dict, Set, Optional
-from ultitrackerapi import models, POSTGRES_SCHEMA
+from ultitrackerapi import models, ANNOTATION_EXPIRATION_DURATION, POSTGRES_SCHEMA
 
 
 TableUsers = models.Table(
@@ -33,6 +33,12 @@ TableUsers = models.Table(
         )
         """.format(full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "users"))
     ],
+    indexes=[
+        models.Index(
+            name="users_username_idx",
+            columns=["username"],
+        ),
+    ],
 )
 
 
@@ -62,6 +68,20 @@ TableGameMetadata = models.Table(
         )
         """.format(full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "game_metadata"))
     ],
+    indexes=[
+        # game list filters use data @> filters
+        models.Index(
+            name="game_metadata_data_idx",
+            columns=["data jsonb_path_ops"],
+            method=models.IndexMethod.gin,
+        ),
+        # keyset pages of the game list in date order, the expression has to
+        # match the ORDER BY of GET_GAME_LIST_COMMANDS
+        models.Index(
+            name="game_metadata_date_game_id_idx",
+            columns=["(COALESCE(data->>'date', ''))", "game_id"],
+        ),
+    ],
 )
 
 
@@ -82,14 +102,20 @@ TableAuthorizationScheme = models.Table(
             users_full_name=TableUsers.full_name
         )
     ],
+    indexes=[
+        models.Index(
+            name="authorization_scheme_user_id_game_id_idx",
+            columns=["user_id", "game_id"],
+        ),
+    ],
 )
 
 
 TableImgLocation = models.Table(
     table_name="img_location",
     schema_name=POSTGRES_SCHEMA,
-    columns=["img_id", "img_raw_path", "img_type", "img_metadata", "game_id", "frame_number"],
-    column_types=[str, str, models.ImgEncoding, dict, str, int],
+    columns=["img_id", "img_raw_path", "img_type", "img_metadata", "game_id", "frame_number", "random_key"],
+    column_types=[str, str, models.ImgEncoding, dict, str, int, float],
     create_commands=[
         """
         CREATE TYPE img_encoding AS ENUM('jpeg', 'png', 'tiff')
@@ -102,6 +128,7 @@ TableImgLocation = models.Table(
             img_metadata JSONB NOT NULL,
             game_id TEXT REFERENCES {game_metadata_full_name}(game_id),
             frame_number INTEGER,
+            random_key DOUBLE PRECISION NOT NULL DEFAULT random(),
             PRIMARY KEY (img_id)
         )
         """.format(
@@ -109,6 +136,31 @@ TableImgLocation = models.Table(
             game_metadata_full_name=TableGameMetadata.full_name
         ),
     ],
+    migration_commands=[
+        # random sort key for the random annotation order, every existing
+        # row gets its own random() value
+        """
+        ALTER TABLE {full_name}
+        ADD COLUMN IF NOT EXISTS random_key DOUBLE PRECISION NOT NULL DEFAULT random()
+        """.format(
+            full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "img_location")
+        ),
+    ],
+    indexes=[
+        models.Index(
+            name="img_location_game_id_random_key_idx",
+            columns=["game_id", "random_key"],
+        ),
+        models.Index(
+            name="img_location_game_id_frame_number_idx",
+            columns=["game_id", "frame_number"],
+        ),
+        models.Index(
+            name="img_location_img_metadata_idx",
+            columns=["img_metadata jsonb_path_ops"],
+            method=models.IndexMethod.gin,
+        ),
+    ],
 )
 
 TablePlayerBbox = models.Table(
@@ -128,6 +180,17 @@ TablePlayerBbox = models.Table(
             img_location_full_name=TableImgLocation.full_name
         )
     ],
+    indexes=[
+        models.Index(
+            name="player_bbox_img_id_idx",
+            columns=["img_id"],
+        ),
+        models.Index(
+            name="player_bbox_bbox_idx",
+            columns=["bbox"],
+            method=models.IndexMethod.gist,
+        ),
+    ],
 )
 
 TableFieldLines = models.Table(
@@ -202,9 +265,217 @@ TableAnnotationTransaction = models.Table(
             img_location_full_name=TableImgLocation.full_name
         ),
     ],
+    indexes=[
+        # latest transaction of an image for a table
+        models.Index(
+            name="annotation_transaction_img_id_table_ref_timestamp_idx",
+            columns=["img_id", "table_ref", "timestamp DESC"],
+        ),
+    ],
+)
+
+# current state of every (img_id, table_ref) that has a transaction, written
+# in the same statement as the transaction so the annotator queue can look
+# up availability without scanning the history
+TableAnnotationStatus = models.Table(
+    table_name="annotation_status",
+    schema_name=POSTGRES_SCHEMA,
+    columns=[
+        "img_id",
+        "table_ref",
+        "status",
+        "lease_expiration",
+        "updated_at",
+    ],
+    column_types=[
+        str,
+        models.AnnotationTable,
+        models.AnnotationAction,
+        datetime.datetime,
+        datetime.datetime,
+    ],
+    create_commands=[
+        """
+        CREATE TABLE {full_name}(
+            img_id TEXT REFERENCES {img_location_full_name}(img_id),
+            table_ref annotation_table NOT NULL,
+            status annotation_action NOT NULL,
+            lease_expiration TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (img_id, table_ref)
+        )
+        """.format(
+            full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "annotation_status"),
+            img_location_full_name=TableImgLocation.full_name
+        ),
+        # backfill from the existing history, a submission always wins over
+        # a later lease
+        """
+        INSERT INTO {full_name} (img_id, table_ref, status, lease_expiration, updated_at)
+        SELECT DISTINCT ON (img_id, table_ref)
+            img_id,
+            table_ref,
+            action,
+            CASE
+                WHEN action = 'sent'
+                THEN timestamp + INTERVAL '{expiration_duration} SECONDS'
+            END,
+            timestamp
+        FROM {annotation_transaction_full_name}
+        ORDER BY img_id, table_ref, (action = 'submitted') DESC, timestamp DESC
+        """.format(
+            full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "annotation_status"),
+            annotation_transaction_full_name=TableAnnotationTransaction.full_name,
+            expiration_duration=ANNOTATION_EXPIRATION_DURATION,
+        ),
+    ],
+    indexes=[
+        # leases that may have expired, submitted images are never
+        # available again
+        models.Index(
+            name="annotation_status_sent_lease_expiration_idx",
+            columns=["table_ref", "lease_expiration"],
+            where="status = 'sent'",
+        ),
+    ],
 )
 
 
+# durable queue of uploaded videos to process, claimed by the video workers
+TableVideoJob = models.Table(
+    table_name="video_job",
+    schema_name=POSTGRES_SCHEMA,
+    columns=[
+        "job_id",
+        "game_id",
+        "payload",
+        "status",
+        "attempts",
+        "max_attempts",
+        "run_after",
+        "locked_by",
+        "locked_at",
+        "last_error",
+        "created_at",
+        "updated_at",
+    ],
+    column_types=[
+        str,
+        str,
+        dict,
+        str,
+        int,
+        int,
+        datetime.datetime,
+        str,
+        datetime.datetime,
+        str,
+        datetime.datetime,
+        datetime.datetime,
+    ],
+    create_commands=[
+        """
+        CREATE TYPE video_job_status AS ENUM ('queued', 'running', 'succeeded', 'failed')
+        """,
+        """
+        CREATE TABLE {full_name}(
+            job_id TEXT NOT NULL,
+            game_id TEXT REFERENCES {game_metadata_full_name}(game_id),
+            payload JSONB NOT NULL,
+            status video_job_status NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after TIMESTAMP NOT NULL,
+            locked_by TEXT,
+            locked_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (job_id)
+        )
+        """.format(
+            full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "video_job"),
+            game_metadata_full_name=TableGameMetadata.full_name,
+        ),
+    ],
+    indexes=[
+        models.Index(
+            name="video_job_queued_run_after_idx",
+            columns=["run_after"],
+            where="status = 'queued'",
+        ),
+        models.Index(
+            name="video_job_running_locked_at_idx",
+            columns=["locked_at"],
+            where="status = 'running'",
+        ),
+    ],
+)
+
+# one row per stage of a game's ingestion, see ultitrackerapi.ingest_stages
+TableIngestStage = models.Table(
+    table_name="ingest_stage",
+    schema_name=POSTGRES_SCHEMA,
+    columns=[
+        "game_id",
+        "stage",
+        "status",
+        "started_at",
+        "finished_at",
+        "num_bytes",
+        "num_frames",
+        "error",
+        "busy_seconds",
+    ],
+    column_types=[
+        str,
+        str,
+        str,
+        datetime.datetime,
+        datetime.datetime,
+        int,
+        int,
+        str,
+        float,
+    ],
+    create_commands=[
+        """
+        CREATE TABLE {full_name}(
+            game_id TEXT REFERENCES {game_metadata_full_name}(game_id),
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            num_bytes BIGINT,
+            num_frames INTEGER,
+            error TEXT,
+            busy_seconds DOUBLE PRECISION,
+            PRIMARY KEY (game_id, stage)
+        )
+        """.format(
+            full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "ingest_stage"),
+            game_metadata_full_name=TableGameMetadata.full_name,
+        ),
+    ],
+    migration_commands=[
+        # time the stage had work running, the stages of the chunk pipeline
+        # overlap so their wall clock durations all span the whole pipeline
+        """
+        ALTER TABLE {full_name}
+        ADD COLUMN IF NOT EXISTS busy_seconds DOUBLE PRECISION
+        """.format(
+            full_name=models.Table.construct_full_name(POSTGRES_SCHEMA, "ingest_stage")
+        ),
+    ],
+    indexes=[
+        # stage latency summaries over the recently finished stages
+        models.Index(
+            name="ingest_stage_finished_at_idx",
+            columns=["finished_at"],
+        ),
+    ],
+)
+
 DatabaseUltitracker = models.Database(
     name="ultitracker",
     tables=set([
@@ -215,7 +486,10 @@ DatabaseUltitracker = models.Database(
         TablePlayerBbox,
         TableFieldLines,
         TableCameraAngle,
-        TableAnnotationTransaction
+        TableAnnotationTransaction,
+        TableAnnotationStatus,
+        TableVideoJob,
+        TableIngestStage,
     ])
 )
 
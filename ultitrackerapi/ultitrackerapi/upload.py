@@ -0,0 +1,143 @@
+"""Streams a multipart/form-data upload to disk as it arrives.
+
+Declaring `UploadFile = File(...)` on a route has Starlette read and spool
+the whole body before the route runs, so neither a size limit nor hashing
+in the route can act on the upload while it is received. `receive_upload`
+parses the body from `request.stream()` instead: the file part is hashed
+and written out chunk by chunk and the upload is rejected as soon as the
+body grows past its limit.
+"""
+import aiofiles
+import hashlib
+
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_413_REQUEST_ENTITY_TOO_LARGE, HTTP_422_UNPROCESSABLE_ENTITY
+from typing import Dict, List, Tuple
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+
+# the other form fields are small strings held in memory
+MAX_FIELD_SIZE = 64 * 1024
+
+
+def _too_large(max_size: int) -> HTTPException:
+    return HTTPException(
+        status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="Upload larger than {} bytes".format(max_size),
+    )
+
+
+async def receive_upload(
+    request: Request,
+    file_field: str,
+    field_names: List[str],
+    filename: str,
+    max_size: int,
+) -> Tuple[Dict[str, str], str, int]:
+    """Writes the `file_field` part of the body of `request` to `filename`
+    and returns the `field_names` form fields, the sha256 hex digest of the
+    file and its size in bytes.
+
+    Raises a 413 as soon as the body is larger than `max_size` bytes, which
+    bounds the file and every field.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_size:
+        raise _too_large(max_size)
+
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="Expected a multipart/form-data body",
+        )
+
+    # the parser calls back synchronously, the events are handled after
+    # every chunk so that the file is written without blocking
+    events = []
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": lambda: events.append(("part_begin", b"")),
+        "on_part_data": lambda data, start, end: events.append(("part_data", data[start:end])),
+        "on_part_end": lambda: events.append(("part_end", b"")),
+        "on_header_field": lambda data, start, end: events.append(("header_field", data[start:end])),
+        "on_header_value": lambda data, start, end: events.append(("header_value", data[start:end])),
+        "on_header_end": lambda: events.append(("header_end", b"")),
+        "on_headers_finished": lambda: events.append(("headers_finished", b"")),
+    })
+
+    fields = {}
+    content_sha256 = hashlib.sha256()
+    num_file_bytes = 0
+    received_file = False
+    num_bytes = 0
+
+    async with aiofiles.open(filename, "wb") as f:
+        part_name = None
+        is_file = False
+        header_field = b""
+        header_value = b""
+        headers = {}
+        value = bytearray()
+
+        async for chunk in request.stream():
+            num_bytes += len(chunk)
+            if num_bytes > max_size:
+                raise _too_large(max_size)
+
+            parser.write(chunk)
+            for event, data in events:
+                if event == "part_begin":
+                    headers = {}
+                    value = bytearray()
+                elif event == "header_field":
+                    header_field += data
+                elif event == "header_value":
+                    header_value += data
+                elif event == "header_end":
+                    headers[header_field.lower()] = header_value
+                    header_field = b""
+                    header_value = b""
+                elif event == "headers_finished":
+                    _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+                    part_name = disposition.get(b"name", b"").decode("utf-8")
+                    is_file = part_name == file_field
+                    received_file = received_file or is_file
+                elif event == "part_data":
+                    if is_file:
+                        content_sha256.update(data)
+                        num_file_bytes += len(data)
+                        await f.write(data)
+                    else:
+                        value += data
+                        if len(value) > MAX_FIELD_SIZE:
+                            raise HTTPException(
+                                status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail="Form field {} larger than {} bytes".format(part_name, MAX_FIELD_SIZE),
+                            )
+                elif event == "part_end" and not is_file:
+                    fields[part_name] = value.decode("utf-8")
+
+            events.clear()
+
+        parser.finalize()
+
+    missing = [name for name in field_names if name not in fields]
+    if not received_file:
+        missing.insert(0, file_field)
+
+    if missing:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Missing form fields: {}".format(", ".join(missing)),
+        )
+
+    return (
+        {name: fields[name] for name in field_names},
+        content_sha256.hexdigest(),
+        num_file_bytes,
+    )
@@ -1,7 +1,17 @@
+import csv
 import ffmpeg
+import io
+import numpy as np
 import os
+import queue
+import statistics
 import subprocess
 
+from PIL import Image
+
+from ultitrackerapi import VIDEO_PROBE_CACHE_MAX_SIZE, VIDEO_PROBE_CACHE_TTL
+from ultitrackerapi.cache import TTLCache
+
 
 def get_thumbnail(in_filename, out_filename, time=1):
     (
@@ -13,55 +23,338 @@ def get_thumbnail(in_filename, out_filename, time=1):
     )
 
 
+# seconds of video read to estimate the keyframe interval
+KEYFRAME_PROBE_WINDOW = 120
+
+
+class VideoProbe(object):
+    """Metadata of the video stream of a file from a single ffprobe run.
+
+    The first video stream that is not an attached cover picture is used,
+    rather than whatever stream happens to come first. Use `probe_video` to
+    reuse the probe of an unchanged file.
+    """
+
+    def __init__(self, in_filename, probe=None):
+        self.filename = in_filename
+        self.probe = probe if probe is not None else ffmpeg.probe(in_filename)
+
+        video_streams = [
+            stream for stream in self.probe["streams"]
+            if stream.get("codec_type") == "video"
+            and not stream.get("disposition", {}).get("attached_pic")
+        ]
+        if not video_streams:
+            raise ValueError("No video stream in {}".format(in_filename))
+
+        self.stream = video_streams[0]
+        self._keyframe_interval = None
+        self._keyframe_interval_probed = False
+
+    @property
+    def duration(self):
+        # not every container stores the duration on the stream
+        duration = self.stream.get("duration") or self.probe.get("format", {}).get("duration")
+        return float(duration)
+
+    @property
+    def height(self):
+        return self.stream["height"]
+
+    @property
+    def width(self):
+        return self.stream["width"]
+
+    @property
+    def fps(self):
+        for rate in [self.stream.get("avg_frame_rate"), self.stream.get("r_frame_rate")]:
+            if rate:
+                numerator, denominator = rate.split("/")
+                if int(denominator) != 0 and int(numerator) != 0:
+                    return float(int(numerator)) / int(denominator)
+
+        return None
+
+    @property
+    def codec(self):
+        return self.stream.get("codec_name")
+
+    @property
+    def bit_rate(self):
+        """Bits per second of the video stream, or of the whole file when
+        the container does not report it per stream."""
+        bit_rate = self.stream.get("bit_rate") or self.probe.get("format", {}).get("bit_rate")
+        return int(bit_rate) if bit_rate else None
+
+    @property
+    def keyframe_interval(self):
+        """Median seconds between keyframes in the first
+        KEYFRAME_PROBE_WINDOW seconds.
+
+        Needs another ffprobe run over the packets, so it is only computed
+        on first use and then kept.
+        """
+        if not self._keyframe_interval_probed:
+            keyframes = ffmpeg.probe(
+                self.filename,
+                select_streams=str(self.stream["index"]),
+                skip_frame="nokey",
+                show_entries="frame=best_effort_timestamp_time",
+                read_intervals="%+{}".format(KEYFRAME_PROBE_WINDOW),
+            ).get("frames", [])
+            times = sorted(
+                float(frame["best_effort_timestamp_time"]) for frame in keyframes
+                if "best_effort_timestamp_time" in frame
+            )
+            intervals = [end - start for start, end in zip(times, times[1:])]
+
+            self._keyframe_interval = statistics.median(intervals) if intervals else None
+            self._keyframe_interval_probed = True
+
+        return self._keyframe_interval
+
+    def height_width(self):
+        return {
+            "height": self.height,
+            "width": self.width
+        }
+
+
+_probe_cache = TTLCache(max_size=VIDEO_PROBE_CACHE_MAX_SIZE, ttl=VIDEO_PROBE_CACHE_TTL)
+
+
+def probe_video(in_filename):
+    """Returns the `VideoProbe` of `in_filename`, probing the file only if
+    it was not probed before with the same modification time and size."""
+    stat = os.stat(in_filename)
+    key = (os.path.realpath(in_filename), stat.st_mtime_ns, stat.st_size)
+
+    video_probe = _probe_cache.get(key)
+    if video_probe is None:
+        video_probe = VideoProbe(in_filename)
+        _probe_cache.set(key, video_probe)
+
+    return video_probe
+
+
 def get_video_duration(in_filename):
-    return float(ffmpeg.probe(in_filename)["streams"][0]["duration"])
+    return probe_video(in_filename).duration
 
 
 def get_video_height_width(in_filename):
-    stream_info = ffmpeg.probe(in_filename)["streams"][0]
-    return {
-        "height": stream_info["height"],
-        "width": stream_info["width"]
-    }
+    return probe_video(in_filename).height_width()
 
 
 def get_video_fps(in_filename):
-    stream_info = ffmpeg.probe(in_filename)["streams"][0]
-    numerator, denominator = stream_info["r_frame_rate"].split("/")
-    return float(int(numerator)) / int(denominator)
+    return probe_video(in_filename).fps
 
 
-def extract_frames(in_filename, out_directory, fps=1):
+def extract_frames(in_filename, out_directory, fps=1, width=720, threads=None):
+    """
+    Parameters
+    ----------
+    in_filename : Path to video to extract frames from
+    out_directory : Path to write out the frames as frame_%06d.png
+    fps : Frames extracted per second of video
+    width : Width the frames are scaled to, keeping the aspect ratio
+    threads : Optional cap on the decoding and encoding threads of ffmpeg
+    """
+    input_kwargs = {}
+    output_kwargs = {}
+    if threads is not None:
+        input_kwargs["threads"] = threads
+        output_kwargs["threads"] = threads
+
     (
-        ffmpeg.input(in_filename)
-        .filter("scale", 720, -1)
+        ffmpeg.input(in_filename, **input_kwargs)
+        .filter("scale", width, -1)
         .filter("fps", fps)
         .output(
             os.path.join(out_directory, "frame_%06d.png"),
+            **output_kwargs
         ).overwrite_output()
         .run()
     )
 
 
-def chunk_video(in_filename, out_directory, chunk_size=60):
+def scaled_height(in_width, in_height, width):
+    """Height of frames scaled to `width` with the aspect ratio kept."""
+    return max(1, int(round(width * in_height / in_width)))
+
+
+class RawFrameReader(object):
+    """Reads the frames `extract_frames` would write from ffmpeg's stdout
+    into reusable NumPy buffers instead of files.
+
+    Iterating yields (frame_index, frame) with 1 based frame indices, the
+    same numbering as the frame_%06d.png files. `frame` is a (height,
+    width, 3) uint8 RGB buffer that is filled again with a later frame once
+    it is handed back with `release`. At most `num_buffers` frames are held
+    at a time and ffmpeg is throttled while all of them are in use.
+    """
+
+    def __init__(self, in_filename, width, height, fps=1, threads=None, num_buffers=8, cmd="ffmpeg"):
+        self._in_filename = in_filename
+        self._width = width
+        self._height = height
+        self._fps = fps
+        self._threads = threads
+        self._cmd = cmd
+
+        self._free_buffers = queue.Queue()
+        for _ in range(num_buffers):
+            self._free_buffers.put(np.empty((height, width, 3), dtype=np.uint8))
+
+    def release(self, frame):
+        self._free_buffers.put(frame)
+
+    @staticmethod
+    def _read_into(stream, frame):
+        view = memoryview(frame).cast("B")
+        num_read = 0
+        while num_read < len(view):
+            n = stream.readinto(view[num_read:])
+            if not n:
+                break
+            num_read += n
+
+        if num_read == 0:
+            return False
+
+        if num_read < len(view):
+            raise ValueError("ffmpeg wrote a truncated frame")
+
+        return True
+
+    def __iter__(self):
+        input_kwargs = {}
+        output_kwargs = {}
+        if self._threads is not None:
+            input_kwargs["threads"] = self._threads
+            output_kwargs["threads"] = self._threads
+
+        process = (
+            ffmpeg.input(self._in_filename, **input_kwargs)
+            .filter("scale", self._width, self._height)
+            .filter("fps", self._fps)
+            .output("pipe:", format="rawvideo", pix_fmt="rgb24", **output_kwargs)
+            .run_async(cmd=self._cmd, pipe_stdout=True)
+        )
+
+        finished = False
+        try:
+            frame_index = 0
+            while True:
+                frame = self._free_buffers.get()
+                if not self._read_into(process.stdout, frame):
+                    self.release(frame)
+                    break
+
+                frame_index += 1
+                yield frame_index, frame
+
+            finished = True
+        finally:
+            process.stdout.close()
+            if not finished and process.poll() is None:
+                process.kill()
+            process.wait()
+
+        if process.returncode:
+            raise ValueError("ffmpeg", process.returncode)
+
+
+def encode_png(frame):
+    out = io.BytesIO()
+    Image.fromarray(frame).save(out, format="PNG")
+    return out.getvalue()
+
+
+def start_chunk_video(in_filename, out_directory, chunk_size=60, segment_list_filename=None):
+    """Starts the ffmpeg process of `chunk_video` without waiting for it.
+
+    Every chunk is added to the segment list once ffmpeg finished writing
+    it, so `SegmentListWatcher` can follow the chunks while ffmpeg runs.
+    """
+
+    command = "ffmpeg -i {input_filename} -codec copy -f segment -segment_time {chunk_size}".format(
+        input_filename=in_filename,
+        chunk_size=chunk_size,
+    ).split(" ")
+
+    # chunks are cut on keyframes, so their real start times drift from
+    # multiples of chunk_size
+    if segment_list_filename is not None:
+        command += [
+            "-segment_list", segment_list_filename,
+            "-segment_list_type", "csv",
+        ]
+
+    command.append(os.path.join(out_directory, "chunk_%03d.mp4"))
+
+    return subprocess.Popen(command)
+
+
+def chunk_video(in_filename, out_directory, chunk_size=60, segment_list_filename=None):
     """
     Parameters
     ----------
     in_filename : Path to video to chunk
     out_directory : Path to write out the video chunks
     chunk_size : Length in seconds of chunked video
+    segment_list_filename : Optional path to write a csv of every chunk's
+        filename, start and end time in seconds to, see `read_segment_list`
     """
 
-    command = "ffmpeg -i {input_filename} -codec copy -f segment -segment_time {chunk_size} {out_directory}".format(
-        input_filename=in_filename,
-        chunk_size=chunk_size,
-        out_directory=os.path.join(out_directory, "chunk_%03d.mp4")
-    ).split(" ")
-
-    process = subprocess.Popen(command)
+    process = start_chunk_video(in_filename, out_directory, chunk_size, segment_list_filename)
     out, err = process.communicate(input)
     retcode = process.poll()
     if retcode:
         raise ValueError("ffmpeg", out, err)
 
     return out, err
+
+
+def read_segment_list(segment_list_filename):
+    """Reads the csv segment list written by `chunk_video` into a dict of
+    chunk filename to (start, end) time in seconds."""
+    segments = {}
+    with open(segment_list_filename, newline="") as f:
+        for row in csv.reader(f):
+            if row:
+                segments[row[0]] = (float(row[1]), float(row[2]))
+
+    return segments
+
+
+
+class SegmentListWatcher(object):
+    """Follows the csv segment list of a running `start_chunk_video`.
+
+    Every call to `poll` returns the (chunk filename, start, end) of the
+    chunks completed since the previous call. Lines ffmpeg has only partly
+    written are kept until they are complete.
+    """
+
+    def __init__(self, segment_list_filename):
+        self._segment_list_filename = segment_list_filename
+        self._offset = 0
+        self._partial_line = b""
+
+    def poll(self):
+        if not os.path.exists(self._segment_list_filename):
+            return []
+
+        with open(self._segment_list_filename, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        self._offset += len(data)
+        lines = (self._partial_line + data).split(b"\n")
+        self._partial_line = lines.pop()
+
+        return [
+            (row[0], float(row[1]), float(row[2]))
+            for row in csv.reader(line.decode("utf-8") for line in lines)
+            if row
+        ]
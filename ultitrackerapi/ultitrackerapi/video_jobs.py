@@ -0,0 +1,225 @@
+"""Durable queue of video processing jobs in `ultitracker.video_job`.
+
+The API enqueues a job per uploaded video and any number of
+`video_worker` processes claim jobs with SKIP LOCKED, so a job is only ever
+run by one worker at a time. Running jobs are kept alive by heartbeats; a
+job whose worker stopped sending them is claimed again by another worker.
+Failed jobs are retried with an exponential backoff up to their
+`max_attempts`.
+"""
+import uuid
+
+from typing import List
+from ultitrackerapi import get_logger, sql_backend, sql_models
+from ultitrackerapi import (
+    VIDEO_JOB_MAX_ATTEMPTS,
+    VIDEO_JOB_RETRY_DELAY,
+    VIDEO_JOB_STALE_TIMEOUT,
+)
+
+
+logger = get_logger(__name__, "DEBUG")
+
+
+ENQUEUE_COMMAND = """
+INSERT INTO {table_name} (job_id, game_id, payload, status, max_attempts, run_after, created_at, updated_at)
+VALUES (
+    %(job_id)s,
+    %(game_id)s,
+    %(payload)s::jsonb,
+    'queued',
+    %(max_attempts)s,
+    NOW() AT TIME ZONE 'utc',
+    NOW() AT TIME ZONE 'utc',
+    NOW() AT TIME ZONE 'utc'
+)
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+# stale jobs that used up their attempts will not be claimed again
+FAIL_STALE_JOBS_COMMAND = """
+UPDATE {table_name}
+SET
+    status = 'failed',
+    locked_by = NULL,
+    last_error = 'Worker stopped sending heartbeats',
+    updated_at = NOW() AT TIME ZONE 'utc'
+WHERE 1=1
+    AND status = 'running'
+    AND locked_at <= NOW() AT TIME ZONE 'utc' - make_interval(secs => %(stale_timeout)s)
+    AND attempts >= max_attempts
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+CLAIM_COMMAND = """
+WITH claimable AS (
+    SELECT job_id
+    FROM {table_name}
+    WHERE 1=1
+        AND (
+            (status = 'queued' AND run_after <= NOW() AT TIME ZONE 'utc')
+            OR (
+                status = 'running'
+                AND locked_at <= NOW() AT TIME ZONE 'utc' - make_interval(secs => %(stale_timeout)s)
+                AND attempts < max_attempts
+            )
+        )
+    ORDER BY run_after
+    LIMIT %(num_jobs)s
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE {table_name} J
+SET
+    status = 'running',
+    attempts = J.attempts + 1,
+    locked_by = %(worker_id)s,
+    locked_at = NOW() AT TIME ZONE 'utc',
+    updated_at = NOW() AT TIME ZONE 'utc'
+FROM claimable
+WHERE J.job_id = claimable.job_id
+RETURNING J.job_id, J.game_id, J.payload, J.attempts, J.max_attempts
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+HEARTBEAT_COMMAND = """
+UPDATE {table_name}
+SET locked_at = NOW() AT TIME ZONE 'utc'
+WHERE 1=1
+    AND job_id = ANY(%(job_ids)s::text[])
+    AND locked_by = %(worker_id)s
+    AND status = 'running'
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+COMPLETE_COMMAND = """
+UPDATE {table_name}
+SET
+    status = 'succeeded',
+    locked_by = NULL,
+    locked_at = NULL,
+    last_error = NULL,
+    updated_at = NOW() AT TIME ZONE 'utc'
+WHERE job_id = %(job_id)s AND locked_by = %(worker_id)s
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+# retried after `retry_delay * 2^(attempts - 1)` seconds until the attempts
+# are used up
+FAIL_COMMAND = """
+UPDATE {table_name}
+SET
+    status = CASE
+        WHEN attempts >= max_attempts THEN 'failed'::video_job_status
+        ELSE 'queued'::video_job_status
+    END,
+    run_after = NOW() AT TIME ZONE 'utc'
+        + make_interval(secs => %(retry_delay)s * power(2, attempts - 1)),
+    locked_by = NULL,
+    locked_at = NULL,
+    last_error = %(error)s,
+    updated_at = NOW() AT TIME ZONE 'utc'
+WHERE job_id = %(job_id)s AND locked_by = %(worker_id)s
+RETURNING status
+""".format(table_name=sql_models.TableVideoJob.full_name)
+
+
+# rows left behind by a failed attempt, images that already have an
+# annotation status are kept and the retry skips them when it inserts
+CLEAR_PARTIAL_INGEST_COMMAND = """
+DELETE FROM {img_location_name} L
+WHERE 1=1
+    AND L.game_id = %(game_id)s
+    AND NOT EXISTS (
+        SELECT 1
+        FROM {annotation_status_name} S
+        WHERE S.img_id = L.img_id
+    )
+""".format(
+    img_location_name=sql_models.TableImgLocation.full_name,
+    annotation_status_name=sql_models.TableAnnotationStatus.full_name,
+)
+
+
+class VideoJob(object):
+    def __init__(self, job_id: str, game_id: str, payload: dict, attempts: int, max_attempts: int):
+        self.job_id = job_id
+        self.game_id = game_id
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+
+
+def enqueue(
+    client: sql_backend.SQLClient,
+    game_id: str,
+    payload: dict,
+    max_attempts: int = VIDEO_JOB_MAX_ATTEMPTS,
+    commands: list = [],
+) -> str:
+    """Enqueues a job for `game_id`. The (command, params) pairs of
+    `commands` run first in the same transaction, so a game can be added
+    together with the job that processes it."""
+    job_id = str(uuid.uuid4())
+    client.execute(list(commands) + [(ENQUEUE_COMMAND, {
+        "job_id": job_id,
+        "game_id": game_id,
+        "payload": payload,
+        "max_attempts": max_attempts,
+    })])
+
+    return job_id
+
+
+def claim(
+    client: sql_backend.SQLClient,
+    worker_id: str,
+    num_jobs: int,
+    stale_timeout: float = VIDEO_JOB_STALE_TIMEOUT,
+) -> List[VideoJob]:
+    params = {
+        "worker_id": worker_id,
+        "num_jobs": num_jobs,
+        "stale_timeout": float(stale_timeout),
+    }
+    results = client.execute([
+        (FAIL_STALE_JOBS_COMMAND, params),
+        (CLAIM_COMMAND, params),
+    ])
+
+    return [VideoJob(*result) for result in results or []]
+
+
+def heartbeat(client: sql_backend.SQLClient, worker_id: str, job_ids: List[str]):
+    if job_ids:
+        client.execute(
+            HEARTBEAT_COMMAND, {"job_ids": job_ids, "worker_id": worker_id}
+        )
+
+
+def clear_partial_ingest(client: sql_backend.SQLClient, job: VideoJob):
+    """Removes the frames inserted by earlier attempts of `job`, so a retry
+    does not insert them twice. Frames that were already queued for
+    annotation are kept, the retry leaves them out when it inserts."""
+    client.execute(CLEAR_PARTIAL_INGEST_COMMAND, {"game_id": job.game_id})
+
+
+def complete(client: sql_backend.SQLClient, worker_id: str, job: VideoJob):
+    client.execute(COMPLETE_COMMAND, {"job_id": job.job_id, "worker_id": worker_id})
+
+
+def fail(
+    client: sql_backend.SQLClient,
+    worker_id: str,
+    job: VideoJob,
+    error: str,
+    retry_delay: float = VIDEO_JOB_RETRY_DELAY,
+) -> str:
+    """Records a failed attempt and returns the new status of the job."""
+    result = client.execute(FAIL_COMMAND, {
+        "job_id": job.job_id,
+        "worker_id": worker_id,
+        "error": error,
+        "retry_delay": float(retry_delay),
+    })
+
+    return result[0][0] if result else None
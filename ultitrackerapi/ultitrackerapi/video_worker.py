@@ -0,0 +1,176 @@
+"""Long running worker that processes uploaded videos from the video job
+queue.
+
+Run one per node with
+
+    python -m ultitrackerapi.video_worker --num_slots 2
+
+Every slot processes one video at a time. A worker only claims as many
+jobs as it has free slots, so bursts of uploads queue up in the database
+and are spread over every running worker.
+"""
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import traceback
+import uuid
+
+from concurrent import futures
+from ultitrackerapi import get_logger, get_s3Client, get_sync_backend, video_jobs
+from ultitrackerapi import (
+    VIDEO_JOB_HEARTBEAT_INTERVAL,
+    VIDEO_WORKER_NUM_SLOTS,
+    VIDEO_WORKER_POLL_INTERVAL,
+)
+from ultitrackerapi.extract_and_upload_video import extract_and_upload_video
+
+
+logger = get_logger(__name__, "DEBUG")
+
+
+def process_job(job: video_jobs.VideoJob):
+    """Downloads the staged video of `job` and runs the extraction."""
+    payload = job.payload
+    s3Client = get_s3Client()
+
+    if job.attempts > 1:
+        video_jobs.clear_partial_ingest(get_sync_backend().client, job)
+
+    fd, video_filename = tempfile.mkstemp()
+    os.close(fd)
+    thumbnail_filename = video_filename + "_thumbnail.jpg"
+
+    try:
+        s3Client.download_file(
+            payload["bucket"], payload["video_key"], video_filename
+        )
+
+        extract_and_upload_video(
+            bucket=payload["bucket"],
+            video_filename=video_filename,
+            thumbnail_filename=thumbnail_filename,
+            video_key=payload["video_key"],
+            thumbnail_key=payload["thumbnail_key"],
+            game_id=job.game_id,
+            # the API uploaded it to video_key already
+            upload_video=False,
+        )
+    finally:
+        # extract_and_upload_video removes them itself when it succeeds
+        for filename in [video_filename, thumbnail_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class VideoWorker(object):
+    def __init__(
+        self,
+        num_slots: int = VIDEO_WORKER_NUM_SLOTS,
+        poll_interval: float = VIDEO_WORKER_POLL_INTERVAL,
+        heartbeat_interval: float = VIDEO_JOB_HEARTBEAT_INTERVAL,
+    ):
+        self._client = get_sync_backend().client
+        self._num_slots = num_slots
+        self._poll_interval = poll_interval
+        self._heartbeat_interval = heartbeat_interval
+        self.worker_id = "{}-{}-{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+
+        self._lock = threading.Lock()
+        # job_id -> VideoJob of the running jobs
+        self._running = {}
+        self._stop = threading.Event()
+        # set when a slot frees up or the worker stops
+        self._wakeup = threading.Event()
+
+    def _run_job(self, job: video_jobs.VideoJob):
+        logger.info("Worker {}: starting job {} of game {}, attempt {} of {}".format(
+            self.worker_id, job.job_id, job.game_id, job.attempts, job.max_attempts
+        ))
+        try:
+            process_job(job)
+        except Exception:
+            error = traceback.format_exc()
+            status = video_jobs.fail(self._client, self.worker_id, job, error)
+            logger.error("Worker {}: job {} failed, now {}: {}".format(
+                self.worker_id, job.job_id, status, error
+            ))
+        else:
+            video_jobs.complete(self._client, self.worker_id, job)
+            logger.info("Worker {}: finished job {}".format(self.worker_id, job.job_id))
+        finally:
+            with self._lock:
+                self._running.pop(job.job_id, None)
+
+            self._wakeup.set()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self._heartbeat_interval):
+            with self._lock:
+                job_ids = list(self._running)
+
+            try:
+                video_jobs.heartbeat(self._client, self.worker_id, job_ids)
+            except Exception as e:
+                logger.error("Worker {}: heartbeat failed: {}".format(self.worker_id, e))
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def run(self):
+        """Claims and runs jobs until `stop` is called, then waits for the
+        running jobs to finish."""
+        heartbeat_thread = threading.Thread(
+            target=self._heartbeat, name="video-worker-heartbeat", daemon=True
+        )
+        heartbeat_thread.start()
+
+        logger.info("Worker {}: started with {} slots".format(self.worker_id, self._num_slots))
+        with futures.ThreadPoolExecutor(self._num_slots) as executor:
+            while not self._stop.is_set():
+                with self._lock:
+                    num_free_slots = self._num_slots - len(self._running)
+
+                jobs = []
+                if num_free_slots > 0:
+                    try:
+                        jobs = video_jobs.claim(
+                            self._client, self.worker_id, num_free_slots
+                        )
+                    except Exception as e:
+                        logger.error("Worker {}: claim failed: {}".format(self.worker_id, e))
+
+                for job in jobs:
+                    with self._lock:
+                        self._running[job.job_id] = job
+
+                    executor.submit(self._run_job, job)
+
+                # the queue was drained or every slot is busy
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+
+        heartbeat_thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--num_slots", type=int, default=VIDEO_WORKER_NUM_SLOTS)
+    parser.add_argument("--poll_interval", type=float, default=VIDEO_WORKER_POLL_INTERVAL)
+
+    args = parser.parse_args()
+
+    worker = VideoWorker(num_slots=args.num_slots, poll_interval=args.poll_interval)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()